@@ -0,0 +1,224 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# Caches of parsed macro and configuration files and shell macro output.
+#
+# A cache of parsed macro and configuration files. A file's entry holds its
+# path, modification time, size and the hash of its contents with the parsed
+# data. An entry is used if the file's time and size match, or if they do not
+# and the hash of the contents matches. Included files are not part of an
+# entry, an include is held as a reference and each included file is looked
+# up when loaded.
+#
+
+import hashlib
+import os
+import pickle
+import threading
+
+from . import error
+from . import log
+from . import path
+
+#
+# Change if the parsed data's format changes.
+#
+version = 1
+
+def digest(text):
+    return hashlib.sha256(text).hexdigest()
+
+class parse_cache(object):
+    '''A directory of parsed files. The cache does nothing until it is
+    enabled.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directory = None
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_name(self, kind, name):
+        key = '%s:%d:%s' % (kind, version, path.abspath(name))
+        return path.join(self.directory,
+                         '%s.pickle' % (hashlib.sha1(key).hexdigest()))
+
+    def _load(self, entry_name):
+        try:
+            f = open(path.host(entry_name), 'rb')
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError,
+                TypeError, pickle.PickleError):
+            return None
+        if type(entry) is not dict or entry.get('version') != version:
+            return None
+        return entry
+
+    def _save(self, entry_name, entry):
+        tmp = '%s.%d.%d' % (entry_name, os.getpid(), threading.current_thread().ident)
+        try:
+            f = open(path.host(tmp), 'wb')
+            try:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(path.host(tmp), path.host(entry_name))
+        except (IOError, OSError) as err:
+            log.trace('cache: save failed: %s: %s' % (entry_name, err))
+            try:
+                os.remove(path.host(tmp))
+            except OSError:
+                pass
+
+    def enable(self, directory):
+        directory = path.abspath(directory)
+        if not path.isdir(directory):
+            path.mkdir(directory)
+        self.directory = directory
+
+    def enabled(self):
+        return self.directory is not None
+
+    def get(self, kind, name):
+        '''Return the parsed data of the file or None if the file has not
+        been parsed or has changed.'''
+        if self.directory is None:
+            return None
+        try:
+            st = os.stat(path.host(name))
+        except OSError:
+            return None
+        entry_name = self._entry_name(kind, name)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(entry_name)
+            if entry is None:
+                entry = self._load(entry_name)
+            if entry is not None:
+                if entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                    try:
+                        f = open(path.host(name), 'rb')
+                        try:
+                            text = f.read()
+                        finally:
+                            f.close()
+                    except IOError:
+                        return None
+                    if entry['size'] != len(text) or entry['hash'] != digest(text):
+                        log.trace('cache: changed: %s' % (name))
+                        entry = None
+                    else:
+                        entry['mtime'] = st.st_mtime
+                        entry['size'] = st.st_size
+                        self._save(entry_name, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[entry_name] = entry
+            self.hits += 1
+            return entry['data']
+        finally:
+            self.lock.release()
+
+    def put(self, kind, name, text, data):
+        '''Add the data parsed from the text read from the file.'''
+        if self.directory is None:
+            return
+        try:
+            st = os.stat(path.host(name))
+        except OSError:
+            return
+        entry_name = self._entry_name(kind, name)
+        entry = { 'version': version,
+                  'kind': kind,
+                  'path': path.abspath(name),
+                  'mtime': st.st_mtime,
+                  'size': len(text),
+                  'hash': digest(text),
+                  'data': data }
+        self.lock.acquire()
+        try:
+            self.entries[entry_name] = entry
+            self._save(entry_name, entry)
+        finally:
+            self.lock.release()
+
+class shell_cache(object):
+    '''The output of shell macros. A config file declares the scope of its
+    shell macros with '%shell_cache <scope>'. A macro with the 'never' scope
+    is run each time it is expanded, one with the 'bsp' scope is run once for
+    each BSP and one with the 'run' scope is run once in a run.'''
+
+    scopes = ['never', 'bsp', 'run']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.spawns = 0
+        self.avoided = 0
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.outputs:
+                self.avoided += 1
+                return self.outputs[key]
+            return None
+        finally:
+            self.lock.release()
+
+    def put(self, key, output):
+        self.lock.acquire()
+        try:
+            self.spawns += 1
+            if key is not None:
+                self.outputs[key] = output
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.outputs = {}
+        self.lock.release()
+
+#
+# The parse cache of this process.
+#
+parsed = parse_cache()
+
+#
+# The shell macro outputs of this process.
+#
+shells = shell_cache()
@@ -42,11 +42,13 @@ import re
 import sys
 
 try:
-    import error
-    import execute
-    import log
-    import options
-    import path
+    from . import cache
+    from . import error
+    from . import execute
+    from . import log
+    from . import macros
+    from . import options
+    from . import path
 except KeyboardInterrupt:
     print('user terminated')
     sys.exit(1)
@@ -84,12 +86,19 @@ class file(object):
         self.wss = re.compile(r'\s+')
         self.tags = re.compile(r':+')
         self.sf = re.compile(r'%\([^\)]+\)')
+        self._memo = {}
+        self._dependents = {}
+        self._memo_generation = None
+        self._deps = []
+        self._expanding = set()
+        self._effects = 0
         for arg in self.opts.args:
             if arg.startswith('--with-') or arg.startswith('--without-'):
                 label = arg[2:].lower().replace('-', '_')
                 self.macros.define(label)
         self._includes = []
         self.load_depth = 0
+        self.shell_scope = 'never'
 
     def __del__(self):
         pass
@@ -197,23 +206,104 @@ class file(object):
             print('-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=')
         return macros
 
+    def _shell_key(self, cmd):
+        if self.shell_scope == 'run':
+            return ('run', cmd)
+        if self.shell_scope == 'bsp':
+            if 'bsp' in self.macros:
+                return ('bsp', self.macros['bsp'], cmd)
+            return ('run', cmd)
+        return None
+
     def _shell(self, line):
         sl = self.sf.findall(line)
         if len(sl):
-            e = execute.capture_execution()
+            self._effects += 1
+            e = None
             for s in sl:
                 if options.host_windows:
                     cmd = '%s -c "%s"' % (self.macros.expand('%{__sh}'), s[2:-1])
                 else:
                     cmd = s[2:-1]
-                exit_code, proc, output = e.shell(cmd)
-                if exit_code == 0:
-                    line = line.replace(s, output)
-                else:
-                    raise error.general('shell macro failed: %s:%d: %s' % (s, exit_code, output))
+                key = self._shell_key(cmd)
+                output = None
+                if key is not None:
+                    output = cache.shells.get(key)
+                if output is None:
+                    if e is None:
+                        e = execute.capture_execution()
+                    exit_code, proc, output = e.shell(cmd)
+                    if exit_code != 0:
+                        raise error.general('shell macro failed: %s:%d: %s' % (s, exit_code, output))
+                    cache.shells.put(key, output)
+                line = line.replace(s, output)
         return line
 
+    def _memo_check(self):
+        #
+        # The macros have been changed other than by this file.
+        #
+        if self._memo_generation != self.macros.generation:
+            self._memo = {}
+            self._dependents = {}
+            self._memo_generation = self.macros.generation
+
+    def _invalidate(self, names):
+        for name in names:
+            key = self.macros.key_filter(name)
+            for k in self._dependents.pop(key, set()) | set([key]):
+                if k in self._memo:
+                    del self._memo[k]
+        self._memo_generation = self.macros.generation
+
+    def _depends(self, name):
+        if len(self._deps):
+            self._deps[-1].add(self.macros.key_filter(name))
+
+    def _value(self, name):
+        '''The expanded value of a macro or None if it is not defined. The
+        value is kept with the macros it depends on until one of them is
+        defined, undefined or a map with one is selected. A value is not kept
+        if expanding it ran a shell, showed a message or did not expand all of
+        its macros. A macro whose value refers back to itself is an error.'''
+        self._memo_check()
+        key = self.macros.key_filter(name)
+        if key in self._memo:
+            value, deps = self._memo[key]
+            if len(self._deps):
+                self._deps[-1].update(deps)
+            return value
+        if name not in self.macros:
+            return None
+        raw = self.macros[name]
+        if '%{echo' in raw:
+            self._depends(key)
+            return raw
+        if key in self._expanding:
+            raise error.general('macro expand looping: %s' % (name))
+        effects = self._effects
+        self._expanding.add(key)
+        self._deps.append(set([key]))
+        try:
+            value = self._expand_macros(raw)
+        finally:
+            deps = self._deps.pop()
+            self._expanding.discard(key)
+        if len(self._deps):
+            self._deps[-1].update(deps)
+        if effects == self._effects and \
+           len(self._macro_split(value)) == 0 and self.sf.search(value) is None:
+            self._memo[key] = (value, deps)
+            for d in deps:
+                if d not in self._dependents:
+                    self._dependents[d] = set()
+                self._dependents[d].add(key)
+        return value
+
     def _expand(self, s):
+        return self._shell(self._expand_macros(s))
+
+    def _expand_macros(self, s):
         expand_count = 0
         expanded = True
         while expanded:
@@ -255,6 +345,7 @@ class file(object):
                     # Change the ' ' to '_' because the macros have no spaces.
                     #
                     n = self._label('with_' + m[7:-1].strip())
+                    self._depends(n)
                     if n in self.macros:
                         s = s.replace(m, '1')
                     else:
@@ -267,12 +358,14 @@ class file(object):
                         mn = None
                     else:
                         e = self._expand(m[6:-1].strip())
+                        self._effects += 1
                         log.output('%s' % (self._name_line_msg(e)))
                         s = ''
                         expanded = True
                         mn = None
                 elif m.startswith('%{defined'):
                     n = self._label(m[9:-1].strip())
+                    self._depends(n)
                     if n in self.macros:
                         s = s.replace(m, '1')
                     else:
@@ -294,6 +387,7 @@ class file(object):
                     else:
                         mn = self._label(m[start:start + colon])
                     if mn:
+                        self._depends(mn)
                         if m.startswith('%{?'):
                             istrue = False
                             if mn in self.macros:
@@ -320,12 +414,15 @@ class file(object):
                             else:
                                 mn = '%{nil}'
                 if mn:
-                    if mn.lower() in self.macros:
-                        s = s.replace(m, self.macros[mn.lower()])
+                    self._depends(mn)
+                    value = self._value(mn.lower())
+                    if value is not None:
+                        s = s.replace(m, value)
                         expanded = True
                     elif show_warning:
+                        self._effects += 1
                         self._error("macro '%s' not found" % (mn))
-        return self._shell(s)
+        return s
 
     def _disable(self, config, ls):
         if len(ls) != 2:
@@ -337,11 +434,20 @@ class file(object):
             else:
                 log.warning('invalid disable statement: %s' % (ls[1]))
 
+    def _shell_cache(self, config, ls):
+        if len(ls) != 2 or ls[1] not in cache.shell_cache.scopes:
+            log.warning('invalid shell_cache statement')
+        else:
+            self.shell_scope = ls[1]
+            log.trace('config: %s: _shell_cache: %s' % (self.init_name, ls[1]))
+
     def _select(self, config, ls):
         if len(ls) != 2:
             log.warning('invalid select statement')
         else:
+            self._memo_check()
             r = self.macros.set_read_map(ls[1])
+            self._invalidate(self.macros.map_keys(ls[1]))
             log.trace('config: %s: _select: %s %s %r' % \
                           (self.init_name, r, ls[1], self.macros.maps()))
 
@@ -350,6 +456,7 @@ class file(object):
             log.warning('invalid macro definition')
         else:
             d = self._label(ls[1])
+            self._memo_check()
             if self.disable_macro_reassign:
                 if (d not in self.macros) or \
                         (d in self.macros and len(self.macros[d]) == 0):
@@ -364,14 +471,17 @@ class file(object):
                     self.macros[d] = '1'
                 else:
                     self.macros[d] = ' '.join([f.strip() for f in ls[2:]])
+            self._invalidate([d])
 
     def _undefine(self, config, ls):
         if len(ls) <= 1:
             log.warning('invalid macro definition')
         else:
             mn = self._label(ls[1])
+            self._memo_check()
             if mn in self.macros:
                 del self.macros[mn]
+                self._invalidate([mn])
             else:
                 log.warning("macro '%s' not defined" % (mn))
 
@@ -517,8 +627,9 @@ class file(object):
             isarch = not isarch
         return self._ifs(config, ls, '%ifarch', isarch, isvalid, dir, info)
 
-    def _parse(self, config, dir, info, roc = False, isvalid = True):
-        # roc = return on control
+    def _tokens(self, lines):
+        '''The line numbers and text of the lines of a config file that are
+        not empty once cleaned.'''
 
         def _clean(line):
             line = line[0:-1]
@@ -527,17 +638,26 @@ class file(object):
                 line = line[1:b]
             return line.strip()
 
+        tokens = []
+        lc = 0
+        for l in lines:
+            lc += 1
+            l = _clean(l)
+            if len(l):
+                tokens += [(lc, l)]
+        return tokens
+
+    def _parse(self, config, dir, info, roc = False, isvalid = True):
+        # roc = return on control
+
         #
         # Need to add code to count matching '{' and '}' and if they
         # do not match get the next line and add to the string until
         # they match. This closes an opening '{' that is on another
         # line.
         #
-        for l in config:
-            self.lc += 1
-            l = _clean(l)
-            if len(l) == 0:
-                continue
+        for lc, l in config:
+            self.lc = lc
             log.trace('config: %s: %03d: %s %s' % \
                           (self.init_name, self.lc, str(isvalid), l))
             lo = l
@@ -554,6 +674,9 @@ class file(object):
                 elif ls[0] == '%select':
                     if isvalid:
                         self._select(config, ls)
+                elif ls[0] == '%shell_cache':
+                    if isvalid:
+                        self._shell_cache(config, ls)
                 elif ls[0] == '%error':
                     if isvalid:
                         return ('data', ['%%error %s' % (self._name_line_msg(l[7:]))])
@@ -685,7 +808,7 @@ class file(object):
     def _info_append(self, info, data):
         pass
 
-    def load(self, name):
+    def _find(self, name):
 
         def common_end(left, right):
             end = ''
@@ -697,20 +820,6 @@ class file(object):
                 right = right[:-1]
             return end
 
-        if self.load_depth == 0:
-            self.in_error = False
-            self.lc = 0
-            self.name = name
-            self.conditionals = {}
-
-        self.load_depth += 1
-
-        save_name = self.name
-        save_lc = self.lc
-
-        self.name = name
-        self.lc = 0
-
         #
         # Locate the config file. Expand any macros then add the
         # extension. Check if the file exists, therefore directly
@@ -747,44 +856,96 @@ class file(object):
             if configname is None:
                 raise error.general('no config file found: %s' % (cfgname))
 
-        try:
-            log.trace('config: %s: _open: %s' % (self.init_name, path.host(configname)))
-            config = open(path.host(configname), 'r')
-        except IOError as err:
-            raise error.general('error opening config file: %s' % (path.host(configname)))
+        return configname
+
+    def files(self, name):
+        '''Return the paths of a config file and the files it includes. An
+        include inside a conditional is followed whether the condition holds
+        or not.'''
+        found = []
+        pending = [name]
+        while len(pending):
+            configname = self._find(pending.pop(0))
+            if configname in found:
+                continue
+            found += [configname]
+            try:
+                config = open(path.host(configname), 'r')
+                try:
+                    text = config.read()
+                finally:
+                    config.close()
+            except IOError as err:
+                raise error.general('error opening config file: %s' % (path.host(configname)))
+            for l in text.splitlines():
+                ls = l.split()
+                if len(ls) >= 2 and ls[0] == '%include':
+                    pending += [ls[1]]
+        return found
+
+    def load(self, name):
+
+        if self.load_depth == 0:
+            self.in_error = False
+            self.lc = 0
+            self.name = name
+            self.conditionals = {}
+            self.shell_scope = 'never'
+
+        self.load_depth += 1
+
+        #
+        # A shell cache scope set in an included file ends with the file.
+        #
+        save_name = self.name
+        save_lc = self.lc
+        save_shell_scope = self.shell_scope
+
+        self.name = name
+        self.lc = 0
+
+        configname = self._find(name)
+
+        tokens = cache.parsed.get('config', configname)
+        if tokens is None:
+            try:
+                log.trace('config: %s: _open: %s' % (self.init_name, path.host(configname)))
+                config = open(path.host(configname), 'r')
+                text = config.read()
+                config.close()
+            except IOError as err:
+                raise error.general('error opening config file: %s' % (path.host(configname)))
+            tokens = self._tokens(text.splitlines(True))
+            cache.parsed.put('config', configname, text, tokens)
+        config = iter(tokens)
         self.configpath += [configname]
 
         self._includes += [configname]
 
-        try:
-            dir = None
-            info = None
-            data = []
-            while True:
-                r = self._parse(config, dir, info)
-                if r[0] == 'control':
-                    if r[1] == '%end':
-                        break
-                    log.warning("unexpected '%s'" % (r[1]))
-                elif r[0] == 'directive':
-                    if r[1] == '%include':
-                        self.load(r[2][0])
-                        continue
-                    dir, info, data = self._process_directive(r, dir, info, data)
-                elif r[0] == 'data':
-                    dir, info, data = self._process_data(r, dir, info, data)
-                else:
-                    self._error("%d: invalid parse state: '%s" % (self.lc, r[0]))
-            if dir is not None:
-                self._directive_extend(dir, data)
-        except:
-            config.close()
-            raise
-
-        config.close()
+        dir = None
+        info = None
+        data = []
+        while True:
+            r = self._parse(config, dir, info)
+            if r[0] == 'control':
+                if r[1] == '%end':
+                    break
+                log.warning("unexpected '%s'" % (r[1]))
+            elif r[0] == 'directive':
+                if r[1] == '%include':
+                    self.load(r[2][0])
+                    continue
+                dir, info, data = self._process_directive(r, dir, info, data)
+            elif r[0] == 'data':
+                dir, info, data = self._process_data(r, dir, info, data)
+            else:
+                self._error("%d: invalid parse state: '%s" % (self.lc, r[0]))
+        if dir is not None:
+            self._directive_extend(dir, data)
 
         self.name = save_name
         self.lc = save_lc
+        self.shell_scope = save_shell_scope
 
         self.load_depth -= 1
 
@@ -803,7 +964,9 @@ class file(object):
         return self._expand(d)
 
     def set_define(self, name, value):
+        self._memo_check()
         self.macros[name] = value
+        self._invalidate([name])
 
     def expand(self, line):
         if type(line) == list:
@@ -853,5 +1016,30 @@ def run():
         sys.exit(1)
     sys.exit(0)
 
+def _check_looping():
+    '''Macros that refer to each other are an error and not a recursion that
+    never ends.'''
+    class _opts(object):
+        def __init__(self):
+            self.args = []
+            self.defaults = macros.macros()
+    opts = _opts()
+    opts.defaults['p'] = '%{q}'
+    opts.defaults['q'] = '%{p}'
+    opts.defaults['r'] = '%{p}'
+    cfg = file('looping', opts)
+    try:
+        cfg.expand('%{r}')
+        print('error: looping macros expanded')
+        sys.exit(1)
+    except error.general as gerr:
+        if 'macro expand looping' not in str(gerr):
+            print('error: looping macros: %s' % (gerr))
+            sys.exit(1)
+        print('config: looping macros: %s' % (str(gerr).strip()))
+
 if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        _check_looping()
+        sys.exit(0)
     run()
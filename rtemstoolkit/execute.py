@@ -34,13 +34,30 @@
 # Note, the subprocess module is only in Python 2.4 or higher.
 #
 
+import errno
+import heapq
 import os
 import re
+import select
 import sys
 import subprocess
 import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+#
+# The asyncio backend needs Python 3.4 or higher.
+#
+try:
+    import asyncio
+    import codecs
+except ImportError:
+    asyncio = None
+
 from . import error
 from . import log
 
@@ -50,6 +67,15 @@ trace_threads = False
 # Redefine the PIPE from subprocess
 PIPE = subprocess.PIPE
 
+# Read the output pipes with the reactor. Windows cannot poll pipes.
+use_reactor = os.name != 'nt'
+
+# The size of a read from an output pipe.
+read_size = 65536
+
+# The lines a stream holds before its readers wait for them to be taken.
+stream_lines = 1000
+
 # Regular expression to find quotes.
 qstr = re.compile('[rR]?\'([^\\n\'\\\\]|\\\\.)*\'|[rR]?"([^\\n"\\\\]|\\\\.)*"')
 
@@ -98,10 +124,341 @@ def arg_subst_str(command, subst):
     def add(x, y): return x + ' ' + str(y)
     return reduce(add, cmd, '')
 
+def _output_line(line, out, count):
+    if out:
+        out(line)
+    else:
+        log.output(line)
+        if count > 10:
+            log.flush()
+
+class reactor(object):
+    """A thread that reads the output pipes of all the processes being
+    captured. The data is read in blocks, split into lines and each line is
+    passed to the stream's output handler. Registering and removing streams
+    is handled by the reactor's thread.
+
+    The output handlers are called on the reactor's thread and must not
+    block. A handler that waits holds up the output and the idle timers of
+    every process being captured. An output handler that can wait is given
+    its own reader threads, as stream() does."""
+
+    class stream(object):
+        def __init__(self, fh, out, prefix, activity):
+            self.fh = fh
+            self.fd = fh.fileno()
+            self.out = out
+            self.prefix = prefix
+            self.activity = activity
+            self.line = ''
+            self.count = 0
+            self.done = threading.Event()
+
+        def data(self, data):
+            if self.activity is not None:
+                self.activity()
+            lines = (self.line + data).split('\n')
+            self.line = lines[-1]
+            for l in lines[:-1]:
+                self.count += 1
+                _output_line(self.prefix + l + '\n', self.out, self.count)
+                if self.count > 10:
+                    self.count = 0
+
+        def close(self):
+            try:
+                self.fh.close()
+            except:
+                pass
+            if len(self.line):
+                _output_line(self.prefix + self.line, self.out, 100)
+                self.line = ''
+            self.done.set()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.streams = {}
+        self.pending = []
+        self.wake_r = None
+        self.wake_w = None
+
+    def _start(self):
+        #
+        # A forked child does not have the parent's thread.
+        #
+        if self.thread is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.streams = {}
+            self.wake_r, self.wake_w = os.pipe()
+            self.thread = threading.Thread(target = self._run,
+                                           name = '_reactor')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, b'\0')
+        except OSError:
+            pass
+
+    def register(self, fh, out, prefix = '', activity = None):
+        s = reactor.stream(fh, out, prefix, activity)
+        self.lock.acquire()
+        try:
+            self._start()
+            self.pending += [('add', s)]
+            self._wake()
+        finally:
+            self.lock.release()
+        return s
+
+    def wait(self, s, timeout):
+        """Wait for the stream to close. The stream is removed if it has not
+        closed in the timeout."""
+        s.done.wait(timeout)
+        if not s.done.is_set():
+            self.lock.acquire()
+            try:
+                self.pending += [('remove', s)]
+                self._wake()
+            finally:
+                self.lock.release()
+
+    def _update(self, poller):
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = []
+        finally:
+            self.lock.release()
+        for op, s in pending:
+            if op == 'add':
+                self.streams[s.fd] = s
+                if poller is not None:
+                    poller.register(s.fd, select.POLLIN)
+            elif s.fd in self.streams and self.streams[s.fd] is s:
+                del self.streams[s.fd]
+                if poller is not None:
+                    poller.unregister(s.fd)
+                s.close()
+
+    def _ready(self, poller):
+        try:
+            if poller is not None:
+                return [fd for fd, event in poller.poll()]
+            r, w, x = select.select([self.wake_r] + self.streams.keys(), [], [])
+            return r
+        except (select.error, IOError, OSError) as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _run(self):
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(self.wake_r, select.POLLIN)
+        else:
+            poller = None
+        while True:
+            self._update(poller)
+            for fd in self._ready(poller):
+                if fd == self.wake_r:
+                    os.read(self.wake_r, read_size)
+                    continue
+                if fd not in self.streams:
+                    continue
+                s = self.streams[fd]
+                try:
+                    data = os.read(fd, read_size)
+                except OSError as ose:
+                    if ose.errno in [errno.EINTR, errno.EAGAIN]:
+                        continue
+                    data = ''
+                if len(data):
+                    try:
+                        s.data(data)
+                    except:
+                        log.stderr('execute: reactor: output handler: %s' % \
+                                   (str(sys.exc_info()[1])))
+                else:
+                    del self.streams[fd]
+                    if poller is not None:
+                        poller.unregister(fd)
+                    try:
+                        s.close()
+                    except:
+                        log.stderr('execute: reactor: output handler: %s' % \
+                                   (str(sys.exc_info()[1])))
+
+#
+# The reactor that reads the output of the processes of this process.
+#
+pipes = reactor()
+
+class timer_service(object):
+    """A thread that times out the processes of this process. A timer has an
+    absolute deadline, a no output (idle) timeout or both. The timers are held
+    in a heap ordered by the time they are due. Touching a timer restarts its
+    idle timeout and the timer is moved when it reaches the top of the heap so
+    touching is cheap. The function of a timer is called in the service's
+    thread when a timer fires."""
+
+    class timer(object):
+        def __init__(self, function, deadline, idle):
+            self.function = function
+            self.deadline = deadline
+            self.idle = idle
+            self.last = time.time()
+            self.cancelled = False
+            self.fired = None
+
+        def touch(self):
+            self.last = time.time()
+
+        def due(self):
+            due = None
+            kind = None
+            if self.deadline is not None:
+                due = self.deadline
+                kind = 'deadline'
+            if self.idle:
+                idle_due = self.last + self.idle
+                if due is None or idle_due < due:
+                    due = idle_due
+                    kind = 'idle'
+            return due, kind
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.heap = []
+        self.seq = 0
+        self.fired = { 'deadline': 0, 'idle': 0 }
+        self.wake_r = None
+        self.wake_w = None
+        self.woken = None
+
+    def _start(self):
+        #
+        # A forked child does not have the parent's thread.
+        #
+        if self.thread is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.heap = []
+            if os.name != 'nt':
+                self.wake_r, self.wake_w = os.pipe()
+            else:
+                self.woken = threading.Event()
+            self.thread = threading.Thread(target = self._run,
+                                           name = '_timers')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _wake(self):
+        if self.woken is not None:
+            self.woken.set()
+        else:
+            try:
+                os.write(self.wake_w, b'\0')
+            except OSError:
+                pass
+
+    def _sleep(self, timeout):
+        #
+        # Python 2's threading waits poll in steps of up to 50 msecs so block
+        # in select when we can.
+        #
+        if self.woken is not None:
+            self.woken.wait(timeout)
+            self.woken.clear()
+            return
+        try:
+            r, w, x = select.select([self.wake_r], [], [], timeout)
+            if len(r):
+                os.read(self.wake_r, read_size)
+        except (select.error, IOError, OSError) as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+    def _push(self, t):
+        due, kind = t.due()
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, t))
+        return due
+
+    def add(self, function, deadline = None, idle = None):
+        """Add a timer. The deadline is an absolute time and the idle is the
+        seconds without a touch before the timer fires."""
+        if deadline is None and not idle:
+            raise error.internal('timer has no deadline or idle timeout')
+        t = timer_service.timer(function, deadline, idle)
+        self.lock.acquire()
+        try:
+            self._start()
+            if self._push(t) <= self.heap[0][0]:
+                self._wake()
+        finally:
+            self.lock.release()
+        return t
+
+    def cancel(self, t):
+        """Cancel a timer. The heap entry is dropped when it is due."""
+        t.cancelled = True
+
+    def timeouts(self):
+        return self.fired['deadline'] + self.fired['idle']
+
+    def _expired(self):
+        fire = []
+        timeout = None
+        self.lock.acquire()
+        try:
+            now = time.time()
+            while len(self.heap):
+                due, seq, t = self.heap[0]
+                if t.cancelled:
+                    heapq.heappop(self.heap)
+                    continue
+                if due > now:
+                    timeout = due - now
+                    break
+                heapq.heappop(self.heap)
+                due, kind = t.due()
+                if due > now:
+                    self._push(t)
+                    continue
+                t.fired = kind
+                self.fired[kind] += 1
+                fire += [t]
+        finally:
+            self.lock.release()
+        return fire, timeout
+
+    def _run(self):
+        while True:
+            fire, timeout = self._expired()
+            for t in fire:
+                try:
+                    t.function()
+                except:
+                    log.stderr('execute: timers: timeout handler: %s' % \
+                               (str(sys.exc_info()[1])))
+            if len(fire) == 0:
+                self._sleep(timeout)
+
+#
+# The timers of the processes of this process.
+#
+timers = timer_service()
+
 class execute(object):
     """Execute commands or scripts. The 'output' is a funtion that handles the
-    output from the process. The 'input' is a function that blocks and returns
-    data to be written to stdin"""
+    output from the process. It is called on the reactor's thread and must not
+    block. The 'input' is a function that blocks and returns data to be
+    written to stdin"""
     def __init__(self, output = None, input = None, cleanup = None,
                  error_prefix = '', verbose = False):
         self.lock = threading.Lock()
@@ -114,14 +471,18 @@ class execute(object):
         self.shell_commands = False
         self.path = None
         self.environment = None
-        self.outputting = False
-        self.timing_out = False
         self.proc = None
+        self.spawn_time = None
+        self.exit_time = None
+        self.exit_code = None
 
-    def _capture(self, command, proc, timeout = None):
-        """Create 3 threads to read stdout and stderr and send to the output handler
-        and call an input handler is provided. Based on the 'communicate' code
-        in the subprocess module."""
+    def _capture(self, command, proc, timeout = None, output = None,
+                 reactor = None):
+        """Read stdout and stderr and send to the output handler and call an
+        input handler is provided. The output is read by the reactor or, if it
+        is not used, by a thread for each pipe. An output handler that can
+        block needs the threads. Based on the 'communicate' code in the
+        subprocess module."""
         def _writethread(exe, fh, input):
             """Call the input handler and write it to the stdin. The input handler should
             block and return None or False if this thread is to exit and True if this
@@ -151,21 +512,9 @@ class execute(object):
             if trace_threads:
                 print('executte:_writethread: finished')
 
-        def _readthread(exe, fh, out, prefix = ''):
+        def _readthread(exe, fh, out, prefix = '', activity = None):
             """Read from a file handle and write to the output handler
             until the file closes."""
-            def _output_line(line, exe, prefix, out, count):
-                #print 'LINE:%d: %s' % (count, line)
-                exe.lock.acquire()
-                #exe.outputting = True
-                exe.lock.release()
-                if out:
-                    out(prefix + line)
-                else:
-                    log.output(prefix + line)
-                    if count > 10:
-                        log.flush()
-
             if trace_threads:
                 print('executte:_readthread: start')
             count = 0
@@ -175,12 +524,14 @@ class execute(object):
                     data = fh.read(1)
                     if len(data) == 0:
                         break
+                    if activity is not None:
+                        activity()
                     #print '))))) %02x "%s"' % (ord(data), data)
                     for c in data:
                         line += c
                         if c == '\n':
                             count += 1
-                            _output_line(line, exe, prefix, out, count)
+                            _output_line(prefix + line, out, count)
                             if count > 10:
                                 count = 0
                             line = ''
@@ -194,55 +545,72 @@ class execute(object):
             except:
                 pass
             if len(line):
-                _output_line(line, exe, prefix, out, 100)
+                _output_line(prefix + line, out, 100)
             if trace_threads:
                 print('executte:_readthread: finished')
 
-        def _timerthread(exe, interval, function):
-            """Timer thread is used to timeout a process if no output is
-            produced for the timeout interval."""
-            count = interval
-            while exe.timing_out:
-                time.sleep(1)
-                if count > 0:
-                    count -= 1
-                exe.lock.acquire()
-                if exe.outputting:
-                    count = interval
-                    exe.outputting = False
-                exe.lock.release()
-                if count == 0:
-                    try:
-                        proc.kill()
-                    except:
-                        pass
-                    else:
-                        function()
-                    break
+        if output is None:
+            output = self.output
+        if reactor is None:
+            reactor = use_reactor
 
         name = os.path.basename(command[0])
 
         stdin_thread = None
         stdout_thread = None
         stderr_thread = None
-        timeout_thread = None
+        streams = []
+        timer = None
+        activity = None
 
-        if proc.stdout:
+        if timeout:
+            #
+            # The timeout is the seconds to the deadline and the function to
+            # call if the process is killed. An optional third item is the
+            # seconds the process can run without any output.
+            #
+            def _timedout(function = timeout[1]):
+                try:
+                    proc.kill()
+                except:
+                    pass
+                else:
+                    function()
+            deadline = None
+            idle = None
+            if timeout[0]:
+                deadline = time.time() + timeout[0]
+            if len(timeout) > 2:
+                idle = timeout[2]
+            timer = timers.add(_timedout, deadline, idle)
+            if idle:
+                activity = timer.touch
+
+        if reactor:
+            if proc.stdout:
+                streams += [pipes.register(proc.stdout, output,
+                                           activity = activity)]
+            if proc.stderr:
+                streams += [pipes.register(proc.stderr, output,
+                                           self.error_prefix, activity)]
+        elif proc.stdout:
             stdout_thread = threading.Thread(target = _readthread,
                                              name = '_stdout[%s]' % (name),
                                              args = (self,
                                                      proc.stdout,
-                                                     self.output,
-                                                     ''))
+                                                     output,
+                                                     '',
+                                                     activity))
             stdout_thread.daemon = True
             stdout_thread.start()
-        if proc.stderr:
+        if proc.stderr and not reactor:
             stderr_thread = threading.Thread(target = _readthread,
                                              name = '_stderr[%s]' % (name),
                                              args = (self,
                                                      proc.stderr,
-                                                     self.output,
-                                                     self.error_prefix))
+                                                     output,
+                                                     self.error_prefix,
+                                                     activity))
             stderr_thread.daemon = True
             stderr_thread.start()
         if self.input and proc.stdin:
@@ -253,15 +621,6 @@ class execute(object):
                                                     self.input))
             stdin_thread.daemon = True
             stdin_thread.start()
-        if timeout:
-            self.timing_out = True
-            timeout_thread = threading.Thread(target = _timerthread,
-                                              name = '_timeout[%s]' % (name),
-                                              args = (self,
-                                                      timeout[0],
-                                                      timeout[1]))
-            timeout_thread.daemon = True
-            timeout_thread.start()
         try:
             self.lock.acquire()
             try:
@@ -271,6 +630,7 @@ class execute(object):
             finally:
                 self.lock.release()
             exitcode = proc.wait()
+            self.exit_time = time.time()
         except:
             proc.kill()
             raise
@@ -284,23 +644,21 @@ class execute(object):
                 self.lock.release()
             if self.cleanup:
                 self.cleanup(proc)
-            if timeout_thread:
-                self.timing_out = False
-                timeout_thread.join(10)
+            if timer:
+                timers.cancel(timer)
             if stdin_thread:
                 stdin_thread.join(2)
             if stdout_thread:
                 stdout_thread.join(2)
             if stderr_thread:
                 stderr_thread.join(2)
+            for s in streams:
+                pipes.wait(s, 2)
         return exitcode
 
-    def open(self, command, capture = True, shell = False,
-             cwd = None, env = None,
-             stdin = None, stdout = None, stderr = None,
-             timeout = None):
-        """Open a command with arguments. Provide the arguments as a list or
-        a string."""
+    def _popen(self, command, shell, cwd, env, stdin, stdout, stderr):
+        """Create the process for a command. The command is returned as it
+        is run with the process."""
         if self.verbose:
             s = command
             if type(command) is list:
@@ -319,25 +677,36 @@ class execute(object):
             stdout = subprocess.PIPE
         if not stderr:
             stderr = subprocess.PIPE
-        proc = None
         if cwd is None:
             cwd = self.path
         if env is None:
             env = self.environment
+        # Work around a problem on Windows with commands that
+        # have a '.' and no extension. Windows needs the full
+        # command name.
+        if sys.platform == "win32" and type(command) is list:
+            if command[0].find('.') >= 0:
+                r, e = os.path.splitext(command[0])
+                if e not in ['.exe', '.com', '.bat']:
+                    command[0] = command[0] + '.exe'
+        log.trace('exe: %s' % (command))
+        proc = subprocess.Popen(command, shell = shell,
+                                cwd = cwd, env = env,
+                                stdin = stdin, stdout = stdout,
+                                stderr = stderr)
+        self.spawn_time = time.time()
+        return command, proc
+
+    def open(self, command, capture = True, shell = False,
+             cwd = None, env = None,
+             stdin = None, stdout = None, stderr = None,
+             timeout = None):
+        """Open a command with arguments. Provide the arguments as a list or
+        a string."""
+        proc = None
         try:
-            # Work around a problem on Windows with commands that
-            # have a '.' and no extension. Windows needs the full
-            # command name.
-            if sys.platform == "win32" and type(command) is list:
-                if command[0].find('.') >= 0:
-                    r, e = os.path.splitext(command[0])
-                    if e not in ['.exe', '.com', '.bat']:
-                        command[0] = command[0] + '.exe'
-            log.trace('exe: %s' % (command))
-            proc = subprocess.Popen(command, shell = shell,
-                                    cwd = cwd, env = env,
-                                    stdin = stdin, stdout = stdout,
-                                    stderr = stderr)
+            command, proc = self._popen(command, shell, cwd, env,
+                                        stdin, stdout, stderr)
             if not capture:
                 return (0, proc)
             if self.output is None:
@@ -351,6 +720,67 @@ class execute(object):
                 log.output('exit: ' + str(ose))
         return (exit_code, proc)
 
+    def stream(self, command, shell = False, cwd = None, env = None,
+               timeout = None):
+        """Run a command and return a generator of the lines of its output as
+        they arrive. The lines do not have the line ending. Closing the
+        generator before the output ends kills the process. The exit code is
+        in exit_code when the output has ended. The output is read by threads
+        that wait when stream_lines lines have not been taken so a slow
+        reader holds the process's output in its pipes."""
+        self.exit_code = None
+        try:
+            command, proc = self._popen(command, shell, cwd, env,
+                                        None, None, None)
+        except OSError as ose:
+            self.exit_code = ose.errno
+            if self.verbose:
+                log.output('exit: ' + str(ose))
+            return
+        lines = queue.Queue(maxsize = stream_lines)
+        closed = threading.Event()
+        def _put(line):
+            #
+            # Once the generator is closed the lines are dropped so a reader
+            # does not wait for ever.
+            #
+            while not closed.is_set():
+                try:
+                    lines.put(line, timeout = 0.5)
+                    return
+                except queue.Full:
+                    pass
+        def _run():
+            try:
+                self.exit_code = self._capture(command, proc, timeout,
+                                               output = _put, reactor = False)
+            finally:
+                _put(None)
+        runner = threading.Thread(target = _run,
+                                  name = '_stream[%s]' % (os.path.basename(command[0])))
+        runner.daemon = True
+        runner.start()
+        ended = False
+        try:
+            while True:
+                line = lines.get()
+                if line is None:
+                    ended = True
+                    break
+                if line[-1:] == '\n':
+                    line = line[:-1]
+                yield line
+        finally:
+            if not ended:
+                closed.set()
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            runner.join()
+        if self.verbose:
+            log.output('exit: ' + str(self.exit_code))
+
     def spawn(self, command, capture = True, cwd = None, env = None,
               stdin = None, stdout = None, stderr = None,
               timeout = None):
@@ -465,7 +895,7 @@ class capture_execution(execute):
 
     class _output_snapper:
         def __init__(self, log = None, dump = False):
-            self.output = ''
+            self.output = []
             self.log = log
             self.dump = dump
 
@@ -474,11 +904,11 @@ class capture_execution(execute):
                 if self.log is not None:
                     self.log.output(text)
                 else:
-                    self.output += text
+                    self.output.append(text)
 
         def get_and_clear(self):
-            text = self.output
-            self.output = ''
+            text = ''.join(self.output)
+            self.output = []
             return text.strip()
 
     def __init__(self, log = None, dump = False, error_prefix = '', verbose = False):
@@ -501,7 +931,517 @@ class capture_execution(execute):
     def set_output(self, output):
         raise error.general('output capture cannot be overrided')
 
+class _async_protocol(object):
+    """The asyncio subprocess protocol of an async_execute process."""
+
+    def __init__(self, exe, done, capture):
+        self.exe = exe
+        self.done = done
+        self.capture = capture
+        self.transport = None
+        self.lines = { 1: '', 2: '' }
+        self.counts = { 1: 0, 2: 0 }
+        self.decoders = {}
+        self.timer = None
+        self.idle = None
+        self.idle_timer = None
+        self.active = None
+        self.grace = None
+
+    def _cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def _finish(self, exit_code):
+        self._cancel()
+        if self.grace is not None:
+            self.grace.cancel()
+            self.grace = None
+        for fd in [1, 2]:
+            if len(self.lines[fd]):
+                self._output(fd, self.lines[fd], 100)
+                self.lines[fd] = ''
+        self.exe._exited(self.transport)
+        if not self.done.done():
+            self.done.set_result((exit_code, self.transport))
+
+    def _output(self, fd, line, count):
+        if fd == 2:
+            line = self.exe.error_prefix + line
+        _output_line(line, self.exe.output, count)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.capture and not self.done.done():
+            self.done.set_result((0, transport))
+
+    def pipe_data_received(self, fd, data):
+        if self.idle is not None:
+            self.active = self.exe.loop.time()
+        if type(data) is not str:
+            if fd not in self.decoders:
+                self.decoders[fd] = \
+                    codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+            data = self.decoders[fd].decode(data)
+        lines = (self.lines[fd] + data).split('\n')
+        self.lines[fd] = lines[-1]
+        for l in lines[:-1]:
+            self.counts[fd] += 1
+            self._output(fd, l + '\n', self.counts[fd])
+            if self.counts[fd] > 10:
+                self.counts[fd] = 0
+
+    def pipe_connection_lost(self, fd, exc):
+        pass
+
+    def process_exited(self):
+        self.exe.exit_time = time.time()
+        #
+        # Wait for the output pipes to close for as long as the threads are
+        # waited for.
+        #
+        self.grace = self.exe.loop.call_later(2, self._grace_end)
+
+    def _grace_end(self):
+        self.grace = None
+        self._finish(self.transport.get_returncode())
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        self._finish(self.transport.get_returncode())
+
+class async_execute(object):
+    """Execute commands or scripts on an asyncio event loop. The interface is
+    the same as the execute class except the open, spawn, shell, command and
+    command_subst calls return a future of the (exit code, transport) the
+    execute class returns. The calls do not block so one thread can run many
+    processes. The output handler is called on the loop. The input handler is
+    called on the loop and must not block, it returns data to write to stdin,
+    None or False to close stdin, True to be called again later or a future of
+    one of these."""
+
+    input_poll = 0.1
+
+    def __init__(self, output = None, input = None, cleanup = None,
+                 error_prefix = '', verbose = False, loop = None):
+        if asyncio is None:
+            raise error.general('asyncio is not available')
+        self.output = output
+        self.input = input
+        self.cleanup = cleanup
+        self.error_prefix = error_prefix
+        self.verbose = verbose
+        self.loop = loop
+        self.shell_exe = None
+        self.shell_commands = False
+        self.path = None
+        self.environment = None
+        self.proc = None
+        self.spawn_time = None
+        self.exit_time = None
+
+    def _loop(self):
+        if self.loop is None:
+            return asyncio.get_event_loop()
+        return self.loop
+
+    def _exited(self, transport):
+        if self.proc is transport:
+            self.proc = None
+            if self.cleanup:
+                self.cleanup(transport)
+
+    def _input(self, transport):
+        stdin = transport.get_pipe_transport(0)
+        if stdin is None or stdin.is_closing():
+            return
+        def _result(lines):
+            if asyncio.isfuture(lines):
+                lines.add_done_callback(lambda f: _result(f.result()))
+            elif lines is None or lines is False:
+                stdin.close()
+            elif lines is True:
+                self.loop.call_later(self.input_poll, self._input, transport)
+            else:
+                if type(lines) is str:
+                    lines = lines.encode('utf-8')
+                stdin.write(lines)
+                self.loop.call_soon(self._input, transport)
+        try:
+            _result(self.input())
+        except:
+            stdin.close()
+
+    def _timeout(self, transport, protocol, function):
+        protocol._cancel()
+        if transport.get_returncode() is None:
+            try:
+                transport.kill()
+            except:
+                pass
+            else:
+                function()
+
+    def _idle(self, transport, protocol, function):
+        protocol.idle_timer = None
+        due = protocol.active + protocol.idle
+        now = self.loop.time()
+        if now < due:
+            protocol.idle_timer = self.loop.call_later(due - now, self._idle,
+                                                       transport, protocol,
+                                                       function)
+        else:
+            self._timeout(transport, protocol, function)
+
+    def _spawned(self, spawn, protocol, timeout):
+        exc = spawn.exception()
+        if exc is not None:
+            if isinstance(exc, OSError):
+                if self.verbose:
+                    log.output('exit: ' + str(exc))
+                protocol.done.set_result((exc.errno, None))
+            else:
+                protocol.done.set_exception(exc)
+            return
+        transport, protocol = spawn.result()
+        self.spawn_time = time.time()
+        self.proc = transport
+        if self.input and transport.get_pipe_transport(0) is not None:
+            self._input(transport)
+        if timeout:
+            #
+            # The deadline and the idle timeout are the same as the execute
+            # class's. The idle timer is moved on when it fires if there has
+            # been output since it was set.
+            #
+            if timeout[0]:
+                protocol.timer = self.loop.call_later(timeout[0], self._timeout,
+                                                      transport, protocol,
+                                                      timeout[1])
+            if len(timeout) > 2 and timeout[2]:
+                protocol.idle = timeout[2]
+                protocol.active = self.loop.time()
+                protocol.idle_timer = self.loop.call_later(timeout[2], self._idle,
+                                                           transport, protocol,
+                                                           timeout[1])
+
+    def open(self, command, capture = True, shell = False,
+             cwd = None, env = None,
+             stdin = None, stdout = None, stderr = None,
+             timeout = None):
+        """Open a command with arguments. Provide the arguments as a list or
+        a string. Returns a future of the exit code and the process's
+        transport."""
+        self.loop = self._loop()
+        if self.verbose:
+            s = command
+            if type(command) is list:
+                s = ' '.join([str(c) for c in command])
+            what = 'spawn'
+            if shell:
+                what = 'shell'
+            log.output(what + ': ' + s)
+        if shell and self.shell_exe:
+            command = self.shell_exe + arg_list(command)
+            shell = False
+        if not stdin and self.input:
+            stdin = subprocess.PIPE
+        if not stdout:
+            stdout = subprocess.PIPE
+        if not stderr:
+            stderr = subprocess.PIPE
+        if cwd is None:
+            cwd = self.path
+        if env is None:
+            env = self.environment
+        if capture and self.output is None:
+            raise error.general('capture needs an output handler')
+        done = self.loop.create_future()
+        protocol = _async_protocol(self, done, capture)
+        log.trace('exe: %s' % (command))
+        if shell:
+            if type(command) is list:
+                command = ' '.join(command)
+            spawn = self.loop.subprocess_shell(lambda: protocol, command,
+                                               cwd = cwd, env = env,
+                                               stdin = stdin, stdout = stdout,
+                                               stderr = stderr)
+        else:
+            spawn = self.loop.subprocess_exec(lambda: protocol,
+                                              *arg_list(command),
+                                              cwd = cwd, env = env,
+                                              stdin = stdin, stdout = stdout,
+                                              stderr = stderr)
+        spawn = asyncio.ensure_future(spawn, loop = self.loop)
+        spawn.add_done_callback(lambda f: self._spawned(f, protocol, timeout))
+        return done
+
+    def spawn(self, command, capture = True, cwd = None, env = None,
+              stdin = None, stdout = None, stderr = None,
+              timeout = None):
+        """Spawn a command with arguments."""
+        return self.open(command, capture, False, cwd, env,
+                         stdin, stdout, stderr, timeout)
+
+    def shell(self, command, capture = True, cwd = None, env = None,
+              stdin = None, stdout = None, stderr = None,
+              timeout = None):
+        """Execute a command within a shell context."""
+        return self.open(command, capture, True, cwd, env,
+                         stdin, stdout, stderr, timeout)
+
+    def command(self, command, args = None, capture = True, shell = False,
+                cwd = None, env = None,
+                stdin = None, stdout = None, stderr = None,
+                timeout = None):
+        """Run the command with the args. The args can be a list
+        or a string."""
+        if args and not type(args) is list:
+            args = arg_list(args)
+        cmd = [command]
+        if args:
+            cmd.extend(args)
+        return self.open(cmd, capture = capture, shell = shell,
+                         cwd = cwd, env = env,
+                         stdin = stdin, stdout = stdout, stderr = stderr,
+                         timeout = timeout)
+
+    def command_subst(self, command, substs, capture = True, shell = False,
+                      cwd = None, env = None,
+                      stdin = None, stdout = None, stderr = None,
+                      timeout = None):
+        """Run the command from the config data with the
+        option format string subsituted with the subst variables."""
+        args = arg_subst(command, substs)
+        return self.command(args[0], args[1:], capture = capture,
+                            shell = shell or self.shell_commands,
+                            cwd = cwd, env = env,
+                            stdin = stdin, stdout = stdout, stderr = stderr,
+                            timeout = timeout)
+
+    def set_shell(self, execute):
+        """Set the shell to execute when issuing a shell command."""
+        args = arg_list(execute)
+        if len(args) == 0 or not os.path.isfile(args[0]):
+            raise error.general('could find shell: ' + execute)
+        self.shell_exe = args
+
+    def command_use_shell(self):
+        """Force all commands to use a shell."""
+        self.shell_commands = True
+
+    def set_output(self, output):
+        old_output = self.output
+        self.output = output
+        return old_output
+
+    def set_path(self, path):
+        old_path = self.path
+        self.path = path
+        return old_path
+
+    def set_environ(self, environment):
+        old_environment = self.environment
+        self.environment = environment
+        return old_environment
+
+    def kill(self):
+        if self.proc is not None:
+            self.proc.kill()
+
+    def terminate(self):
+        if self.proc is not None:
+            self.proc.terminate()
+
+    def send_signal(self, signal):
+        if self.proc is not None:
+            self.proc.send_signal(signal)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        #
+        # Pipe output through a capture with the reading threads and with
+        # the reactor.
+        #
+        if len(sys.argv) > 2:
+            megabytes = int(sys.argv[2])
+        else:
+            megabytes = 64
+        line = 'RTEMS test output, a line of about sixty characters long'
+        cmd = "yes '%s' | head -c %d" % (line, megabytes * 1024 * 1024)
+        for use_reactor in [False, True]:
+            e = capture_execution()
+            start = time.time()
+            ec, proc, output = e.shell(cmd)
+            period = time.time() - start
+            if ec != 0 or len(output) < megabytes * 1024 * 1024 - 100:
+                print('error: benchmark output: %d bytes' % (len(output)))
+                sys.exit(1)
+            if use_reactor:
+                what = 'reactor'
+            else:
+                what = 'threads'
+            print('%s: %d MB in %.2f s, %.1f MB/s' % \
+                  (what, megabytes, period, megabytes / period))
+            del e
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'async':
+        #
+        # Run processes at once from one thread with the asyncio backend. The
+        # last processes are timed out at a deadline and when they stop
+        # printing, a process that keeps printing is not.
+        #
+        if asyncio is None:
+            print('error: asyncio is not available')
+            sys.exit(1)
+        if len(sys.argv) > 2:
+            count = int(sys.argv[2])
+        else:
+            count = 200
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        output = []
+        timeouts = []
+        futures = []
+        for p in range(0, count):
+            e = async_execute(output = output.append, loop = loop)
+            futures += [e.shell('echo start %d; sleep 1; echo end %d' % (p, p))]
+        e = async_execute(output = output.append, loop = loop)
+        futures += [e.shell('for i in 1 2 3 4 5 6; do echo $i; sleep 0.5; done',
+                            timeout = (None, lambda: timeouts.append('chatter'), 1))]
+        e = async_execute(output = output.append, loop = loop)
+        futures += [e.shell('echo start; exec sleep 30',
+                            timeout = (None, lambda: timeouts.append('idle'), 1))]
+        e = async_execute(output = output.append, loop = loop)
+        futures += [e.shell('echo start; sleep 30; echo end',
+                            timeout = (2, lambda: timeouts.append('deadline')))]
+        start = time.time()
+        results = loop.run_until_complete(asyncio.gather(*futures))
+        period = time.time() - start
+        exit_codes = [r[0] for r in results]
+        print('async: %d processes in %.2f s, %d thread(s), %d lines' % \
+              (count, period, threading.active_count(), len(output)))
+        print('async: exit codes: %d zero, timeouts: %s, timed out exit code: %d' % \
+              (exit_codes[:-2].count(0), ' '.join(sorted(timeouts)), exit_codes[-1]))
+        if exit_codes[:-2].count(0) != count + 1 or \
+           len(output) != count * 2 + 6 + 2 or \
+           sorted(timeouts) != ['deadline', 'idle'] or period > 10:
+            print('error: async run failed')
+            sys.exit(1)
+        loop.close()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'stream':
+        #
+        # Stream the lines of a command then stop a command that does not
+        # end at the first line that matches.
+        #
+        e = execute()
+        lines = [l for l in e.stream('echo one; echo two >&2; printf three',
+                                     shell = True)]
+        print('stream: lines: %r, exit code: %d' % (lines, e.exit_code))
+        if sorted(lines) != ['one', 'three', 'two'] or e.exit_code != 0:
+            print('error: stream failed')
+            sys.exit(1)
+        start = time.time()
+        found = None
+        lines = e.stream('i=0; while true; do i=$((i+1)); echo line $i; done',
+                         shell = True)
+        for l in lines:
+            if l == 'line 1000':
+                found = l
+                break
+        lines.close()
+        period = time.time() - start
+        print('stream: found: %s in %.2f s, exit code: %d' % \
+              (found, period, e.exit_code))
+        if found is None or e.exit_code >= 0 or period > 5:
+            print('error: stream failed')
+            sys.exit(1)
+        #
+        # A reader that stops taking lines holds the command at the lines the
+        # stream and its pipe hold. Closing the stream with them full ends
+        # it.
+        #
+        import tempfile
+        fd, count_file = tempfile.mkstemp(prefix = 'rtems-execute-')
+        os.close(fd)
+        try:
+            lines = e.stream('i=0; while true; do i=$((i+1)); echo line $i; ' \
+                             'echo $i > %s; done' % (count_file), shell = True)
+            next(lines)
+            time.sleep(2)
+            cf = open(count_file, 'r')
+            try:
+                written = cf.read().strip()
+            finally:
+                cf.close()
+            start = time.time()
+            lines.close()
+            period = time.time() - start
+        finally:
+            os.unlink(count_file)
+        print('stream: stopped reader: %s line(s) written, closed in %.2f s' % \
+              (written, period))
+        if len(written) == 0 or int(written) > stream_lines + 20000 or \
+           period > 5:
+            print('error: stream failed')
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'timers':
+        #
+        # Time out processes with a deadline and with no output then measure
+        # how late the timers fire. The lateness is the time after a timer is
+        # due its function is called.
+        #
+        if len(sys.argv) > 2:
+            count = int(sys.argv[2])
+        else:
+            count = 50
+        deadlines = []
+        idles = []
+        def _run(timeout, command):
+            e = execute(output = lambda text: None)
+            e.shell(command, timeout = timeout)
+        runs = []
+        start = time.time()
+        for p in range(0, count):
+            runs += [threading.Thread(target = _run,
+                                      args = ((0.5, lambda: deadlines.append(True)),
+                                              'exec sleep 10'))]
+            runs += [threading.Thread(target = _run,
+                                      args = ((None, lambda: idles.append(True), 0.3),
+                                              'echo a; sleep 0.2; echo b; exec sleep 10'))]
+        for r in runs:
+            r.start()
+        for r in runs:
+            r.join()
+        period = time.time() - start
+        print('timers: %d processes in %.2f s, fired: %d deadline, %d no output' % \
+              (len(runs), period, timers.fired['deadline'], timers.fired['idle']))
+        lateness = []
+        def _fired(due):
+            lateness.append(time.time() - due)
+        now = time.time()
+        for t in range(0, count * 10):
+            due = now + 0.1 + (t % 100) * 0.003
+            timers.add(lambda d = due: _fired(d), deadline = due)
+        time.sleep(1)
+        print('timers: %d timers, lateness: max %.2f ms, average %.2f ms' % \
+              (len(lateness), max(lateness) * 1000.0,
+               sum(lateness) * 1000.0 / len(lateness)))
+        if len(deadlines) != count or len(idles) != count or \
+           len(lateness) != count * 10:
+            print('error: timers failed')
+            sys.exit(1)
+        sys.exit(0)
+
     def run_tests(e, commands, use_shell):
         for c in commands['shell']:
             e.shell(c)
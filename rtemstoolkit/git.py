@@ -44,12 +44,14 @@ class repo:
         if ec:
             raise error.general('git command failed (%s): %d' % (self.git, ec))
 
+    def _cwd(self):
+        if path.exists(self.path):
+            return self.path
+        return None
+
     def _run(self, args, check = False):
         e = execute.capture_execution()
-        if path.exists(self.path):
-            cwd = self.path
-        else:
-            cwd = None
+        cwd = self._cwd()
         cmd = [self.git] + args
         log.trace('cmd: (%s) %s' % (str(cwd), ' '.join(cmd)))
         exit_code, proc, output = e.spawn(cmd, cwd = path.host(cwd))
@@ -58,6 +60,23 @@ class repo:
             self._git_exit_code(exit_code)
         return exit_code, output
 
+    def _first_line(self, args, match):
+        '''Return the first line of the output the match function returns
+        True for or None. Git is killed once the line is found.'''
+        e = execute.execute()
+        cwd = self._cwd()
+        cmd = [self.git] + args
+        log.trace('cmd: (%s) %s' % (str(cwd), ' '.join(cmd)))
+        lines = e.stream(cmd, cwd = path.host(cwd))
+        try:
+            for l in lines:
+                log.trace(l)
+                if match(l):
+                    return l
+        finally:
+            lines.close()
+        return None
+
     def __init__(self, _path, opts = None, macros = None):
         self.path = _path
         self.opts = opts
@@ -98,11 +117,9 @@ class repo:
         ec, output = self._run(['reset'] + args, check = True)
 
     def branch(self):
-        ec, output = self._run(['branch'])
-        if ec == 0:
-            for b in output.split('\n'):
-                if b[0] == '*':
-                    return b[2:]
+        b = self._first_line(['branch'], lambda l: l.startswith('* '))
+        if b is not None:
+            return b[2:]
         return None
 
     def checkout(self, branch = 'master'):
@@ -44,17 +44,15 @@ def load():
     uname = os.uname()
     smp_mflags = ''
     processors = '/bin/grep processor /proc/cpuinfo'
-    e = execute.capture_execution()
-    exit_code, proc, output = e.shell(processors)
+    e = execute.execute()
     ncpus = 0
-    if exit_code == 0:
+    for l in e.stream(processors, shell = True):
         try:
-            for l in output.split('\n'):
-                count = l.split(':')[1].strip()
-                if int(count) > ncpus:
-                    ncpus = int(count)
+            count = int(l.split(':')[1].strip())
         except:
-            pass
+            continue
+        if count > ncpus:
+            ncpus = count
     ncpus = str(ncpus + 1)
     if uname[4].startswith('arm'):
         cpu = 'arm'
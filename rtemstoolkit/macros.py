@@ -38,6 +38,7 @@ import re
 import os
 import string
 
+from . import cache
 from . import error
 from . import path
 
@@ -66,6 +67,7 @@ class macros:
 
     def __init__(self, name = None, original = None, rtdir = '.'):
         self.files = []
+        self.generation = 0
         self.macro_filter = re.compile(r'%{[^}]+}')
         if original is None:
             self.macros = {}
@@ -187,6 +189,7 @@ class macros:
         if value[1] == 'convert':
             value = self.expand(value)
         self.macros[self.write_map][self.key_filter(key)] = value
+        self.generation += 1
 
     def __delitem__(self, key):
         self.undefine(key)
@@ -218,6 +221,11 @@ class macros:
     def maps(self):
         return self.macros.keys()
 
+    def map_keys(self, _map):
+        if _map in self.macros:
+            return self.macros[_map].keys()
+        return []
+
     def get_read_maps(self):
         return [rm[5:] for rm in self.read_maps]
 
@@ -246,6 +254,7 @@ class macros:
         state = 'key'
         token = ''
         macro = []
+        ops = []
         for l in lines:
             lc += 1
             #print 'l:%s' % (l[:-1])
@@ -282,6 +291,7 @@ class macros:
                     if c is ']':
                         if token not in self.macros:
                             self.macros[token] = {}
+                        ops += [('map', token)]
                         map = token
                         token = ''
                         state = 'key'
@@ -294,6 +304,7 @@ class macros:
                     if c in string.whitespace:
                         if token == 'include':
                             self.load(_clean(l_remaining))
+                            ops += [('include', _clean(l_remaining))]
                             token = ''
                             state = 'key'
                             break
@@ -364,18 +375,39 @@ class macros:
                     raise error.internal('bad state: %s' % (state))
                 if state is 'macro':
                     self.macros[map][macro[0].lower()] = (macro[1], macro[2], macro[3])
+                    self.generation += 1
+                    ops += [('macro', map, macro[0].lower(), self.macros[map][macro[0].lower()])]
                     macro = []
                     token = ''
                     state = 'key'
+        return ops
+
+    def _replay(self, ops):
+        for op in ops:
+            if op[0] == 'map':
+                if op[1] not in self.macros:
+                    self.macros[op[1]] = {}
+            elif op[0] == 'macro':
+                self.macros[op[1]][op[2]] = op[3]
+                self.generation += 1
+            elif op[0] == 'include':
+                self.load(op[1])
 
     def load(self, name):
         names = self.expand(name).split(':')
         for n in names:
             if path.exists(n):
+                ops = cache.parsed.get('macros', n)
+                if ops is not None:
+                    self._replay(ops)
+                    self.files += [n]
+                    return
                 try:
                     mc = open(path.host(n), 'r')
-                    macros = self.parse(mc)
+                    text = mc.read()
                     mc.close()
+                    ops = self.parse(text.splitlines(True))
+                    cache.parsed.put('macros', n, text, ops)
                     self.files += [n]
                     return
                 except IOError as err:
@@ -427,6 +459,7 @@ class macros:
         for map in self.macros:
             if key in self.macros[map]:
                 del self.macros[map][key]
+        self.generation += 1
 
     def expand(self, _str):
         """Simple basic expander of config file macros."""
@@ -449,6 +482,19 @@ class macros:
                 expanded = True
         return _str
 
+    def substitute(self, values):
+        """Replace each key of values with its value in every macro's value."""
+        for map in self.macros:
+            for key in self.macros[map]:
+                macro = self.macros[map][key]
+                value = macro[2]
+                for old in values:
+                    if old in value:
+                        value = value.replace(old, values[old])
+                if value is not macro[2]:
+                    self.macros[map][key] = (macro[0], macro[1], value)
+                    self.generation += 1
+
     def find(self, regex):
         what = re.compile(regex)
         keys = []
@@ -463,6 +509,7 @@ class macros:
                 if _map not in self.get_read_maps():
                     rm = '%04d_%s' % (len(self.read_maps), _map)
                     self.read_maps = sorted(self.read_maps + [rm])
+                    self.generation += 1
                 return True
         return False
 
@@ -472,6 +519,7 @@ class macros:
                 for i in range(0, len(self.read_maps)):
                     if '%04d_%s' % (i, _map) == self.read_maps[i]:
                         self.read_maps.pop(i)
+                        self.generation += 1
                 return True
         return False
 
@@ -102,7 +102,7 @@ class command_line(object):
             '--no-clean':                   'Do not clean up the build tree',
             '--always-clean':               'Always clean the build tree, even with an error',
             '--keep-going':                 'Do not stop on an error.',
-            '--jobs=[0..n,none,half,full]': 'Run with specified number of jobs, default: num CPUs.',
+            '--jobs=[0..n,none,half,full]': 'Run with specified number of jobs or auto, default: num CPUs.',
             '--macros file[,file]':         'Macro format files to load after the defaults',
             '--log file':                   'Log file where all build output is written to',
         }
@@ -198,7 +198,7 @@ class command_line(object):
         if value is None:
             raise error.general('option requires a value: %s' % (opt))
         ok = False
-        if value in ['max', 'none', 'half']:
+        if value in ['max', 'none', 'half', 'auto']:
             ok = True
         else:
             try:
@@ -451,7 +451,7 @@ class command_line(object):
         if opt_jobs != 'default':
             if opt_jobs == 'none':
                 cpus = 0
-            elif opt_jobs == 'max':
+            elif opt_jobs == 'max' or opt_jobs == 'auto':
                 pass
             elif opt_jobs == 'half':
                 cpus = cpus / 2
@@ -476,6 +476,10 @@ class command_line(object):
             cpu = 1
         return cpus
 
+    def jobs_auto(self):
+        '''The number of jobs is adjusted by the command as it runs.'''
+        return self.opts['jobs'] == 'auto'
+
     def params(self):
         return self.opts['params']
 
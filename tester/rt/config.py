@@ -32,9 +32,12 @@
 # RTEMS Testing Config
 #
 
+import copy
 import datetime
 import os
+import re
 import threading
+import time
 
 from rtemstoolkit import config
 from rtemstoolkit import error
@@ -44,6 +47,8 @@ from rtemstoolkit import path
 
 import console
 import gdb
+import incremental
+import qemu
 
 timeout = 15
 
@@ -52,11 +57,19 @@ class file(config.file):
 
     _directives = ['%execute',
                    '%gdb',
+                   '%qemu',
                    '%console']
 
-    def __init__(self, report, name, opts, _directives = _directives):
-        super(file, self).__init__(name, opts, directives = _directives)
+    def __init__(self, report, name, opts, _directives = _directives,
+                 phases = None, template = None):
+        macros = None
+        self.compiled = None
+        if template is not None:
+            macros, self.compiled = template.bind(opts.defaults)
+        super(file, self).__init__(name, opts, macros = macros,
+                                   directives = _directives)
         self.lock = threading.Lock()
+        self.phases = phases
         self.realtime_trace = self.debug_trace('output')
         self.process = None
         self.console = None
@@ -64,6 +77,7 @@ class file(config.file):
         self.report = report
         self.name = name
         self.timedout = False
+        self.overflow_end = False
 
     def __del__(self):
         if self.console:
@@ -76,12 +90,59 @@ class file(config.file):
     def _unlock(self):
         self.lock.release()
 
+    def _mark(self, phase, when = None):
+        if self.phases is not None:
+            self.phases.mark(phase, when)
+
+    def _deadline(self):
+        '''The test's adaptive timeout or None if it does not have one.'''
+        if self.defined('test_deadline'):
+            return int(self.expand('%{test_deadline}'))
+        return None
+
+    def _test_timeout(self):
+        deadline = self._deadline()
+        if deadline is not None:
+            return deadline
+        return int(self.expand('%{timeout}'))
+
     def _timeout(self):
         self._lock()
         self.timedout = True
         self._unlock()
         self.capture('*** TIMEOUT TIMEOUT')
 
+    def _overflow(self):
+        self._lock()
+        process = self.process
+        self._unlock()
+        if process is not None:
+            process.kill()
+
+    def _limit_output(self):
+        '''Limit the test's output to the capture limits in the
+        configuration.'''
+        def _macro(name, default):
+            if self.defined(name):
+                return self.expand('%%{%s}' % (name)).strip()
+            return default
+        try:
+            max_bytes = incremental.size_value(_macro('capture_max_bytes', '0'))
+            max_lines = int(_macro('capture_max_lines', '0'))
+            head = int(_macro('capture_head', '20'))
+            tail = int(_macro('capture_tail', '20'))
+        except (ValueError, error.general):
+            raise error.general(self._name_line_msg('invalid capture limit'))
+        if max_lines < 0 or head < 0 or tail < 0:
+            raise error.general(self._name_line_msg('invalid capture limit'))
+        overflow = _macro('capture_overflow', 'keep')
+        if overflow not in ['keep', 'end']:
+            raise error.general(self._name_line_msg('invalid capture overflow: %s' % \
+                                                    (overflow)))
+        self.overflow_end = overflow == 'end'
+        if max_bytes or max_lines:
+            self.output.limit(max_bytes, max_lines, head, tail)
+
     def _dir_console(self, data):
         if self.console is not None:
             raise error.general(self._name_line_msg('console already configured'))
@@ -111,8 +172,12 @@ class file(config.file):
                 self.console.open()
             self.capture_console('run: %s' % (' '.join(data)))
             ec, proc = self.process.open(data,
-                                         timeout = (int(self.expand('%{timeout}')),
+                                         timeout = (self._test_timeout(),
                                                     self._timeout))
+            if self.process.spawn_time is not None:
+                self._mark('spawn', self.process.spawn_time)
+                if self.process.exit_time is not None:
+                    self._mark('simulator', self.process.exit_time)
             self._lock()
             if ec > 0:
                 self._error('execute failed: %s: exit-code:%d' % (' '.join(data), ec))
@@ -122,15 +187,63 @@ class file(config.file):
             if self.console:
                 self.console.close()
 
+    def _script(self, label):
+        script = self.expand('%%{%s}' % label)
+        if script:
+            script = [l.strip() for l in script.splitlines()]
+        return script
+
+    def _dir_gdb_session(self, data, bsp_arch, bsp):
+        connect = self._script(self.expand('%{gdb_session_connect}')) or []
+        script = self._script(self.expand('%{gdb_session_script}')) or []
+        session = gdb.sessions.acquire(bsp_arch, bsp, data[0], connect,
+                                       gdb_console = self.capture_console,
+                                       trace = self.debug_trace('gdb'),
+                                       mi_trace = self.debug_trace('gdb-mi'),
+                                       timeout = self._test_timeout())
+        if session is None:
+            self.capture_console('gdb: session failed to start')
+            return False
+        self._lock()
+        self.process = session
+        self._unlock()
+        if self.console:
+            self.console.open()
+        ran = session.run(data[1], script,
+                          output = self.capture,
+                          gdb_console = self.capture_console,
+                          timeout = self._test_timeout())
+        self._mark('simulator')
+        if self.console:
+            self.console.close()
+        gdb.sessions.release(session)
+        if not ran:
+            #
+            # A session that failed before the test started is not the
+            # test's result, run the test with its own GDB.
+            #
+            self._lock()
+            try:
+                self.process = None
+                retry = not self.output.started and not self.output.timedout
+            finally:
+                self._unlock()
+            if retry:
+                self.capture_console('gdb: session failed, running with gdb')
+                return False
+        return True
+
     def _dir_gdb(self, data, total, index, exe, bsp_arch, bsp):
         if len(data) < 3 or len(data) > 4:
             raise error.general('invalid %gdb arguments')
+        if self.defined('gdb_session_script') and \
+           gdb.sessions.enabled and not self.in_error:
+            if self._dir_gdb_session(data, bsp_arch, bsp):
+                return
         self.process = gdb.gdb(bsp_arch, bsp,
                                trace = self.debug_trace('gdb'),
                                mi_trace = self.debug_trace('gdb-mi'))
-        script = self.expand('%%{%s}' % data[2])
-        if script:
-            script = [l.strip() for l in script.splitlines()]
+        script = self._script(data[2])
         if not self.in_error:
             if self.console:
                 self.console.open()
@@ -138,10 +251,52 @@ class file(config.file):
                               script = script,
                               output = self.capture,
                               gdb_console = self.capture_console,
-                              timeout = int(self.expand('%{timeout}')))
+                              timeout = self._test_timeout())
+            self._mark('simulator')
             if self.console:
                 self.console.close()
 
+    def _dir_qemu_instance(self, command, executable):
+        instance = qemu.instances.acquire(command,
+                                          self.expand('%{qemu_test_end}'),
+                                          trace = self.debug_trace('qemu'))
+        if instance is None:
+            self.capture_console('qemu: instance failed to start')
+            return False
+        self._lock()
+        self.process = instance
+        self._unlock()
+        if self.console:
+            self.console.open()
+        self.capture_console('qemu: instance: test %d: %s' % (instance.loads + 1,
+                                                              executable))
+        ran = instance.run(executable,
+                           output = self.capture,
+                           timeout = self._test_timeout())
+        if ran:
+            self._mark('simulator')
+        if self.console:
+            self.console.close()
+        if not ran:
+            self.capture_console('qemu: instance cannot load the executable')
+            qemu.instances.fail(instance)
+            self._lock()
+            self.process = None
+            self._unlock()
+            return False
+        qemu.instances.release(instance)
+        return True
+
+    def _dir_qemu(self, data, total, index, exe, bsp_arch, bsp):
+        if len(data) < 2:
+            raise error.general('invalid %qemu arguments')
+        command = data[:-1]
+        if not self.in_error and qemu.instances.usable(command):
+            if self._dir_qemu_instance(command, data[-1]):
+                return
+        self._dir_execute(command + ['-kernel', data[-1]],
+                          total, index, exe, bsp_arch, bsp)
+
     def _directive_filter(self, results, directive, info, data):
         if results[0] == 'directive':
             _directive = results[1]
@@ -156,6 +311,7 @@ class file(config.file):
             if _directive == '%console':
                 self._dir_console(ds)
             else:
+                self._mark('parse')
                 self._lock()
                 try:
                     total = int(self.expand('%{test_total}'))
@@ -163,16 +319,22 @@ class file(config.file):
                     exe = self.expand('%{test_executable}')
                     bsp_arch = self.expand('%{bsp_arch}')
                     bsp = self.expand('%{bsp}')
-                    self.report.start(index, total, exe, exe, bsp_arch, bsp)
-                    self.output = []
+                    self.report.start(index, total, exe, exe, bsp_arch, bsp,
+                                      self._deadline())
+                    self.output = self.report.output(exe)
+                    self._limit_output()
                 finally:
                     self._unlock()
+                self._mark('report-start')
                 if _directive == '%execute':
                     self._dir_execute(ds, total, index, exe, bsp_arch, bsp)
                 elif _directive == '%gdb':
                     self._dir_gdb(ds, total, index, exe, bsp_arch, bsp)
+                elif _directive == '%qemu':
+                    self._dir_qemu(ds, total, index, exe, bsp_arch, bsp)
                 else:
                     raise error.general(self._name_line_msg('invalid directive'))
+                self._mark('reap')
                 self._lock()
                 try:
                     self.report.end(exe, self.output)
@@ -180,6 +342,7 @@ class file(config.file):
                     self.output = None
                 finally:
                     self._unlock()
+                self._mark('report-end')
         return None, None, None
 
     def _realtime_trace(self, text):
@@ -188,23 +351,52 @@ class file(config.file):
                 print(' '.join(l))
 
     def run(self):
-        self.load(self.name)
+        if self.compiled is None:
+            self.load(self.name)
+        else:
+            #
+            # The configuration has been parsed, run its directives.
+            #
+            self.in_error = False
+            for lc, directive, data in self.compiled:
+                self.lc = lc
+                self._directive_filter(('directive', directive, data),
+                                       None, None, [])
 
-    def capture(self, text):
-        text = [(']', l) for l in text.replace(chr(13), '').splitlines()]
+    def _add(self, text, start):
+        #
+        # The output is captured on the execute reactor's thread and must
+        # not block. A test over its output limit is ended by killing it. The
+        # kill is made by a thread because the output can be captured with
+        # the lock of the process held.
+        #
+        overflow = False
         self._lock()
         if self.output is not None:
             self._realtime_trace(text)
-            self.output += text
+            self.output.add(text)
+            if self.overflow_end and \
+               self.output.limited and not self.output.overflowed:
+                self.output.add([(']', '*** OVERFLOW OVERFLOW')])
+                overflow = True
         self._unlock()
+        if overflow:
+            kill = threading.Thread(target = self._overflow,
+                                    name = 'overflow[%s]' % (path.basename(self.name)))
+            kill.daemon = True
+            kill.start()
+        if self.phases is not None:
+            self.phases.add('capture', time.time() - start)
+
+    def capture(self, text):
+        start = time.time()
+        text = [(']', l) for l in text.replace(chr(13), '').splitlines()]
+        self._add(text, start)
 
     def capture_console(self, text):
+        start = time.time()
         text = [('>', l) for l in text.replace(chr(13), '').splitlines()]
-        self._lock()
-        if self.output is not None:
-            self._realtime_trace(text)
-            self.output += text
-        self._unlock()
+        self._add(text, start)
 
     def debug_trace(self, flag):
         dt = self.macros['debug_trace']
@@ -216,3 +408,215 @@ class file(config.file):
     def kill(self):
         if self.process:
             self.process.kill()
+
+def _placeholder(name):
+    return '\x01%s\x01' % (name)
+
+class _compiler(file):
+    '''Parse a configuration recording the directives rather than running
+    them. The bound macros are defined as placeholders and the configuration
+    cannot be bound if a placeholder is used in a conditional or a shell
+    macro, a shell macro is not cached for the BSP or the run, or the parse
+    has an error.'''
+
+    _conditional = re.compile(r'%\{!?\?([^:}]+)')
+
+    def __init__(self, name, opts, bound):
+        super(_compiler, self).__init__(None, name, opts)
+        self.bound = bound
+        self.placeholders = [_placeholder(b) for b in bound]
+        self.recorded = []
+        self.bindable = True
+
+    def _unbindable(self, why):
+        if self.bindable:
+            log.trace('config: %s: cannot bind: %s' % (self.init_name, why))
+        self.bindable = False
+
+    def _has_placeholder(self, s):
+        for p in self.placeholders:
+            if p in s:
+                return True
+        return False
+
+    def _error(self, msg):
+        self._unbindable(self._name_line_msg(msg))
+
+    def _expand_macros(self, s):
+        for m in self._conditional.findall(s):
+            if m.strip().lower() in self.bound:
+                self._unbindable('conditional macro: %s' % (m))
+        return super(_compiler, self)._expand_macros(s)
+
+    def _shell(self, line):
+        #
+        # A template is parsed once for a BSP in a run so only the output of
+        # shell macros cached for the BSP or the run can be held in it.
+        #
+        if self.sf.search(line):
+            if self._has_placeholder(line):
+                self._unbindable('shell macro: %s' % (line))
+            elif self.shell_scope not in ['bsp', 'run']:
+                self._unbindable('shell macro scope %s: %s' % (self.shell_scope,
+                                                               line))
+        return super(_compiler, self)._shell(line)
+
+    def _ifs(self, config, ls, label, iftrue, isvalid, dir, info):
+        if isvalid and self._has_placeholder(' '.join(ls)):
+            self._unbindable('%s: %s' % (label, ' '.join(ls)))
+        return super(_compiler, self)._ifs(config, ls, label, iftrue,
+                                           isvalid, dir, info)
+
+    def _directive_filter(self, results, directive, info, data):
+        if results[0] == 'directive':
+            self.recorded += [(self.lc, results[1], list(results[2]))]
+        return None, None, None
+
+class template(object):
+    '''A test configuration parsed once with the per-test macros bound to
+    placeholders. A test's configuration is the template's macros and
+    directives with its values bound.'''
+
+    def __init__(self, name, opts, bound):
+        self.name = name
+        self.bound = sorted([b.lower() for b in bound])
+        opts = copy.copy(opts)
+        for b in self.bound:
+            opts.defaults[b] = _placeholder(b)
+        c = _compiler(name, opts, self.bound)
+        try:
+            c.load(name)
+        except error.general as gerr:
+            c._unbindable(str(gerr))
+        self.bindable = c.bindable
+        self.macros = c.macros
+        self.directives = c.recorded
+
+    def bind(self, defaults):
+        values = {}
+        for b in self.bound:
+            values[_placeholder(b)] = defaults[b]
+        macros = copy.copy(self.macros)
+        macros.substitute(values)
+        directives = []
+        for lc, directive, data in self.directives:
+            bound_data = []
+            for d in data:
+                for p in values:
+                    d = d.replace(p, values[p])
+                bound_data += [d]
+            directives += [(lc, directive, bound_data)]
+        return macros, directives
+
+class template_cache(object):
+    '''The templates of the configurations of this process. A template is
+    parsed the first time a configuration is used with a set of per-test
+    macros and options.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.enabled = True
+
+    def get(self, name, bsp, opts, owner, bound):
+        '''Return the template for the configuration or None if it cannot be
+        bound. The owner is the options the test's options are copied from.'''
+        if not self.enabled:
+            return None
+        key = (name, bsp, tuple(sorted(bound)))
+        self.lock.acquire()
+        try:
+            if key in self.templates and self.templates[key][0] is owner:
+                t = self.templates[key][1]
+            else:
+                t = template(name, opts, bound)
+                self.templates[key] = (owner, t)
+        finally:
+            self.lock.release()
+        if not t.bindable:
+            return None
+        return t
+
+    def clear(self):
+        self.lock.acquire()
+        self.templates = {}
+        self.lock.release()
+
+#
+# The configuration templates of this process.
+#
+templates = template_cache()
+
+if __name__ == "__main__":
+    #
+    # Time the per-test configuration cost of parsing the BSP configuration
+    # for each test against binding a template parsed once.
+    #
+    import sys
+    import options
+    optargs = { '--rtems-tools': 'The path to the RTEMS tools',
+                '--rtems-bsp':   'The RTEMS BSP',
+                '--count':       'Number of tests to time (default: 100)' }
+    opts = options.load(sys.argv, optargs = optargs,
+                        command_path = path.dirname(path.dirname(__file__)))
+    bsp = opts.find_arg('--rtems-bsp')
+    if bsp is None or len(bsp) != 2:
+        raise error.general('RTEMS BSP not provided or invalid option')
+    opts.defaults.load('%%{_configdir}/bsps/%s.mc' % (bsp[1]))
+    bsp = opts.defaults.get('%{bsp}')[2]
+    opts.defaults.set_read_map(bsp)
+    cfg = opts.defaults.expand(opts.defaults[bsp])
+    opts.defaults['bsp'] = bsp
+    opts.defaults['bsp_arch'] = '%%{%s_arch}' % (bsp)
+    opts.defaults['bsp_opts'] = '%%{%s_opts}' % (bsp)
+    rtems_tools = opts.find_arg('--rtems-tools')
+    if rtems_tools:
+        opts.defaults['rtems_tools'] = \
+            path.join(opts.defaults.expand(rtems_tools[1]), 'bin')
+    count = opts.find_arg('--count')
+    if count:
+        count = int(count[1])
+    else:
+        count = 100
+    opts.defaults['debug_trace'] = ''
+    bound = ['test_index', 'test_total', 'test_executable']
+    exes = opts.params()
+    if len(exes) == 0:
+        exes = ['test.exe']
+    def test_opts(index):
+        o = copy.copy(opts)
+        o.defaults['test_index'] = str(index + 1)
+        o.defaults['test_total'] = str(count)
+        o.defaults['test_executable'] = exes[index % len(exes)]
+        return o
+    start = time.time()
+    parsed = []
+    for i in range(0, count):
+        c = _compiler(cfg, test_opts(i), [])
+        c.load(cfg)
+        parsed += [c.recorded]
+    before = (time.time() - start) / count
+    start = time.time()
+    t = templates.get(cfg, bsp, test_opts(0), opts, bound)
+    compile_time = time.time() - start
+    if t is None:
+        print('config: %s cannot be bound, each test is parsed' % (cfg))
+        sys.exit(1)
+    start = time.time()
+    bound_configs = []
+    for i in range(0, count):
+        f = file(None, cfg, test_opts(i), template = t)
+        bound_configs += [f.compiled]
+    after = (time.time() - start) / count
+    for i in range(0, count):
+        if parsed[i] != bound_configs[i]:
+            print('error: test %d: parsed %r != bound %r' % \
+                  (i + 1, parsed[i], bound_configs[i]))
+            sys.exit(1)
+    print('config: %s: %d tests' % (cfg, count))
+    print('  parse per test:    %8.3f ms' % (before * 1000))
+    print('  compile once:      %8.3f ms' % (compile_time * 1000))
+    print('  bind per test:     %8.3f ms' % (after * 1000))
+    print('  speed up:          %8.1fx' % (before / after))
+    del c, f, parsed, bound_configs
+    templates.clear()
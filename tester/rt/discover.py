@@ -0,0 +1,210 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Executable Discovery
+#
+
+import fnmatch
+import os
+import sys
+import threading
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+from rtemstoolkit import error
+from rtemstoolkit import path
+
+def _order(name, isdir):
+    #
+    # Sorting a directory's entries with a '/' after a directory's name visits
+    # the tree in the same order as sorting the full paths found.
+    #
+    if isdir:
+        return name + '/'
+    return name
+
+def _entries(directory):
+    '''Return the sorted names of a directory's entries and if each is a
+    directory. Symbolic links are followed. A directory that cannot be read
+    has no entries.'''
+    entries = []
+    if _scandir is not None:
+        try:
+            it = _scandir(directory)
+        except OSError:
+            return []
+        try:
+            for e in it:
+                try:
+                    isdir = e.is_dir()
+                except OSError:
+                    isdir = False
+                entries += [(e.name, isdir)]
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+    else:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        for name in names:
+            entries += [(name, os.path.isdir(os.path.join(directory, name)))]
+    return sorted(entries, key = lambda e: _order(e[0], e[1]))
+
+def _walk(directory, glob):
+    for name, isdir in _entries(directory):
+        if isdir:
+            for exe in _walk(path.join(directory, name), glob):
+                yield exe
+        elif fnmatch.fnmatch(name.lower(), glob):
+            yield path.join(directory, name)
+
+def executables(paths, glob):
+    '''Generate the executables in the paths that match the glob. The
+    executables are generated in sorted order as they are found.'''
+    roots = []
+    for p in paths:
+        if path.isfile(p):
+            roots += [(p, False)]
+        elif path.isdir(p):
+            roots += [(p, True)]
+    for p, isdir in sorted(roots, key = lambda r: _order(r[0].rstrip('/'), r[1])):
+        if isdir:
+            for exe in _walk(p, glob):
+                yield exe
+        else:
+            yield p
+
+class discovery(object):
+    '''Find the executables in a thread so tests can be started while the
+    paths are still being searched. The found call is made each time an
+    executable is found and when the search has finished.'''
+
+    def __init__(self, paths, glob, found = None):
+        self.paths = paths
+        self.glob = glob
+        self.found = found
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.executables = []
+        self.taken = 0
+        self.done = False
+        self.error = None
+        self.thread = threading.Thread(target = self._search,
+                                       name = 'discovery')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _signal(self):
+        self.event.set()
+        if self.found is not None:
+            self.found()
+
+    def _search(self):
+        try:
+            for exe in executables(self.paths, self.glob):
+                self.lock.acquire()
+                try:
+                    self.executables += [exe]
+                finally:
+                    self.lock.release()
+                self._signal()
+        except:
+            self.error = str(sys.exc_info()[1])
+        self.lock.acquire()
+        try:
+            self.done = True
+        finally:
+            self.lock.release()
+        self._signal()
+
+    def take(self):
+        '''Return the executables found since the last call and if the search
+        has finished.'''
+        self.lock.acquire()
+        try:
+            found = self.executables[self.taken:]
+            self.taken = len(self.executables)
+            done = self.done
+        finally:
+            self.lock.release()
+        if done and self.error is not None:
+            raise error.general('finding executables: %s' % (self.error))
+        return found, done
+
+    def wait(self, timeout):
+        '''Wait for more executables or the search to finish.'''
+        self.event.wait(timeout)
+        self.event.clear()
+
+if __name__ == "__main__":
+    import time
+    if len(sys.argv) < 2:
+        print('usage: discover.py path [path ...]')
+        sys.exit(1)
+    #
+    # Compare the time to the first executable and all executables with the
+    # walk the tester used before.
+    #
+    start = time.time()
+    walked = []
+    for p in sys.argv[1:]:
+        if path.isfile(p):
+            walked += [p]
+        elif path.isdir(p):
+            for root, dirs, files in os.walk(p, followlinks = True):
+                for f in files:
+                    if fnmatch.fnmatch(f.lower(), '*.exe'):
+                        walked += [path.join(root, f)]
+    walked = sorted(walked)
+    walk_time = time.time() - start
+    start = time.time()
+    first = None
+    found = []
+    for exe in executables(sys.argv[1:], '*.exe'):
+        if first is None:
+            first = time.time() - start
+        found += [exe]
+    found_time = time.time() - start
+    if first is None:
+        first = found_time
+    print('scandir        : %s' % (_scandir is not None))
+    print('executables    : %d' % (len(found)))
+    print('os.walk + sort : %.3f sec to first, %.3f sec total' % (walk_time, walk_time))
+    print('discovery      : %.3f sec to first, %.3f sec total' % (first, found_time))
+    print('same order     : %s' % (found == walked))
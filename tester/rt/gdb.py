@@ -36,6 +36,7 @@ import os
 import Queue
 import sys
 import threading
+import time
 
 from rtemstoolkit import error
 from rtemstoolkit import execute
@@ -181,6 +182,9 @@ class gdb(object):
         finally:
             self._unlock('_gdb_quit')
 
+    def _script_end(self):
+        self._put(None)
+
     def open(self, command, executable,
              output, gdb_console, script = None, tty = None,
              timeout = 300):
@@ -202,9 +206,11 @@ class gdb(object):
                                            cleanup = self._cleanup)
         finally:
             self._unlock('_open')
+        if timeout:
+            timeout = (timeout, self._timeout)
         try:
             self.gdb_console('gdb: %s' % (' '.join(cmds)))
-            ec, proc = self.process.open(cmds, timeout = (timeout, self._timeout))
+            ec, proc = self.process.open(cmds, timeout = timeout)
             if self.trace:
                 print('gdb done', ec)
             if ec > 0:
@@ -222,7 +228,7 @@ class gdb(object):
             print('}}} gdb-expect')
         if self.process and not self.running and self.script is not None:
             if self.script_line == len(self.script):
-                self._put(None)
+                self._script_end()
             else:
                 if self.script_line == 0:
                     self._put('-gdb-set confirm no')
@@ -293,6 +299,256 @@ class gdb(object):
             for line in lines.splitlines():
                 self.output(line)
 
+class session(gdb):
+    '''A long lived GDB session. The connect script is run once when the session
+    starts and each test loads its executable into the connected target and
+    runs the session script. The session is idle between tests.'''
+
+    def __init__(self, bsp_arch, bsp, command, connect,
+                 trace = False, mi_trace = False):
+        super(session, self).__init__(bsp_arch, bsp, trace, mi_trace)
+        self.command = command
+        self.connect = connect
+        self.idle = threading.Event()
+        self.thread = None
+        self.failed = False
+        self.timer = None
+        self.output_to = None
+        self.console_to = None
+        self.sync = 0
+        self.synced = False
+        self.sync_seen = False
+        self.tests = 0
+
+    def _reader(self, line):
+        self._lock('_reader')
+        try:
+            if self.timer is not None:
+                self.timer.touch()
+            super(session, self)._reader(line)
+            if self.synced:
+                if line.startswith('%d^' % (self.sync)):
+                    self.sync_seen = True
+                elif self.sync_seen and line.startswith('(gdb)'):
+                    self.idle.set()
+        finally:
+            self._unlock('_reader')
+
+    def _script_end(self):
+        #
+        # GDB can still have prompts to send for the commands of the
+        # script. Send a command with a token and the session is idle
+        # when its prompt arrives.
+        #
+        if not self.synced:
+            self.synced = True
+            self.sync += 1
+            self._put('%d-gdb-set confirm off' % (self.sync))
+
+    def _gdb_quit(self, backtrace = False):
+        self._lock('_gdb_quit')
+        try:
+            self.failed = True
+            super(session, self)._gdb_quit(backtrace)
+        finally:
+            self._unlock('_gdb_quit')
+
+    def _timeout(self):
+        self._lock('_timeout')
+        try:
+            if self.output:
+                self.output('*** TIMEOUT TIMEOUT')
+        finally:
+            self._unlock('_timeout')
+        self.kill()
+
+    def _session(self):
+        try:
+            self.open(self.command, None,
+                      output = self._output,
+                      gdb_console = self._console,
+                      script = self.connect,
+                      timeout = None)
+        except:
+            pass
+        self._lock('_session')
+        try:
+            self.failed = True
+        finally:
+            self._unlock('_session')
+        self.idle.set()
+
+    def _output(self, text):
+        if self.output_to:
+            self.output_to(text)
+
+    def _console(self, text):
+        if self.console_to:
+            self.console_to(text)
+
+    def _wait(self, timeout):
+        timer = None
+        if timeout:
+            timer = execute.timers.add(self._timeout,
+                                       deadline = time.time() + timeout,
+                                       idle = timeout)
+        self._lock('_wait')
+        try:
+            self.timer = timer
+        finally:
+            self._unlock('_wait')
+        try:
+            while not self.idle.is_set():
+                self.idle.wait(1.0)
+                if timer is not None and timer.fired:
+                    self.idle.wait(10.0)
+                    break
+        finally:
+            self._lock('_wait')
+            try:
+                self.timer = None
+            finally:
+                self._unlock('_wait')
+            if timer is not None:
+                execute.timers.cancel(timer)
+
+    def start(self, gdb_console, timeout = 300):
+        '''Start GDB and connect to the target. Returns False if the session
+        could not be started.'''
+        self.output_to = None
+        self.console_to = gdb_console
+        self.idle.clear()
+        self.thread = threading.Thread(target = self._session,
+                                       name = 'gdb-session[%s]' % (self.bsp))
+        self.thread.daemon = True
+        self.thread.start()
+        self._wait(timeout)
+        return self.alive()
+
+    def alive(self):
+        self._lock('alive')
+        try:
+            return not self.failed and self.process is not None
+        finally:
+            self._unlock('alive')
+
+    def run(self, executable, script, output, gdb_console, timeout = 300):
+        '''Load and run an executable. Returns False if the session failed and
+        cannot be used again.'''
+        self._lock('run')
+        try:
+            if self.failed or self.process is None:
+                return False
+            self.output_to = output
+            self.console_to = gdb_console
+            self.output_buffer = ''
+            self.running = False
+            self.script = ['-file-exec-and-symbols %s' % (executable)] + script
+            self.script_line = 0
+            self.synced = False
+            self.sync_seen = False
+            self.tests += 1
+            self.idle.clear()
+            gdb_console('gdb: session: test %d: %s' % (self.tests, executable))
+            self.gdb_expect()
+            self._input_commands()
+        finally:
+            self._unlock('run')
+        self._wait(timeout)
+        self._lock('run')
+        try:
+            self.output_to = None
+            self.console_to = None
+        finally:
+            self._unlock('run')
+        return self.alive()
+
+    def kill(self):
+        self._lock('kill')
+        try:
+            self.failed = True
+            if self.process is not None:
+                self.process.kill()
+        finally:
+            self._unlock('kill')
+
+    def close(self):
+        self._lock('close')
+        try:
+            self.failed = True
+            self._put(None)
+            self._input_commands()
+        finally:
+            self._unlock('close')
+        if self.thread is not None:
+            self.thread.join(5)
+
+class session_pool(object):
+    '''A pool of idle GDB sessions. Sessions are shared by tests with the same
+    GDB command and connect script and a session is only used by one test at a
+    time so there is a session for each job slot running tests.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.started = 0
+        self.enabled = True
+
+    def acquire(self, bsp_arch, bsp, command, connect, gdb_console,
+                trace = False, mi_trace = False, timeout = 300):
+        key = (command, tuple(connect))
+        while True:
+            self.lock.acquire()
+            try:
+                if key in self.idle and len(self.idle[key]) > 0:
+                    s = self.idle[key].pop()
+                else:
+                    self.started += 1
+                    break
+            finally:
+                self.lock.release()
+            #
+            # The target or simulator can exit while the session is idle.
+            #
+            if s.alive():
+                return s
+            s.close()
+        s = session(bsp_arch, bsp, command, connect,
+                    trace = trace, mi_trace = mi_trace)
+        if not s.start(gdb_console, timeout):
+            s.close()
+            return None
+        return s
+
+    def release(self, s):
+        if not s.alive():
+            s.close()
+            return
+        key = (s.command, tuple(s.connect))
+        self.lock.acquire()
+        try:
+            if key not in self.idle:
+                self.idle[key] = []
+            self.idle[key] += [s]
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for key in idle:
+            for s in idle[key]:
+                s.close()
+
+#
+# The sessions of this process.
+#
+sessions = session_pool()
+
 if __name__ == "__main__":
     stdtty = console.save()
     try:
@@ -0,0 +1,221 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Job Governor
+#
+
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from rtemstoolkit import log
+
+def _free_memory():
+    '''Return the host's total and available memory in bytes or None if it is
+    not known.'''
+    try:
+        mf = open('/proc/meminfo', 'r')
+        try:
+            lines = mf.readlines()
+        finally:
+            mf.close()
+    except IOError:
+        return None
+    info = {}
+    for l in lines:
+        ls = l.split()
+        if len(ls) >= 2 and ls[0][-1] == ':':
+            try:
+                info[ls[0][:-1]] = int(ls[1]) * 1024
+            except ValueError:
+                pass
+    if 'MemTotal' not in info:
+        return None
+    if 'MemAvailable' in info:
+        available = info['MemAvailable']
+    else:
+        available = info.get('MemFree', 0) + info.get('Cached', 0)
+    return info['MemTotal'], available
+
+def _load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+def _children_usage():
+    '''Return the CPU seconds and the largest resident size in bytes of the
+    child processes that have finished.'''
+    if resource is None:
+        return None
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    maxrss = ru.ru_maxrss
+    if os.uname()[0] != 'Darwin':
+        maxrss *= 1024
+    return ru.ru_utime + ru.ru_stime, maxrss
+
+class governor(object):
+    '''Adjust the number of jobs the scheduler runs to the load on the host.
+    The host's CPUs less the load that is not from the tests, divided by the
+    CPU a test has been seen to use, is the number of tests the CPUs can run.
+    The available memory less a reserve, divided by the largest test seen, is
+    the number of tests that fit in memory. The number of jobs is the smaller
+    of these within the minimum and maximum. It is raised by one at a time
+    because the load average lags, and lowered at once.'''
+
+    def __init__(self, sched, cpus, minimum, maximum,
+                 interval = 5.0, reserve = 10):
+        self.sched = sched
+        self.cpus = cpus
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.interval = interval
+        self.reserve = reserve
+        self.cpu_per_test = 1.0
+        self.mem_per_test = None
+        self.last = time.time()
+        self.last_usage = _children_usage()
+        self.last_busy = 0.0
+        self.decisions = 0
+        self.running = True
+        self.sched.resize(self.target(_load_average(), _free_memory(), False))
+        log.notice('Jobs: auto, %d to %d, starting with %d, check every %.0f sec' % \
+                   (self.minimum, self.maximum, self.sched.limit, self.interval))
+        self.ticker = threading.Thread(target = self._tick,
+                                       name = 'governor')
+        self.ticker.daemon = True
+        self.ticker.start()
+
+    def _tick(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.sched.wake()
+
+    def _observe(self):
+        usage = _children_usage()
+        busy = sum(self.sched.busy)
+        if usage is not None and self.last_usage is not None:
+            cpu = usage[0] - self.last_usage[0]
+            slot_time = busy - self.last_busy
+            if slot_time > 0.0 and cpu >= 0.0:
+                #
+                # Smooth the CPU a test uses so one odd test does not move
+                # the number of jobs too far.
+                #
+                self.cpu_per_test = (self.cpu_per_test + cpu / slot_time) / 2
+            if usage[1] > 0:
+                self.mem_per_test = usage[1]
+        self.last_usage = usage
+        self.last_busy = busy
+
+    def target(self, load, memory, ramp = True):
+        '''The number of jobs for the load average and the total and
+        available memory. Either can be None if not known.'''
+        running = self.sched.running()
+        cpu_per_test = max(self.cpu_per_test, 0.05)
+        jobs = self.maximum
+        if load is not None:
+            other = max(load - running * cpu_per_test, 0.0)
+            jobs = min(jobs, int((self.cpus - other) / cpu_per_test))
+        if memory is not None and self.mem_per_test:
+            total, available = memory
+            spare = available - total * self.reserve / 100
+            jobs = min(jobs, running + int(spare / self.mem_per_test))
+        jobs = max(self.minimum, min(jobs, self.maximum))
+        if ramp and jobs > self.sched.limit + 1:
+            jobs = self.sched.limit + 1
+        return jobs
+
+    def update(self):
+        '''Adjust the number of jobs if the interval has passed.'''
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self._observe()
+        load = _load_average()
+        memory = _free_memory()
+        jobs = self.target(load, memory)
+        if jobs != self.sched.limit:
+            self.decisions += 1
+            if load is None:
+                load_text = 'unknown'
+            else:
+                load_text = '%.2f' % (load)
+            if memory is None:
+                memory_text = 'unknown'
+            else:
+                memory_text = '%dM' % (memory[1] / (1024 * 1024))
+            log.notice('Jobs: %d -> %d (load: %s, cpus: %d, free: %s, ' \
+                       'cpu/test: %.2f, running: %d)' % \
+                       (self.sched.limit, jobs, load_text, self.cpus,
+                        memory_text, self.cpu_per_test, self.sched.running()))
+            self.sched.resize(jobs)
+
+    def stop(self):
+        self.running = False
+
+if __name__ == "__main__":
+    #
+    # Show the decisions for a range of loads with a fake scheduler.
+    #
+    class fake_scheduler(object):
+        def __init__(self):
+            self.limit = 1
+            self.busy = [0.0]
+            self.active = 0
+        def running(self):
+            return self.active
+        def resize(self, jobs):
+            self.limit = jobs
+        def wake(self):
+            pass
+    sched = fake_scheduler()
+    g = governor(sched, 8, 1, 16, interval = 3600)
+    g.stop()
+    g.mem_per_test = 512 * 1024 * 1024
+    print('host: load %s, memory %s' % (_load_average(), _free_memory()))
+    for cpu, load, free in [(1.0, 0.0, 16), (1.0, 4.0, 16), (0.5, 4.0, 16),
+                            (0.25, 2.0, 16), (1.0, 9.0, 16), (0.5, 1.0, 2)]:
+        g.cpu_per_test = cpu
+        for step in range(0, 16):
+            sched.active = sched.limit
+            jobs = g.target(load + sched.active * cpu, (16 * 1024 ** 3, free * 1024 ** 3))
+            if jobs == sched.limit:
+                break
+            sched.resize(jobs)
+        print('cpu/test %.2f other load %.1f free %2dG: jobs %d' % \
+              (cpu, load, free, sched.limit))
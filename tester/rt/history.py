@@ -0,0 +1,218 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Run Time History
+#
+
+import json
+import math
+import os
+
+from rtemstoolkit import error
+from rtemstoolkit import log
+from rtemstoolkit import path
+
+class history(object):
+    '''The run time history of tests. The time a test takes is recorded per
+    BSP and executable so the tester can estimate how long a test will take
+    the next time it is run.'''
+
+    def __init__(self, name, samples = 20):
+        self.name = name
+        self.samples = samples
+        self.times = {}
+        self.load()
+
+    def _key(self, executable):
+        return path.basename(executable)
+
+    def load(self):
+        self.times = {}
+        if path.exists(self.name):
+            try:
+                hf = open(path.host(self.name), 'r')
+                try:
+                    self.times = json.load(hf)
+                finally:
+                    hf.close()
+            except (IOError, ValueError) as err:
+                log.warning('ignoring test history: %s: %s' % (self.name, str(err)))
+                self.times = {}
+            if type(self.times) is not dict:
+                log.warning('ignoring test history: %s: invalid format' % (self.name))
+                self.times = {}
+
+    def save(self):
+        tmp = self.name + '.tmp'
+        try:
+            hf = open(path.host(tmp), 'w')
+            try:
+                json.dump(self.times, hf, indent = 1, sort_keys = True)
+            finally:
+                hf.close()
+            os.rename(path.host(tmp), path.host(self.name))
+        except (IOError, OSError) as err:
+            raise error.general('writing test history: %s: %s' % (self.name, str(err)))
+
+    def add(self, bsp, executable, seconds):
+        if bsp not in self.times:
+            self.times[bsp] = {}
+        key = self._key(executable)
+        if key not in self.times[bsp]:
+            self.times[bsp][key] = []
+        self.times[bsp][key] = (self.times[bsp][key] + [seconds])[-self.samples:]
+
+    def update(self, bsp, results):
+        '''Add the run times of the tests in a report's results that ran to
+        completion.'''
+        for name in results:
+            result = results[name]
+            if result['result'] in ['passed', 'failed'] and \
+                    result['end'] is not None and not result['cached']:
+                elapsed = result['end'] - result['start']
+                self.add(bsp, name,
+                         elapsed.days * 86400 + elapsed.seconds + \
+                         elapsed.microseconds / 1000000.0)
+            elif result['result'] == 'timeout' and result['deadline']:
+                #
+                # A test that ran out of its adaptive timeout is recorded as
+                # taking the time it had so its next deadline is longer.
+                #
+                self.add(bsp, name, result['deadline'])
+
+    def durations(self, bsp, executable):
+        if bsp in self.times:
+            key = self._key(executable)
+            if key in self.times[bsp]:
+                return self.times[bsp][key]
+        return []
+
+    def expected(self, bsp, executable):
+        '''The expected run time of a test or None if the test has not been
+        run.'''
+        durations = self.durations(bsp, executable)
+        if len(durations) == 0:
+            return None
+        return sum(durations) / len(durations)
+
+    def percentile(self, bsp, executable, percent):
+        '''The run time the percentage of the recorded runs of a test took no
+        longer than, or None if the test has not been run.'''
+        durations = sorted(self.durations(bsp, executable))
+        if len(durations) == 0:
+            return None
+        rank = int(math.ceil(percent * len(durations) / 100.0))
+        return durations[min(max(rank, 1), len(durations)) - 1]
+
+    def deadline(self, bsp, executable, percent, factor, floor, limit):
+        '''An adaptive timeout in seconds for a test. It is the percentile of
+        the test's run times scaled by the factor plus the floor and is no
+        longer than the limit. None is returned if the test has not been
+        run.'''
+        run_time = self.percentile(bsp, executable, percent)
+        if run_time is None:
+            return None
+        return min(limit, int(math.ceil(run_time * factor + floor)))
+
+    def longest_first(self, tests):
+        '''Return the indexes of the tests, a list of BSP and executable
+        pairs, ordered longest expected run time first. Tests without a
+        history are given the average of the tests that have one. The order is
+        unchanged if there is no history.'''
+        expected = [self.expected(bsp, e) for bsp, e in tests]
+        known = [e for e in expected if e is not None]
+        order = list(range(0, len(tests)))
+        if len(known) == 0:
+            return order
+        average = sum(known) / len(known)
+        expected = [average if e is None else e for e in expected]
+        return sorted(order, key = lambda i: -expected[i])
+
+    def shard(self, tests, index, count):
+        '''Return the indexes of the tests, a list of BSP and executable
+        pairs, in shard index of count shards. The split is balanced by the
+        expected run times if there is a history, otherwise by the number of
+        tests. The split only depends on the tests and the history so each
+        shard given the same history selects a different part of the same
+        split.'''
+        expected = [self.expected(bsp, e) for bsp, e in tests]
+        known = [e for e in expected if e is not None]
+        if len(known) == 0:
+            return [i for i in range(0, len(tests)) if i % count == index - 1]
+        average = sum(known) / len(known)
+        expected = [average if e is None else e for e in expected]
+        loads = [0.0] * count
+        shards = [[] for s in range(0, count)]
+        for i in sorted(range(0, len(tests)), key = lambda i: (-expected[i], i)):
+            s = loads.index(min(loads))
+            loads[s] += expected[i]
+            shards[s] += [i]
+        return sorted(shards[index - 1])
+
+def _check_shards():
+    '''Check the shards of a split cover every test once with and without a
+    history.'''
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp(prefix = 'rtems-test-history-')
+    try:
+        h = history(path.join(tmpdir, 'history.json'))
+        tests = [('sis', 't%02d.exe' % (i)) for i in range(0, 14)]
+        for timed in [False, True]:
+            if timed:
+                for bsp, exe in tests[:10]:
+                    h.add(bsp, exe, float(len(tests) - int(exe[1:3])))
+            for count in range(1, 6):
+                selected = []
+                for index in range(1, count + 1):
+                    selected += h.shard(tests, index, count)
+                if sorted(selected) != list(range(0, len(tests))):
+                    raise error.internal('shards do not cover the tests: %d: %r' % \
+                                         (count, sorted(selected)))
+        print('history: shards: ok')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 1:
+        _check_shards()
+        sys.exit(0)
+    if len(sys.argv) != 2:
+        print('usage: history.py [history-file]')
+        sys.exit(1)
+    h = history(sys.argv[1])
+    for bsp in sorted(h.times):
+        print('%s:' % (bsp))
+        for exe in sorted(h.times[bsp]):
+            print(' %-30s %8.3f (%d)' % (exe,
+                                         h.expected(bsp, exe),
+                                         len(h.durations(bsp, exe))))
@@ -0,0 +1,296 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Incremental Test Results
+#
+
+import copy
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from rtemstoolkit import config
+from rtemstoolkit import error
+from rtemstoolkit import log
+from rtemstoolkit import path
+from rtemstoolkit import version
+
+import remote
+
+#
+# The macros that change how a run is made and not how a test is run. They are
+# not part of a cache key.
+#
+_run_macros = ['_cwd', '_jobs', '_ncpus', '_smp_mflags',
+               'jobs_interval', 'jobs_max', 'jobs_min', 'jobs_reserve',
+               'spool_excerpt', 'status_interval',
+               'test_cache', 'test_cache_size', 'test_history']
+
+def size_value(value):
+    '''Convert a size with an optional K, M or G suffix to bytes.'''
+    scales = { 'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024 }
+    value = value.strip()
+    scale = 1
+    if len(value) and value[-1].lower() in scales:
+        scale = scales[value[-1].lower()]
+        value = value[:-1]
+    try:
+        size = int(value) * scale
+    except ValueError:
+        raise error.general('invalid size: %s' % (value))
+    if size < 0:
+        raise error.general('invalid size: %s' % (value))
+    return size
+
+class cache(object):
+    '''A cache of the tests that have passed. An entry's key is a hash of the
+    executable's contents, the BSP's configuration and the tools so a test is
+    only skipped if nothing it depends on has changed. The oldest entries are
+    removed when the cache is larger than the maximum size.'''
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        if not path.isdir(self.name):
+            try:
+                path.mkdir(self.name)
+            except error.general as gerr:
+                raise error.general('creating test cache: %s' % (str(gerr)))
+
+    def _entry(self, key):
+        return path.join(self.name, key + '.json')
+
+    def bsp(self, br, rtems_tools):
+        '''Return the cached results for the tests of a BSP run.'''
+        opts = br.opts
+        h = hashlib.sha256()
+        h.update(version.str())
+        h.update(br.name)
+        h.update('rtems_tools:%s' % (opts.defaults.expand(rtems_tools)))
+        #
+        # The BSP's configuration is the expanded macros the BSP's tests see
+        # and the text of the script and every file it includes. A macro that
+        # depends on the test being run cannot be expanded and its raw value
+        # is used.
+        #
+        for k in opts.defaults.keys():
+            if k in _run_macros or k.startswith('_local_git'):
+                continue
+            try:
+                value = opts.defaults.expand(opts.defaults[k])
+            except error.general:
+                value = opts.defaults[k]
+            h.update('%s:%s\n' % (k, value))
+        try:
+            cfg = config.file(br.config, opts, macros = copy.copy(opts.defaults))
+            for name in cfg.files(br.config):
+                cf = open(path.host(name), 'r')
+                try:
+                    h.update('%s:%s' % (name, cf.read()))
+                finally:
+                    cf.close()
+        except IOError as err:
+            raise error.general('reading BSP config: %s: %s' % (br.config, str(err)))
+        except error.general as gerr:
+            raise error.general('reading BSP config: %s: %s' % (br.config, str(gerr).strip()))
+        #
+        # The tools are identified by the size and modification time of the
+        # programs in the tools' bin directory.
+        #
+        tools_bin = path.join(opts.defaults.expand(rtems_tools), 'bin')
+        if path.isdir(tools_bin):
+            for f in sorted(os.listdir(path.host(tools_bin))):
+                try:
+                    st = os.stat(path.host(path.join(tools_bin, f)))
+                except OSError:
+                    continue
+                h.update('%s:%d:%d' % (f, st.st_size, int(st.st_mtime)))
+        return results(self, br.name,
+                       opts.defaults.expand('%%{%s_arch}' % (br.bsp)),
+                       h.hexdigest())
+
+    def get(self, key):
+        entry = None
+        name = self._entry(key)
+        try:
+            ef = open(path.host(name), 'r')
+            try:
+                entry = json.load(ef)
+            finally:
+                ef.close()
+            os.utime(path.host(name), None)
+        except (IOError, OSError, ValueError):
+            entry = None
+        self.lock.acquire()
+        try:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+        return entry
+
+    def put(self, key, entry):
+        name = self._entry(key)
+        tmp = '%s.%d.tmp' % (name, threading.current_thread().ident)
+        try:
+            ef = open(path.host(tmp), 'w')
+            try:
+                json.dump(entry, ef)
+            finally:
+                ef.close()
+            os.rename(path.host(tmp), path.host(name))
+        except (IOError, OSError) as err:
+            log.warning('test cache: %s: %s' % (name, str(err)))
+            return
+        self.lock.acquire()
+        try:
+            self.stores += 1
+        finally:
+            self.lock.release()
+
+    def prune(self):
+        '''Remove the least recently used entries until the cache is no larger
+        than the maximum size.'''
+        entries = []
+        size = 0
+        for f in os.listdir(path.host(self.name)):
+            if f.endswith('.json'):
+                try:
+                    st = os.stat(path.host(path.join(self.name, f)))
+                except OSError:
+                    continue
+                entries += [(st.st_mtime, st.st_size, f)]
+                size += st.st_size
+        removed = 0
+        for mtime, fsize, f in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path.host(path.join(self.name, f)))
+                size -= fsize
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+class results(object):
+    '''The cached results of a BSP's tests.'''
+
+    def __init__(self, store, name, bsp_arch, context):
+        self.store = store
+        self.name = name
+        self.bsp_arch = bsp_arch
+        self.context = context
+        self.lock = threading.Lock()
+        self.keys = {}
+
+    def _key(self, executable):
+        self.lock.acquire()
+        try:
+            if executable in self.keys:
+                return self.keys[executable]
+        finally:
+            self.lock.release()
+        h = hashlib.sha256()
+        h.update(self.context)
+        h.update(path.basename(executable))
+        h.update(remote.executable_hash(executable))
+        key = h.hexdigest()
+        self.lock.acquire()
+        try:
+            self.keys[executable] = key
+        finally:
+            self.lock.release()
+        return key
+
+    def replay(self, tst):
+        '''Report the test as a cached pass if it has passed before. Returns
+        True if the test was reported.'''
+        entry = self.store.get(self._key(tst.executable))
+        if entry is None:
+            return False
+        output = [(str(l[0]), str(l[1])) for l in entry['output']]
+        tst.report.start(tst.index, tst.total, tst.executable, tst.executable,
+                         self.bsp_arch, tst.bsp)
+        tst.report.end(tst.executable, output, cached = True)
+        return True
+
+    def save(self, tst):
+        '''Add the test to the cache if it passed.'''
+        tst.report.lock.acquire()
+        try:
+            if tst.executable not in tst.report.results:
+                return
+            result = tst.report.results[tst.executable]
+            if result['result'] != 'passed' or result['cached']:
+                return
+            elapsed = result['end'] - result['start']
+        finally:
+            tst.report.lock.release()
+        output = [(l[0], l[2:]) for l in tst.report.lines(tst.executable)]
+        self.store.put(self._key(tst.executable),
+                       { 'bsp': self.name,
+                         'executable': path.basename(tst.executable),
+                         'date': datetime.datetime.now().isoformat(),
+                         'time': elapsed.days * 86400 + elapsed.seconds + \
+                                 elapsed.microseconds / 1000000.0,
+                         'output': output })
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 2:
+        print('usage: incremental.py cache-dir')
+        sys.exit(1)
+    c = cache(sys.argv[1], 0)
+    size = 0
+    for f in sorted(os.listdir(path.host(c.name))):
+        if f.endswith('.json'):
+            try:
+                ef = open(path.host(path.join(c.name, f)), 'r')
+                try:
+                    entry = json.load(ef)
+                finally:
+                    ef.close()
+            except (IOError, ValueError):
+                continue
+            size += os.path.getsize(path.host(path.join(c.name, f)))
+            print('%s %-12s %-30s %8.3f %s' % (f[:12], entry['bsp'],
+                                               entry['executable'],
+                                               entry['time'], entry['date']))
+    print('size: %d' % (size))
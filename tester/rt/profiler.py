@@ -0,0 +1,164 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Harness Profiler
+#
+
+import csv
+import json
+import threading
+import time
+
+from rtemstoolkit import error
+from rtemstoolkit import log
+from rtemstoolkit import path
+
+#
+# The phases of a test in the order they happen. The simulator phase is the
+# time the simulator or target runs. The capture phase is the time spent
+# handling the output and happens while the simulator runs so it is not part
+# of the test's wall time.
+#
+test_phases = ['dispatch',
+               'options',
+               'config',
+               'parse',
+               'report-start',
+               'spawn',
+               'simulator',
+               'reap',
+               'report-end',
+               'finish']
+
+harness_phases = [p for p in test_phases if p != 'simulator']
+
+class phases(object):
+    '''The times of the phases of a test. A phase is marked when it ends and
+    the time since the last mark is added to it.'''
+
+    def __init__(self, start = None):
+        if start is None:
+            start = time.time()
+        self.lock = threading.Lock()
+        self.start = start
+        self.last = start
+        self.times = {}
+
+    def mark(self, phase, now = None):
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.times[phase] = self.times.get(phase, 0.0) + now - self.last
+            self.last = now
+        finally:
+            self.lock.release()
+
+    def add(self, phase, seconds):
+        self.lock.acquire()
+        try:
+            self.times[phase] = self.times.get(phase, 0.0) + seconds
+        finally:
+            self.lock.release()
+
+    def total(self):
+        return self.last - self.start
+
+class profile(object):
+    '''Collect the phases of the tests in a run.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tests = []
+
+    def add(self, bsp, executable, test_phases):
+        self.lock.acquire()
+        try:
+            self.tests += [(bsp, executable, test_phases)]
+        finally:
+            self.lock.release()
+
+    def _rows(self):
+        rows = []
+        for bsp, exe, tp in self.tests:
+            row = { 'bsp': bsp,
+                    'executable': exe,
+                    'total': tp.total() }
+            for phase in test_phases + ['capture']:
+                row[phase] = tp.times.get(phase, 0.0)
+            rows += [row]
+        return rows
+
+    def save(self, name):
+        '''Save the phases of each test as CSV if the file name ends in .csv
+        else as JSON.'''
+        columns = ['bsp', 'executable', 'total'] + test_phases + ['capture']
+        try:
+            pf = open(path.host(name), 'w')
+            try:
+                if name.endswith('.csv'):
+                    w = csv.writer(pf)
+                    w.writerow(columns)
+                    for row in self._rows():
+                        w.writerow([row[c] for c in columns])
+                else:
+                    json.dump({ 'phases': test_phases + ['capture'],
+                                'tests': self._rows() },
+                              pf, sort_keys = True, indent = 2)
+            finally:
+                pf.close()
+        except IOError as err:
+            raise error.general('profile: %s: %s' % (name, str(err)))
+
+    def summary(self):
+        '''Log a table of the total and average time of each phase and the
+        harness overhead against the simulator time.'''
+        count = len(self.tests)
+        if count == 0:
+            return
+        totals = {}
+        for bsp, exe, tp in self.tests:
+            for phase in tp.times:
+                totals[phase] = totals.get(phase, 0.0) + tp.times[phase]
+        wall = sum([tp.total() for bsp, exe, tp in self.tests])
+        log.notice('Profile of %d test(s):' % (count))
+        log.notice(' %-14s %12s %12s %7s' % ('Phase', 'Total (s)', 'Mean (ms)', 'Wall'))
+        for phase in test_phases + ['capture']:
+            t = totals.get(phase, 0.0)
+            if wall > 0.0:
+                share = '%6.1f%%' % (t * 100.0 / wall)
+            else:
+                share = '     -'
+            log.notice(' %-14s %12.3f %12.1f %7s' % (phase, t, t * 1000.0 / count, share))
+        harness = sum([totals.get(p, 0.0) for p in harness_phases])
+        simulator = totals.get('simulator', 0.0)
+        log.notice(' Harness overhead: %.3fs (%.1f ms/test), simulator: %.3fs (%.1f ms/test)' % \
+                   (harness, harness * 1000.0 / count, simulator, simulator * 1000.0 / count))
@@ -0,0 +1,486 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing QEMU Instances
+#
+
+import os
+import Queue
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from rtemstoolkit import error
+from rtemstoolkit import execute
+from rtemstoolkit import path
+
+import remote
+
+#
+# Seconds to wait for QEMU to stop after the end of a test is seen on the
+# console.
+#
+end_grace = 1.0
+
+class monitor(object):
+    '''A QEMU Machine Protocol (QMP) client. The address is unix:path or
+    [host:]port. The replies to commands are returned and the events QEMU sends
+    are passed to the event handler.'''
+
+    def __init__(self, address, event = None, trace = False):
+        self.address = address
+        self.event = event
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.replies = Queue.Queue()
+        self.channel = None
+        self.reader = None
+        self.greeting = None
+
+    def _connect(self):
+        if self.address.startswith('unix:'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            addr = self.address[len('unix:'):]
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addr = remote.address(self.address, 'localhost')
+        try:
+            sock.connect(addr)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _reader(self):
+        while True:
+            try:
+                msg = self.channel.recv()
+            except:
+                msg = None
+            if msg is None:
+                self.replies.put(None)
+                break
+            if self.trace:
+                print('qmp <<<', msg)
+            if 'event' in msg:
+                if self.event:
+                    self.event(msg)
+            else:
+                self.replies.put(msg)
+
+    def open(self, timeout = 10):
+        '''Connect to QEMU. QEMU creates the monitor socket after it starts so
+        keep trying until the timeout.'''
+        end = time.time() + timeout
+        while True:
+            try:
+                sock = self._connect()
+                break
+            except socket.error as serr:
+                if time.time() > end:
+                    raise error.general('qemu monitor: %s: %s' % (self.address,
+                                                                  str(serr)))
+                time.sleep(0.1)
+        self.channel = remote.channel(sock)
+        self.greeting = self.channel.recv()
+        if self.greeting is None or 'QMP' not in self.greeting:
+            self.channel.close()
+            raise error.general('qemu monitor: %s: no greeting' % (self.address))
+        self.reader = threading.Thread(target = self._reader,
+                                       name = 'qmp[%s]' % (self.address))
+        self.reader.daemon = True
+        self.reader.start()
+        self.command('qmp_capabilities')
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            if self.reader is not None:
+                self.reader.join(5)
+            self.channel = None
+
+    def command(self, name, arguments = None, timeout = 10):
+        msg = { 'execute': name }
+        if arguments:
+            msg['arguments'] = arguments
+        self.lock.acquire()
+        try:
+            if self.channel is None:
+                raise error.general('qemu monitor: not connected')
+            if self.trace:
+                print('qmp >>>', msg)
+            try:
+                self.channel.send(msg)
+            except socket.error as serr:
+                raise error.general('qemu monitor: %s: %s' % (name, str(serr)))
+            try:
+                reply = self.replies.get(timeout = timeout)
+            except Queue.Empty:
+                raise error.general('qemu monitor: %s: no reply' % (name))
+        finally:
+            self.lock.release()
+        if reply is None:
+            raise error.general('qemu monitor: %s: closed' % (name))
+        if 'error' in reply:
+            raise error.general('qemu monitor: %s: %s' % (name,
+                                                          reply['error'].get('desc')))
+        return reply.get('return')
+
+    def hmp(self, command_line):
+        '''Run a human monitor command and return its output.'''
+        return self.command('human-monitor-command',
+                            { 'command-line': command_line })
+
+class instance(object):
+    '''A QEMU process that runs one test after another. QEMU starts stopped
+    with no kernel. Each test's executable is loaded with a loader device and
+    the machine is reset and continued. The test ends when the machine shuts
+    down or the end pattern is seen on the console.'''
+
+    def __init__(self, command, end, trace = False):
+        self.command = command
+        self.end = re.compile(end)
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.ended = threading.Event()
+        self.process = None
+        self.monitor = None
+        self.thread = None
+        self.tmpdir = None
+        self.output_to = None
+        self.end_seen = None
+        self.timer = None
+        self.failed = False
+        self.loader = None
+        self.loads = 0
+
+    def _run(self, cmds):
+        try:
+            self.process.open(cmds)
+        except:
+            pass
+        self.lock.acquire()
+        try:
+            self.failed = True
+        finally:
+            self.lock.release()
+        self.ended.set()
+
+    def _output(self, text):
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.touch()
+            if self.output_to:
+                self.output_to(text)
+            if self.end_seen is None and self.end.search(text):
+                self.end_seen = time.time()
+        finally:
+            self.lock.release()
+
+    def _event(self, msg):
+        if msg['event'] == 'SHUTDOWN':
+            self.ended.set()
+
+    def start(self, timeout = 10):
+        '''Start QEMU and connect to its monitor. Returns False if QEMU did not
+        start.'''
+        self.tmpdir = tempfile.mkdtemp(prefix = 'rtems-qemu-')
+        qmp = path.join(self.tmpdir, 'qmp')
+        cmds = self.command + ['-S', '-no-shutdown',
+                               '-qmp', 'unix:%s,server,nowait' % (qmp)]
+        self.process = execute.execute(output = self._output)
+        self.thread = threading.Thread(target = self._run,
+                                       name = 'qemu[%s]' % (path.basename(self.command[0])),
+                                       args = (cmds,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.monitor = monitor('unix:%s' % (qmp), event = self._event,
+                               trace = self.trace)
+        try:
+            self.monitor.open(timeout)
+        except error.general:
+            self.close()
+            return False
+        return True
+
+    def alive(self):
+        self.lock.acquire()
+        try:
+            return not self.failed
+        finally:
+            self.lock.release()
+
+    def load(self, executable):
+        '''Load an executable and start it. An error is raised if the monitor
+        cannot load it.'''
+        self.lock.acquire()
+        try:
+            self.end_seen = None
+            self.ended.clear()
+            self.loads += 1
+        finally:
+            self.lock.release()
+        self.monitor.command('stop')
+        if self.loader is not None:
+            self.monitor.command('device_del', { 'id': self.loader })
+            self.loader = None
+        loader = 'rtems-loader-%d' % (self.loads)
+        self.monitor.command('device_add', { 'driver': 'loader',
+                                             'id': loader,
+                                             'file': executable,
+                                             'cpu-num': 0 })
+        self.loader = loader
+        self.monitor.command('system_reset')
+        self.monitor.command('cont')
+
+    def run(self, executable, output, timeout = 300):
+        '''Run an executable. Returns False if the executable could not be
+        loaded and the test has not run.'''
+        def _timeout():
+            output('*** TIMEOUT TIMEOUT')
+            self.kill()
+        timer = None
+        if timeout:
+            timer = execute.timers.add(_timeout,
+                                       deadline = time.time() + timeout,
+                                       idle = timeout)
+        self.lock.acquire()
+        try:
+            self.output_to = output
+            self.timer = timer
+        finally:
+            self.lock.release()
+        try:
+            try:
+                self.load(executable)
+            except error.general:
+                self.kill()
+                return False
+            while not self.ended.is_set():
+                self.ended.wait(0.25)
+                if timer is not None and timer.fired:
+                    break
+                self.lock.acquire()
+                try:
+                    now = time.time()
+                    end_seen = self.end_seen
+                finally:
+                    self.lock.release()
+                if end_seen is not None and now - end_seen > end_grace:
+                    break
+            if self.alive():
+                try:
+                    self.monitor.command('stop')
+                except error.general:
+                    self.kill()
+        finally:
+            if timer is not None:
+                execute.timers.cancel(timer)
+            self.lock.acquire()
+            try:
+                self.output_to = None
+                self.timer = None
+            finally:
+                self.lock.release()
+        return True
+
+    def kill(self):
+        self.lock.acquire()
+        try:
+            self.failed = True
+        finally:
+            self.lock.release()
+        if self.process is not None:
+            self.process.kill()
+
+    def close(self):
+        if self.monitor is not None:
+            if self.alive():
+                try:
+                    self.monitor.command('quit')
+                except error.general:
+                    pass
+            self.monitor.close()
+        if self.thread is not None:
+            self.thread.join(5)
+            if self.thread.is_alive():
+                self.kill()
+                self.thread.join(5)
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors = True)
+            self.tmpdir = None
+
+class instance_pool(object):
+    '''A pool of idle QEMU instances. An instance is only used by one test at a
+    time so there is an instance for each job slot running tests. If a QEMU
+    command cannot load a test its instances are not used again.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.failed = set()
+        self.enabled = True
+
+    def usable(self, command):
+        self.lock.acquire()
+        try:
+            return self.enabled and tuple(command) not in self.failed
+        finally:
+            self.lock.release()
+
+    def acquire(self, command, end, trace = False):
+        key = tuple(command)
+        self.lock.acquire()
+        try:
+            if key in self.idle and len(self.idle[key]) > 0:
+                return self.idle[key].pop()
+        finally:
+            self.lock.release()
+        i = instance(command, end, trace = trace)
+        if not i.start():
+            self.fail(i)
+            return None
+        return i
+
+    def release(self, i):
+        if not i.alive():
+            i.close()
+            return
+        key = tuple(i.command)
+        self.lock.acquire()
+        try:
+            if key not in self.idle:
+                self.idle[key] = []
+            self.idle[key] += [i]
+        finally:
+            self.lock.release()
+
+    def fail(self, i):
+        self.lock.acquire()
+        try:
+            self.failed.add(tuple(i.command))
+        finally:
+            self.lock.release()
+        i.close()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for key in idle:
+            for i in idle[key]:
+                i.close()
+
+#
+# The instances of this process.
+#
+instances = instance_pool()
+
+if __name__ == "__main__":
+    #
+    # Check the monitor protocol against a fake QMP server.
+    #
+    import json
+    class fake_qmp(object):
+        def __init__(self):
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind(('127.0.0.1', 0))
+            self.server.listen(1)
+            self.port = self.server.getsockname()[1]
+            self.commands = []
+            self.thread = threading.Thread(target = self._serve)
+            self.thread.daemon = True
+            self.thread.start()
+        def _send(self, f, msg):
+            f.write(json.dumps(msg) + '\r\n')
+            f.flush()
+        def _serve(self):
+            sock, addr = self.server.accept()
+            f = sock.makefile('rw')
+            self._send(f, { 'QMP': { 'version': {}, 'capabilities': [] } })
+            while True:
+                line = f.readline()
+                if len(line) == 0:
+                    break
+                msg = json.loads(line)
+                self.commands += [msg['execute']]
+                if msg['execute'] == 'device_add' and \
+                   msg['arguments']['file'] == 'missing.exe':
+                    self._send(f, { 'error': { 'class': 'GenericError',
+                                               'desc': 'missing.exe: not found' } })
+                elif msg['execute'] == 'human-monitor-command':
+                    self._send(f, { 'return': 'ran: %s\r\n' % (msg['arguments']['command-line']) })
+                elif msg['execute'] == 'cont':
+                    self._send(f, { 'timestamp': {}, 'event': 'RESUME' })
+                    self._send(f, { 'return': {} })
+                    self._send(f, { 'timestamp': {}, 'event': 'SHUTDOWN' })
+                elif msg['execute'] == 'quit':
+                    self._send(f, { 'return': {} })
+                    break
+                else:
+                    self._send(f, { 'return': {} })
+            sock.close()
+    events = []
+    def event(msg):
+        events.append(msg['event'])
+    server = fake_qmp()
+    m = monitor('localhost:%d' % (server.port), event = event)
+    m.open()
+    print('greeting: %s' % (str(m.greeting)))
+    m.command('stop')
+    m.command('device_add', { 'driver': 'loader', 'id': 'l1', 'file': 'hello.exe' })
+    m.command('system_reset')
+    m.command('cont')
+    print('hmp: %s' % (m.hmp('info status').strip()))
+    try:
+        m.command('device_add', { 'driver': 'loader', 'id': 'l2', 'file': 'missing.exe' })
+        print('error not raised')
+        sys.exit(1)
+    except error.general as gerr:
+        print(str(gerr))
+    m.command('quit')
+    m.close()
+    print('commands: %s' % (', '.join(server.commands)))
+    print('events: %s' % (', '.join(events)))
+    if events != ['RESUME', 'SHUTDOWN'] or \
+       server.commands != ['qmp_capabilities', 'stop', 'device_add', 'system_reset',
+                           'cont', 'human-monitor-command', 'device_add', 'quit']:
+        print('monitor check failed')
+        sys.exit(1)
+    print('monitor check passed')
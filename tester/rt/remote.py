@@ -0,0 +1,579 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Remote Workers
+#
+# A coordinator hands tests to workers on other hosts. A worker connects to
+# the coordinator over TCP, pulls tests and runs them, and sends the report
+# calls the test makes back to the coordinator. The messages are JSON
+# objects, one per line.
+#
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import Queue
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from rtemstoolkit import error
+from rtemstoolkit import log
+from rtemstoolkit import path
+
+try:
+    _unicode = unicode
+except NameError:
+    _unicode = str
+
+#
+# The default port the coordinator listens on.
+#
+default_port = 4580
+
+#
+# The host the coordinator listens on if the address does not have one. A
+# worker on another host needs the coordinator to be given an address other
+# hosts can reach.
+#
+default_host = '127.0.0.1'
+
+#
+# The environment variable holding the token workers give the coordinator if
+# there is no --remote-token option.
+#
+token_env = 'RTEMS_TEST_TOKEN'
+
+def _same_token(left, right):
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(left, right)
+    return left == right
+
+def _native(data):
+    '''JSON strings are unicode and the macros need native strings.'''
+    if type(data) is dict:
+        return dict([(_native(k), _native(v)) for k, v in data.items()])
+    if type(data) is list:
+        return [_native(d) for d in data]
+    if type(data) is _unicode and _unicode is not str:
+        return data.encode('utf-8')
+    return data
+
+def _printable(data):
+    '''Replace any bytes that are not UTF-8 so the data can be encoded.'''
+    if type(data) is dict:
+        return dict([(k, _printable(v)) for k, v in data.items()])
+    if type(data) in [list, tuple]:
+        return [_printable(d) for d in data]
+    if type(data) is str and _unicode is not str:
+        return data.decode('utf-8', 'replace')
+    return data
+
+def address(addr, host = ''):
+    '''Split an address of the form [host:]port.'''
+    if ':' in addr:
+        host, port = addr.rsplit(':', 1)
+    else:
+        port = addr
+    try:
+        port = int(port)
+    except:
+        raise error.general('invalid port: %s' % (addr))
+    return host, port
+
+def executable_hash(name):
+    h = hashlib.sha256()
+    ef = open(path.host(name), 'rb')
+    try:
+        while True:
+            data = ef.read(1024 * 1024)
+            if len(data) == 0:
+                break
+            h.update(data)
+    finally:
+        ef.close()
+    return h.hexdigest()
+
+class channel(object):
+    '''A JSON message channel over a socket.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('r')
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        try:
+            data = json.dumps(msg)
+        except UnicodeDecodeError:
+            data = json.dumps(_printable(msg))
+        self.lock.acquire()
+        try:
+            self.sock.sendall((data + '\n').encode('utf-8'))
+        finally:
+            self.lock.release()
+
+    def recv(self):
+        line = self.reader.readline()
+        if len(line) == 0:
+            return None
+        try:
+            return _native(json.loads(line))
+        except ValueError:
+            raise error.general('remote: invalid message')
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+class coordinator(object):
+    '''Hand tests to the workers that connect. A worker asks for as many tests
+    as it has jobs. The report calls a worker sends back are made on the
+    test's report. The BSP runs are used to find the name of the BSP a test
+    is for so the worker can load the same BSP. If there is a token a worker
+    that does not give it is closed.'''
+
+    def __init__(self, addr, bsp_runs, trace = False, token = None):
+        self.bsp_runs = bsp_runs
+        self.trace = trace
+        self.token = token
+        self.lock = threading.Lock()
+        self.work = Queue.Queue()
+        self.running = {}
+        self.workers = []
+        self.senders = []
+        self.key = 0
+        self.closing = False
+        host, port = address(addr)
+        if len(host) == 0:
+            host = default_host
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.server.bind((host, port))
+        except socket.error as serr:
+            raise error.general('remote: listen: %s: %s' % (addr, str(serr)))
+        self.server.listen(16)
+        log.notice('Coordinator listening on %s:%d' % (host, port))
+        if not token and host not in ['127.0.0.1', 'localhost', '::1']:
+            log.warning('remote: no token, any host that can connect to %s:%d ' \
+                        'can run tests and fetch the executables' % (host, port))
+        self.listener = threading.Thread(target = self._accept,
+                                         name = 'remote[listen]')
+        self.listener.daemon = True
+        self.listener.start()
+
+    def _accept(self):
+        while not self.closing:
+            try:
+                sock, addr = self.server.accept()
+            except socket.error:
+                break
+            t = threading.Thread(target = self._worker,
+                                 name = 'remote[%s:%d]' % (addr[0], addr[1]),
+                                 args = (sock, addr))
+            t.daemon = True
+            t.start()
+
+    def _bsp_name(self, tst):
+        for br in self.bsp_runs:
+            if br.opts is tst.opts:
+                return br.name
+        raise error.internal('remote: test BSP not found')
+
+    def _item(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.running:
+                return self.running[key]
+            return None
+        finally:
+            self.lock.release()
+
+    def _worker(self, sock, addr):
+        ch = channel(sock)
+        name = '%s:%d' % (addr[0], addr[1])
+        try:
+            hello = ch.recv()
+            if hello is None or hello.get('op') != 'hello':
+                ch.close()
+                return
+            if self.token and \
+                    not _same_token(str(hello.get('token', '')), self.token):
+                log.warning('remote: worker rejected, invalid token: %s' % (name))
+                ch.send({ 'op': 'exit', 'error': 'invalid token' })
+                ch.close()
+                return
+            jobs = int(hello.get('jobs', 1))
+            name = '%s (%s)' % (hello.get('host', name), name)
+        except:
+            ch.close()
+            return
+        log.notice('Worker connected: %s, jobs: %d' % (name, jobs))
+        slots = threading.Semaphore(jobs)
+        inflight = []
+        self.lock.acquire()
+        self.workers += [ch]
+        self.lock.release()
+        sender = threading.Thread(target = self._sender,
+                                  name = 'remote-send[%s]' % (name),
+                                  args = (ch, slots, inflight))
+        sender.daemon = True
+        self.lock.acquire()
+        self.senders += [(slots, sender)]
+        self.lock.release()
+        sender.start()
+        try:
+            while True:
+                msg = ch.recv()
+                if msg is None:
+                    break
+                item = self._item(msg.get('id'))
+                if item is None:
+                    continue
+                tst = item['test']
+                op = msg.get('op')
+                try:
+                    if op == 'event':
+                        args = msg['args']
+                        if msg['what'] == 'start':
+                            args[2] = tst.executable
+                            args[3] = tst.executable
+                            tst.report.start(*args)
+                            item['started'] = True
+                        elif msg['what'] == 'end':
+                            args[0] = tst.executable
+                            tst.report.end(*args)
+                            item['ended'] = True
+                    elif op == 'fetch':
+                        ef = open(path.host(tst.executable), 'rb')
+                        try:
+                            data = base64.b64encode(ef.read())
+                        finally:
+                            ef.close()
+                        if type(data) is not str:
+                            data = data.decode('ascii')
+                        ch.send({ 'op': 'binary', 'id': msg['id'], 'data': data })
+                    elif op == 'done':
+                        item['error'] = msg.get('error')
+                        self._done(msg['id'], inflight)
+                        slots.release()
+                except (error.general, IOError) as err:
+                    item['error'] = str(err)
+                    self._done(msg['id'], inflight)
+                    slots.release()
+        except socket.error:
+            pass
+        log.notice('Worker disconnected: %s' % (name))
+        self.lock.acquire()
+        if ch in self.workers:
+            self.workers.remove(ch)
+        lost = list(inflight)
+        del inflight[:]
+        self.lock.release()
+        for key in lost:
+            item = self._item(key)
+            if item is None:
+                continue
+            if item['started']:
+                if not item['ended']:
+                    tst = item['test']
+                    tst.report.end(tst.executable,
+                                   [('>', 'remote worker lost: %s' % (name))])
+                item['done'].set()
+            else:
+                self.work.put(key)
+        ch.close()
+
+    def _sender(self, ch, slots, inflight):
+        while not self.closing:
+            slots.acquire()
+            key = None
+            while key is None and not self.closing:
+                try:
+                    key = self.work.get(True, 1.0)
+                except Queue.Empty:
+                    pass
+            if key is None:
+                break
+            item = self._item(key)
+            if item is None:
+                slots.release()
+                continue
+            self.lock.acquire()
+            connected = ch in self.workers
+            if connected:
+                inflight += [key]
+            self.lock.release()
+            if not connected:
+                self.work.put(key)
+                break
+            try:
+                ch.send(item['msg'])
+            except socket.error:
+                self.work.put(key)
+                break
+
+    def _done(self, key, inflight):
+        self.lock.acquire()
+        try:
+            if key in inflight:
+                inflight.remove(key)
+            if key in self.running:
+                self.running[key]['done'].set()
+        finally:
+            self.lock.release()
+
+    def run(self, tst):
+        done = threading.Event()
+        msg = { 'op': 'run',
+                'bsp': self._bsp_name(tst),
+                'index': tst.index,
+                'total': tst.total,
+                'executable': tst.executable,
+                'resources': tst.allocation,
+                'deadline': tst.deadline,
+                'sha256': executable_hash(tst.executable) }
+        self.lock.acquire()
+        try:
+            self.key += 1
+            key = self.key
+            msg['id'] = key
+            item = { 'test': tst, 'msg': msg, 'done': done, 'error': None,
+                     'started': False, 'ended': False }
+            self.running[key] = item
+        finally:
+            self.lock.release()
+        try:
+            self.work.put(key)
+            while not done.wait(1.0):
+                pass
+        finally:
+            self.lock.acquire()
+            try:
+                del self.running[key]
+            finally:
+                self.lock.release()
+        if item['error'] is not None:
+            raise error.general('remote: %s' % (item['error']))
+
+    def close(self):
+        self.closing = True
+        self.lock.acquire()
+        workers = list(self.workers)
+        self.lock.release()
+        for ch in workers:
+            try:
+                ch.send({ 'op': 'exit' })
+            except socket.error:
+                pass
+        try:
+            self.server.close()
+        except socket.error:
+            pass
+        self.lock.acquire()
+        senders = list(self.senders)
+        self.lock.release()
+        for slots, sender in senders:
+            slots.release()
+            sender.join(2)
+
+    def terminate(self):
+        self.close()
+        self.lock.acquire()
+        try:
+            for key in self.running:
+                self.running[key]['error'] = 'terminated'
+                self.running[key]['done'].set()
+        finally:
+            self.lock.release()
+
+class _events(object):
+    '''Send the report calls of a test to the coordinator.'''
+
+    def __init__(self, ch):
+        self.ch = ch
+
+    def put(self, event):
+        key, what, args = event
+        self.ch.send({ 'op': 'event', 'id': key, 'what': what, 'args': args })
+
+class worker(object):
+    '''Connect to a coordinator and run the tests it sends. The runner is
+    called in a thread for each test with the test's message, the local path
+    to the executable and a report to use.'''
+
+    def __init__(self, addr, jobs, runner, forwarder, retry = 30, token = None):
+        self.host, self.port = address(addr, host = 'localhost')
+        if jobs < 1:
+            jobs = 1
+        self.jobs = jobs
+        self.runner = runner
+        self.forwarder = forwarder
+        self.retry = retry
+        self.token = token
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.disconnected = False
+        self.threads = []
+        self.tmpdir = None
+        self.ch = None
+
+    def _connect(self):
+        retry = self.retry
+        while True:
+            try:
+                sock = socket.create_connection((self.host, self.port))
+                return channel(sock)
+            except socket.error as serr:
+                retry -= 1
+                if retry <= 0:
+                    raise error.general('remote: connect: %s:%d: %s' % \
+                                        (self.host, self.port, str(serr)))
+                time.sleep(1)
+
+    def _executable(self, msg):
+        exe = msg['executable']
+        if path.isfile(exe) and executable_hash(exe) == msg['sha256']:
+            return exe, False
+        fetched = threading.Event()
+        self.lock.acquire()
+        try:
+            if self.disconnected:
+                raise error.general('coordinator disconnected: %s' % (exe))
+            self.fetching[msg['id']] = [fetched, None]
+        finally:
+            self.lock.release()
+        try:
+            self.ch.send({ 'op': 'fetch', 'id': msg['id'] })
+        except socket.error:
+            fetched.set()
+        while not fetched.wait(1.0):
+            pass
+        self.lock.acquire()
+        data = self.fetching[msg['id']][1]
+        del self.fetching[msg['id']]
+        self.lock.release()
+        if data is None:
+            raise error.general('executable not received: %s' % (exe))
+        exedir = path.join(self.tmpdir, str(msg['id']))
+        os.mkdir(path.host(exedir))
+        local = path.join(exedir, path.basename(exe))
+        ef = open(path.host(local), 'wb')
+        try:
+            ef.write(base64.b64decode(data))
+        finally:
+            ef.close()
+        return local, True
+
+    def _disconnect(self):
+        '''The coordinator has gone, fail the fetches waiting for it.'''
+        self.lock.acquire()
+        try:
+            self.disconnected = True
+            for id in self.fetching:
+                self.fetching[id][0].set()
+        finally:
+            self.lock.release()
+
+    def _test(self, msg):
+        err = None
+        local = None
+        try:
+            local, fetched = self._executable(msg)
+            self.runner(msg, local, self.forwarder(msg['id'], _events(self.ch)))
+        except error.general as gerr:
+            err = str(gerr)
+        except error.internal as ierr:
+            err = str(ierr)
+        except:
+            err = 'worker exception: %s' % (str(sys.exc_info()[1]))
+        if local is not None and fetched:
+            shutil.rmtree(path.host(path.dirname(local)), ignore_errors = True)
+        try:
+            self.ch.send({ 'op': 'done', 'id': msg['id'], 'error': err })
+        except socket.error:
+            pass
+
+    def run(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = 'rtems-test-worker-')
+        try:
+            self.ch = self._connect()
+            log.notice('Worker connected to %s:%d, jobs: %d' % \
+                       (self.host, self.port, self.jobs))
+            hello = { 'op': 'hello',
+                      'host': socket.gethostname(),
+                      'jobs': self.jobs }
+            if self.token:
+                hello['token'] = self.token
+            self.ch.send(hello)
+            try:
+                while True:
+                    msg = self.ch.recv()
+                    if msg is None:
+                        break
+                    if msg.get('op') == 'exit':
+                        if msg.get('error'):
+                            raise error.general('remote: coordinator: %s' % \
+                                                (msg['error']))
+                        break
+                    if msg.get('op') == 'run':
+                        t = threading.Thread(target = self._test,
+                                             name = 'worker[%s]' % \
+                                                 (path.basename(msg['executable'])),
+                                             args = (msg,))
+                        t.daemon = True
+                        self.threads = [th for th in self.threads if th.is_alive()]
+                        self.threads += [t]
+                        t.start()
+                    elif msg.get('op') == 'binary':
+                        self.lock.acquire()
+                        if msg['id'] in self.fetching:
+                            self.fetching[msg['id']][1] = msg['data']
+                            self.fetching[msg['id']][0].set()
+                        self.lock.release()
+            finally:
+                self._disconnect()
+            for t in self.threads:
+                t.join()
+        finally:
+            if self.ch is not None:
+                self.ch.close()
+            shutil.rmtree(self.tmpdir, ignore_errors = True)
@@ -32,25 +32,219 @@
 # RTEMS Testing Reports
 #
 
+import collections
 import datetime
+import gzip
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 import threading
 
 from rtemstoolkit import error
 from rtemstoolkit import log
 from rtemstoolkit import path
+from rtemstoolkit import version
+
+def _read_spool(name):
+    if name.endswith('.gz'):
+        sf = gzip.open(name, 'rb')
+    else:
+        sf = open(name, 'r')
+    try:
+        return [l.rstrip('\n') for l in sf]
+    finally:
+        sf.close()
+
+class output(object):
+    '''The output of a test as it is captured. The start, end, timeout and
+    overflow markers are found as lines are added. Without a spool file all
+    the lines are held in memory. With a spool file the lines are written to
+    the file and only the first and last lines are held as an excerpt.
+
+    The output can be limited to a number of bytes or lines. Once the limit is
+    reached only the last lines are kept and the lines in the middle are
+    dropped. Without a spool file the first lines are kept and the lines
+    after them are dropped when the limit is reached.'''
+
+    def __init__(self, spool = None, excerpt = 20):
+        self.spool = spool
+        self.excerpt_lines = excerpt
+        self.started = False
+        self.ended = False
+        self.timedout = False
+        self.overflowed = False
+        self.count = 0
+        self.written = 0
+        self.bytes = 0
+        self.pairs = []
+        self.tail = collections.deque(maxlen = excerpt)
+        self.max_bytes = None
+        self.max_lines = None
+        self.head_lines = excerpt
+        self.limited = False
+        self.last = None
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.file = None
+        if spool is not None:
+            try:
+                if spool.endswith('.gz'):
+                    self.file = gzip.open(spool, 'wb')
+                else:
+                    self.file = open(spool, 'w')
+            except IOError as err:
+                raise error.general('output spool: %s: %s' % (spool, str(err)))
+
+    def limit(self, max_bytes = None, max_lines = None, head = 20, tail = 20):
+        '''Limit the output to a number of bytes or lines. The head and tail
+        are the lines kept from the start and the end of the output once the
+        limit is reached. A limit of None or 0 is no limit.'''
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.head_lines = head
+        self.last = collections.deque(maxlen = tail)
+
+    def _keep(self, pair):
+        if len(self.last) == self.last.maxlen:
+            self.dropped += 1
+            self.dropped_bytes += len(self.last[0][1]) + 1
+        self.last.append(pair)
+
+    def _limit(self):
+        #
+        # The lines held after the head are the start of the lines kept
+        # from the end. A spool file has them.
+        #
+        self.limited = True
+        if self.file is None:
+            pairs = self.pairs[self.head_lines:]
+            self.pairs = self.pairs[:self.head_lines]
+            for pair in pairs:
+                self._keep(pair)
+
+    def add(self, lines):
+        for prefix, text in lines:
+            #
+            # A test ended at the limit is being killed and the output that
+            # follows is dropped.
+            #
+            if self.overflowed:
+                self.count += 1
+                self.bytes += len(text) + 1
+                self.dropped += 1
+                self.dropped_bytes += len(text) + 1
+                continue
+            if prefix == ']':
+                if text.startswith('*** '):
+                    if text[4:].startswith('END OF '):
+                        self.ended = True
+                    if text[4:].startswith('TIMEOUT TIMEOUT'):
+                        self.timedout = True
+                    elif text[4:].startswith('OVERFLOW OVERFLOW'):
+                        self.overflowed = True
+                    else:
+                        self.started = True
+            self.count += 1
+            self.bytes += len(text) + 1
+            if not self.limited and self.last is not None:
+                if (self.max_bytes and self.bytes > self.max_bytes) or \
+                   (self.max_lines and self.count > self.max_lines):
+                    self._limit()
+            if self.limited:
+                self._keep((prefix, text))
+            elif self.file is None:
+                self.pairs += [(prefix, text)]
+            else:
+                self.file.write(prefix + ' ' + text + '\n')
+                self.written += 1
+                if len(self.pairs) < self.excerpt_lines:
+                    self.pairs += [(prefix, text)]
+                else:
+                    self.tail.append((prefix, text))
+
+    def _dropped(self):
+        return '%d line(s), %d byte(s) dropped at the output limit' % \
+            (self.dropped, self.dropped_bytes)
+
+    def close(self):
+        if self.file is not None:
+            if self.limited:
+                self.file.write('... ' + self._dropped() + '\n')
+                for p, t in self.last:
+                    self.file.write(p + ' ' + t + '\n')
+            self.file.close()
+            self.file = None
+
+    def kept(self):
+        '''The lines held in memory as prefix and text pairs with the lines
+        dropped at the limit as a '...' line.'''
+        pairs = list(self.pairs)
+        if self.limited:
+            pairs += [('...', self._dropped())]
+            pairs += list(self.last)
+        return pairs
+
+    def excerpt(self):
+        '''The lines held in memory, all the lines if there is no spool
+        file.'''
+        lines = [p + ' ' + t for p, t in self.pairs]
+        if self.spool is not None:
+            skipped = self.written - len(self.pairs) - len(self.tail)
+            if skipped > 0:
+                lines += ['... %d line(s) in %s' % (skipped, self.spool)]
+            lines += [p + ' ' + t for p, t in self.tail]
+        if self.limited:
+            lines += ['... ' + self._dropped()]
+            lines += [p + ' ' + t for p, t in self.last]
+        return lines
+
+class spool(object):
+    '''A directory the output of each test is written to as it is captured.
+    A temporary directory is removed when the spool is closed.'''
+
+    def __init__(self, directory = None, compress = False, excerpt = 20):
+        if directory is None:
+            self.directory = tempfile.mkdtemp(prefix = 'rtems-test-output-')
+            self.temporary = True
+        else:
+            self.directory = directory
+            self.temporary = False
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as err:
+                    raise error.general('output spool: %s: %s' % (directory, str(err)))
+        self.compress = compress
+        self.excerpt = excerpt
+
+    def output(self, bsp, name):
+        tag = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        spool_name = '%s-%s-%s.txt' % (bsp, path.basename(name), tag)
+        if self.compress:
+            spool_name += '.gz'
+        return output(os.path.join(self.directory, spool_name), self.excerpt)
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors = True)
 
 class report(object):
-    '''RTEMS Testing report.'''
+    '''RTEMS Testing report. The output of the tests is written to the
+    spool if there is one.'''
 
-    def __init__(self, total):
+    def __init__(self, total, spool = None):
         self.lock = threading.Lock()
+        self.spool = spool
         self.total = total
         self.total_len = len(str(total))
         self.passed = 0
         self.failed = 0
         self.timeouts = 0
+        self.overflows = 0
         self.invalids = 0
+        self.cached = 0
         self.invalid_tests = 0
         self.results = {}
         self.name_max_len = 0
@@ -59,16 +253,31 @@ class report(object):
         msg  = 'Passed:   %*d%s' % (self.total_len, self.passed, os.linesep)
         msg += 'Failed:   %*d%s' % (self.total_len, self.failed, os.linesep)
         msg += 'Timeouts: %*d%s' % (self.total_len, self.timeouts, os.linesep)
+        if self.overflows:
+            msg += 'Overflow: %*d%s' % (self.total_len, self.overflows, os.linesep)
         msg += 'Invalid:  %*d%s' % (self.total_len, self.invalids, os.linesep)
         return msg
 
     def set_invalid_tests(self, invalid_tests):
         self.invalid_tests = invalid_tests
 
-    def start(self, index, total, name, executable, bsp_arch, bsp):
-        header = '[%*d/%*d] p:%-*d f:%-*d t:%-*d i:%-*d | %s/%s: %s' % \
-                 (len(str(total)), index,
-                  len(str(total)), total,
+    def set_total(self, total):
+        self.lock.acquire()
+        self.total = total
+        self.total_len = len(str(total))
+        self.lock.release()
+
+    def start(self, index, total, name, executable, bsp_arch, bsp, deadline = None):
+        #
+        # A total of 0 is not known yet because the executables are still
+        # being found.
+        #
+        if total:
+            count = '%*d/%*d' % (len(str(total)), index, len(str(total)), total)
+        else:
+            count = '%d/?' % (index)
+        header = '[%s] p:%-*d f:%-*d t:%-*d i:%-*d | %s/%s: %s' % \
+                 (count,
                   len(str(total)), self.passed,
                   len(str(total)), self.failed,
                   len(str(total)), self.timeouts,
@@ -88,26 +297,55 @@ class report(object):
                                'end': None,
                                'result': None,
                                'output': None,
+                               'spool': None,
+                               'cached': False,
+                               'deadline': deadline,
                                'header': header }
 
         self.lock.release()
         log.notice(header, stdout_only = True)
 
-    def end(self, name, output):
-        start = False
-        end = False
-        timeout = False
-        prefixed_output = []
-        for line in output:
-            if line[0] == ']':
-                if line[1].startswith('*** '):
-                    if line[1][4:].startswith('END OF '):
-                        end = True
-                    if line[1][4:].startswith('TIMEOUT TIMEOUT'):
-                        timeout = True
-                    else:
-                        start = True
-            prefixed_output += [line[0] + ' ' + line[1]]
+    def output(self, name):
+        '''Return the store for the output of a test that has started.'''
+        if self.spool is None:
+            return output()
+        self.lock.acquire()
+        try:
+            if name not in self.results:
+                raise error.general('test report missing: %s' % (name))
+            bsp = self.results[name]['bsp']
+        finally:
+            self.lock.release()
+        return self.spool.output(bsp, name)
+
+    def lines(self, name):
+        '''Return all the output of a test, reading it from the spool file if
+        it was spooled.'''
+        self.lock.acquire()
+        try:
+            if name not in self.results:
+                raise error.general('test report missing: %s' % (name))
+            spool = self.results[name].get('spool')
+            lines = self.results[name]['output']
+        finally:
+            self.lock.release()
+        if spool is not None:
+            try:
+                return _read_spool(spool)
+            except IOError:
+                pass
+        return lines
+
+    def end(self, name, test_output, cached = False):
+        if type(test_output) is list:
+            lines = test_output
+            test_output = self.output(name)
+            test_output.add(lines)
+        test_output.close()
+        start = test_output.started
+        end = test_output.ended
+        timeout = test_output.timedout
+        overflow = test_output.overflowed
         self.lock.acquire()
         if name not in self.results:
             self.lock.release()
@@ -119,6 +357,9 @@ class report(object):
         if start and end:
             status = 'passed'
             self.passed += 1
+        elif overflow:
+            status = 'overflow'
+            self.overflows += 1
         elif timeout:
             status = 'timeout'
             self.timeouts += 1
@@ -134,7 +375,11 @@ class report(object):
                 status = 'invalid'
                 self.invalids += 1
         self.results[name]['result'] = status
-        self.results[name]['output'] = prefixed_output
+        self.results[name]['output'] = test_output.excerpt()
+        self.results[name]['spool'] = test_output.spool
+        if cached:
+            self.results[name]['cached'] = True
+            self.cached += 1
         if self.name_max_len < len(path.basename(name)):
             self.name_max_len = len(path.basename(name))
         self.lock.release()
@@ -147,19 +392,28 @@ class report(object):
                 raise error.general('test report missing: %s' % (name))
             result = self.results[name]['result']
             time = self.results[name]['end'] - self.results[name]['start']
+            cached = self.results[name]['cached']
+            deadline = self.results[name]['deadline']
             if mode != 'none':
                 header = self.results[name]['header']
-            if mode == 'all' or result != 'passed':
-                output = self.results[name]['output']
+            show_output = mode == 'all' or result != 'passed'
+            self.lock.release()
+            if show_output:
+                output = self.lines(name)
             else:
                 output = None
-            self.lock.release()
             if header:
                 log.output(header)
             if output:
                 log.output(output)
             if header:
-                log.output('Result: %-10s Time: %s' % (result, str(time)))
+                if cached:
+                    log.output('Result: %-10s Time: %s (cached)' % (result, str(time)))
+                elif deadline:
+                    log.output('Result: %-10s Time: %s Deadline: %ds' % \
+                               (result, str(time), deadline))
+                else:
+                    log.output('Result: %-10s Time: %s' % (result, str(time)))
 
     def summary(self):
         def show_state(results, state, max_len):
@@ -170,9 +424,13 @@ class report(object):
         log.notice('Passed:   %*d' % (self.total_len, self.passed))
         log.notice('Failed:   %*d' % (self.total_len, self.failed))
         log.notice('Timeouts: %*d' % (self.total_len, self.timeouts))
+        if self.overflows:
+            log.notice('Overflow: %*d' % (self.total_len, self.overflows))
         log.notice('Invalid:  %*d' % (self.total_len, self.invalids))
         log.output('----------%s' % ('-' * self.total_len))
         log.notice('Total:    %*d' % (self.total_len, self.total))
+        if self.cached:
+            log.notice('Cached:   %*d' % (self.total_len, self.cached))
         log.output()
         if self.failed:
             log.output('Failures:')
@@ -180,6 +438,155 @@ class report(object):
         if self.timeouts:
             log.output('Timeouts:')
             show_state(self.results, 'timeout', self.name_max_len)
+        if self.overflows:
+            log.output('Overflows:')
+            show_state(self.results, 'overflow', self.name_max_len)
         if self.invalids:
             log.output('Invalid:')
             show_state(self.results, 'invalid', self.name_max_len)
+
+def _str(text):
+    if type(text) is not str:
+        text = text.encode('utf-8')
+    return text
+
+def _time(text):
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise error.general('invalid time in results: %s' % (text))
+
+def save(name, reports, shard = None):
+    '''Save the results of a run to a file. The reports are a list of BSP
+    name and report pairs. The results are written one test at a time so
+    only one test's output is read back from the spool at once.'''
+    bsps = []
+    for bsp_name, rep in reports:
+        results = {}
+        rep.lock.acquire()
+        try:
+            for exe in rep.results:
+                r = rep.results[exe]
+                if r['end'] is None:
+                    continue
+                results[exe] = { 'index': r['index'],
+                                 'bsp': r['bsp'],
+                                 'bsp_arch': r['bsp_arch'],
+                                 'start': r['start'].isoformat(),
+                                 'end': r['end'].isoformat(),
+                                 'result': r['result'],
+                                 'output': None,
+                                 'cached': r['cached'],
+                                 'deadline': r['deadline'],
+                                 'header': r['header'] }
+        finally:
+            rep.lock.release()
+        bsps += [(bsp_name, rep, results)]
+    tmp = name + '.tmp'
+    try:
+        rf = open(path.host(tmp), 'w')
+        try:
+            rf.write('{\n "bsps": [')
+            bsep = '\n'
+            for bsp_name, rep, results in bsps:
+                rf.write('%s  {\n   "name": %s,\n   "total": %d,\n   "results": {' % \
+                         (bsep, json.dumps(bsp_name), rep.total))
+                rsep = '\n'
+                for exe in sorted(results):
+                    results[exe]['output'] = rep.lines(exe)
+                    rf.write('%s    %s: %s' % (rsep, json.dumps(exe),
+                                               json.dumps(results[exe],
+                                                          sort_keys = True)))
+                    results[exe]['output'] = None
+                    rsep = ',\n'
+                rf.write('\n   }\n  }')
+                bsep = ',\n'
+            rf.write('\n ],\n "shard": %s,\n "version": %s\n}\n' % \
+                     (json.dumps(shard), json.dumps(version.str())))
+        finally:
+            rf.close()
+        os.rename(path.host(tmp), path.host(name))
+    except (IOError, OSError) as err:
+        raise error.general('writing results: %s: %s' % (name, str(err)))
+
+def load(names):
+    '''Load and merge the results of runs saved to files. The reports
+    returned are a list of BSP name and report pairs in the order the BSPs are
+    first found in the files.'''
+    reports = []
+    merged = {}
+    for name in names:
+        try:
+            rf = open(path.host(name), 'r')
+            try:
+                data = json.load(rf)
+            finally:
+                rf.close()
+        except (IOError, ValueError) as err:
+            raise error.general('reading results: %s: %s' % (name, str(err)))
+        if type(data) is not dict or 'bsps' not in data:
+            raise error.general('reading results: %s: invalid format' % (name))
+        for b in data['bsps']:
+            bsp_name = _str(b['name'])
+            if bsp_name not in merged:
+                merged[bsp_name] = report(0)
+                reports += [(bsp_name, merged[bsp_name])]
+            rep = merged[bsp_name]
+            rep.total += b['total']
+            for exe in b['results']:
+                r = b['results'][exe]
+                exe = _str(exe)
+                if exe in rep.results:
+                    raise error.general('test in more than one result: %s: %s' % \
+                                        (bsp_name, path.basename(exe)))
+                rep.results[exe] = { 'index': r['index'],
+                                     'bsp': _str(r['bsp']),
+                                     'bsp_arch': _str(r['bsp_arch']),
+                                     'exe': exe,
+                                     'start': _time(r['start']),
+                                     'end': _time(r['end']),
+                                     'result': _str(r['result']),
+                                     'output': [_str(l) for l in r['output']],
+                                     'spool': None,
+                                     'cached': r['cached'],
+                                     'deadline': r.get('deadline'),
+                                     'header': _str(r['header']) }
+                if r['result'] == 'passed':
+                    rep.passed += 1
+                elif r['result'] == 'failed':
+                    rep.failed += 1
+                elif r['result'] == 'timeout':
+                    rep.timeouts += 1
+                elif r['result'] == 'overflow':
+                    rep.overflows += 1
+                else:
+                    rep.invalids += 1
+                if r['cached']:
+                    rep.cached += 1
+                if rep.name_max_len < len(path.basename(exe)):
+                    rep.name_max_len = len(path.basename(exe))
+    for bsp_name, rep in reports:
+        rep.total_len = len(str(rep.total))
+    return reports
+
+class forwarder(object):
+    '''Forward the report calls a test makes to a queue. A test run in a
+    worker process reports through this to the report in the parent.'''
+
+    def __init__(self, key, queue):
+        self.key = key
+        self.queue = queue
+
+    def start(self, index, total, name, executable, bsp_arch, bsp, deadline = None):
+        self.queue.put((self.key, 'start',
+                        (index, total, name, executable, bsp_arch, bsp, deadline)))
+
+    def output(self, name):
+        return output()
+
+    def end(self, name, test_output, cached = False):
+        if type(test_output) is not list:
+            test_output = test_output.kept()
+        self.queue.put((self.key, 'end', (name, test_output, cached)))
@@ -0,0 +1,276 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Job Scheduler
+#
+
+import Queue
+import time
+
+from rtemstoolkit import error
+
+class resources(object):
+    '''Resources jobs need to hold while they run. A job names pools of
+    resource instances, for example a list of ports, and is given a free
+    instance from each pool. The instances in a pool are the pool's capacity.
+    An instance is used by one job at a time even if it is in the pools of
+    different BSPs.'''
+
+    def __init__(self):
+        self.in_use = set()
+
+    def acquire(self, pools):
+        '''Return an instance from each of the pools, a dict of pool names
+        and instances, or None if a pool has no free instance.'''
+        allocation = {}
+        for name in sorted(pools):
+            for instance in pools[name]:
+                if (name, instance) not in self.in_use:
+                    allocation[name] = instance
+                    break
+            if name not in allocation:
+                return None
+        for name in allocation:
+            self.in_use.add((name, allocation[name]))
+        return allocation
+
+    def release(self, allocation):
+        for name in allocation:
+            self.in_use.discard((name, allocation[name]))
+
+class scheduler(object):
+    '''Run jobs in a fixed number of slots. A job calls the scheduler back when
+    it finishes so the next job can be started at once rather than when a
+    poll notices the job has ended. The resources a job holds are released
+    when it finishes.'''
+
+    def __init__(self, jobs, resources = None):
+        if jobs < 1:
+            jobs = 1
+        self.jobs = jobs
+        self.limit = jobs
+        self.resources = resources
+        self.capacity = 0.0
+        self.resized = None
+        self.completions = Queue.Queue()
+        self.free = list(range(jobs - 1, -1, -1))
+        self.active = []
+        self.busy = [0.0] * jobs
+        self.started = None
+        self.finished = 0
+
+    def _completed(self, job):
+        job.slot_end = time.time()
+        self.completions.put(job)
+
+    def available(self):
+        return len(self.free) > 0 and len(self.active) < self.limit
+
+    def _capacity_mark(self):
+        if self.resized is None or self.resized < self.started:
+            return self.started
+        return self.resized
+
+    def resize(self, jobs):
+        '''Change the number of jobs that can run at once. Running jobs are not
+        stopped if there are fewer slots, the next job waits for enough of
+        them to finish.'''
+        if jobs < 1:
+            jobs = 1
+        now = time.time()
+        if self.started is not None:
+            self.capacity += self.limit * (now - self._capacity_mark())
+        self.resized = now
+        while self.jobs < jobs:
+            self.free.insert(0, self.jobs)
+            self.busy += [0.0]
+            self.jobs += 1
+        self.limit = jobs
+
+    def running(self):
+        return len(self.active)
+
+    def start(self, job, allocation = None):
+        if not self.available():
+            raise error.internal('no free job slot')
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        job.allocation = allocation
+        job.slot = self.free.pop()
+        job.slot_start = now
+        job.slot_end = None
+        self.active += [job]
+        job.run(self._completed)
+
+    def wake(self):
+        '''Return from a wait even if no job has finished.'''
+        self.completions.put(None)
+
+    def wait(self):
+        '''Block until at least one active job has finished or the scheduler
+        is woken and return the finished jobs. The wait is made in steps so
+        the user can still interrupt the main thread.'''
+        finished = []
+        woken = False
+        while len(self.active) > 0 and len(finished) == 0 and not woken:
+            try:
+                job = self.completions.get(True, 1.0)
+                if job is None:
+                    woken = True
+                else:
+                    finished += [job]
+            except Queue.Empty:
+                pass
+        while True:
+            try:
+                job = self.completions.get(False)
+                if job is not None:
+                    finished += [job]
+            except Queue.Empty:
+                break
+        for job in finished:
+            self.active.remove(job)
+            self.busy[job.slot] += job.slot_end - job.slot_start
+            self.free.append(job.slot)
+            if job.allocation is not None and self.resources is not None:
+                self.resources.release(job.allocation)
+            self.finished += 1
+        return finished
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    def utilisation(self):
+        '''The fraction of the available slot time jobs were running.'''
+        if self.started is None:
+            return 0.0
+        capacity = self.capacity + \
+                   self.limit * (time.time() - self._capacity_mark())
+        if capacity <= 0.0:
+            return 0.0
+        return sum(self.busy) / capacity
+
+    def rate(self):
+        '''The number of jobs finished per minute.'''
+        elapsed = self.elapsed()
+        if elapsed <= 0.0:
+            return 0.0
+        return self.finished * 60.0 / elapsed
+
+if __name__ == "__main__":
+    import subprocess
+    import sys
+    import threading
+
+    #
+    # Benchmark the scheduler with a fake simulator. The simulator is a
+    # Python process that sleeps for the test's run time and prints the test
+    # markers. The polling loop the tester used before is run as a
+    # reference.
+    #
+    class fake_test(object):
+        simulator = "import sys, time; " \
+                    "print('*** BEGIN OF TEST'); " \
+                    "time.sleep(float(sys.argv[1])); " \
+                    "print('*** END OF TEST')"
+
+        def __init__(self, duration):
+            self.duration = duration
+            self.thread = None
+
+        def runner(self, completed):
+            self.start = time.time()
+            subprocess.call([sys.executable, '-c', self.simulator,
+                             str(self.duration)],
+                            stdout = subprocess.PIPE)
+            self.end = time.time()
+            if completed is not None:
+                completed(self)
+
+        def run(self, completed = None):
+            self.thread = threading.Thread(target = self.runner,
+                                           args = (completed,))
+            self.thread.start()
+
+        def is_alive(self):
+            return self.thread and self.thread.is_alive()
+
+    def polled(jobs, durations):
+        tests = []
+        started = []
+        start = time.time()
+        for d in durations:
+            while len(tests) >= jobs:
+                dead = [t for t in tests if not t.is_alive()]
+                tests[:] = [t for t in tests if t not in dead]
+                if len(tests) >= jobs:
+                    time.sleep(0.250)
+            tst = fake_test(d)
+            tests += [tst]
+            started += [tst]
+            tst.run()
+        for t in tests:
+            t.thread.join()
+        elapsed = time.time() - start
+        busy = sum([t.end - t.start for t in started])
+        return elapsed, len(durations) * 60.0 / elapsed, busy / (elapsed * jobs)
+
+    def scheduled(jobs, durations):
+        s = scheduler(jobs)
+        for d in durations:
+            while not s.available():
+                s.wait()
+            s.start(fake_test(d))
+        while s.running():
+            s.wait()
+        return s.elapsed(), s.rate(), s.utilisation()
+
+    jobs = 4
+    total = 200
+    duration = 0.05
+    if len(sys.argv) > 1:
+        jobs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        total = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        duration = float(sys.argv[3])
+    durations = [duration] * total
+    print('scheduler benchmark: jobs=%d tests=%d duration=%.3fs' % \
+          (jobs, total, duration))
+    elapsed, rate, utilisation = scheduled(jobs, durations)
+    print(' event driven: time=%7.2fs tests/min=%8.1f utilisation=%5.1f%%' % \
+          (elapsed, rate, utilisation * 100.0))
+    elapsed, rate, utilisation = polled(jobs, durations)
+    print(' polled      : time=%7.2fs tests/min=%8.1f utilisation=%5.1f%%' % \
+          (elapsed, rate, utilisation * 100.0))
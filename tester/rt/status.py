@@ -0,0 +1,263 @@
+#
+# RTEMS Tools Project (http://www.rtems.org/)
+# Copyright 2015 Chris Johns (chrisj@rtems.org)
+# All rights reserved.
+#
+# This file is part of the RTEMS Tools package in 'rtems-tools'.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+#
+# RTEMS Testing Live Status
+#
+
+import datetime
+import json
+import os
+import threading
+import time
+
+try:
+    import BaseHTTPServer as http_server
+except ImportError:
+    import http.server as http_server
+
+from rtemstoolkit import error
+from rtemstoolkit import log
+from rtemstoolkit import path
+
+import remote
+
+def _duration(seconds):
+    if seconds is None:
+        return '?'
+    return str(datetime.timedelta(seconds = int(seconds)))
+
+class _handler(http_server.BaseHTTPRequestHandler):
+    '''Return the last status as JSON.'''
+
+    def do_GET(self):
+        if self.path not in ['/', '/status', '/status.json']:
+            self.send_error(404)
+            return
+        data = self.server.status.json()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+class status(object):
+    '''The live status of a test run. Every interval the running tests and
+    how long they have run, the rate tests are finishing, the predicted
+    finish time and the time each job slot has been idle are logged as a
+    status line, written to the status file and served to HTTP clients. The
+    times come from the reports and the scheduler. The status is taken in
+    the tester's main loop so the scheduler is not read by another thread, a
+    ticker wakes the main loop when a status is due. With no status line the
+    file and HTTP status are refreshed every 5 seconds.'''
+
+    def __init__(self, sched, reports, interval = 30.0,
+                 status_file = None, listen = None):
+        self.sched = sched
+        self.reports = reports
+        self.interval = interval
+        if interval > 0:
+            self.period = interval
+        else:
+            self.period = 5.0
+        self.status_file = status_file
+        self.lock = threading.Lock()
+        self.last = time.time()
+        self.current = {}
+        self.running = True
+        self.server = None
+        if listen:
+            host, port = remote.address(listen, 'localhost')
+            try:
+                self.server = http_server.HTTPServer((host, port), _handler)
+            except Exception as err:
+                raise error.general('status: listen: %s: %s' % (listen, str(err)))
+            self.server.status = self
+            self.server_thread = threading.Thread(target = self.server.serve_forever,
+                                                  name = 'status[http]')
+            self.server_thread.daemon = True
+            self.server_thread.start()
+            log.notice('Status served on http://%s:%d/status' % \
+                       (host, self.server.server_address[1]))
+        self.ticker = threading.Thread(target = self._tick,
+                                       name = 'status')
+        self.ticker.daemon = True
+        self.ticker.start()
+
+    def _tick(self):
+        while self.running:
+            time.sleep(self.period)
+            self.sched.wake()
+
+    def snapshot(self, total, finding = False):
+        '''Take the status. The total is 0 and finding is True while the
+        executables are still being found.'''
+        now = time.time()
+        elapsed = self.sched.elapsed()
+        finished = self.sched.finished
+        counts = { 'passed': 0, 'failed': 0, 'timeouts': 0,
+                   'overflows': 0, 'invalid': 0, 'cached': 0 }
+        running = []
+        starts = {}
+        for name, rpt in self.reports:
+            rpt.lock.acquire()
+            try:
+                counts['passed'] += rpt.passed
+                counts['failed'] += rpt.failed
+                counts['timeouts'] += rpt.timeouts
+                counts['overflows'] += rpt.overflows
+                counts['invalid'] += rpt.invalids
+                counts['cached'] += rpt.cached
+                for exe in rpt.results:
+                    if rpt.results[exe]['end'] is None:
+                        starts[(id(rpt), exe)] = rpt.results[exe]['start']
+            finally:
+                rpt.lock.release()
+        bsps = dict([(id(rpt), name) for name, rpt in self.reports])
+        for job in self.sched.active:
+            #
+            # A test is in its slot before it has been reported as started
+            # while its configuration is loaded.
+            #
+            key = (id(job.report), job.executable)
+            if key in starts:
+                started = starts[key]
+                state = 'running'
+            else:
+                started = datetime.datetime.fromtimestamp(job.slot_start)
+                state = 'starting'
+            running += [{ 'bsp': bsps.get(id(job.report)),
+                          'executable': job.executable,
+                          'slot': job.slot,
+                          'state': state,
+                          'started': started.isoformat(),
+                          'elapsed': (datetime.datetime.now() - started).total_seconds() }]
+        running = sorted(running, key = lambda r: r['elapsed'], reverse = True)
+        slot_status = []
+        busy = list(self.sched.busy)
+        for job in self.sched.active:
+            busy[job.slot] += now - job.slot_start
+        for slot in range(0, self.sched.jobs):
+            slot_status += [{ 'slot': slot,
+                              'busy': busy[slot],
+                              'idle': max(elapsed - busy[slot], 0.0) }]
+        if elapsed > 0.0:
+            rate = finished * 60.0 / elapsed
+        else:
+            rate = 0.0
+        eta = None
+        finish = None
+        if not finding and total > 0:
+            remaining = total - finished
+            if remaining == 0:
+                eta = 0.0
+            elif finished > 0:
+                eta = remaining * elapsed / finished
+            if eta is not None:
+                finish = (datetime.datetime.now() + \
+                          datetime.timedelta(seconds = eta)).isoformat()
+        return { 'time': datetime.datetime.now().isoformat(),
+                 'elapsed': elapsed,
+                 'total': total,
+                 'finding': finding,
+                 'finished': finished,
+                 'results': counts,
+                 'running': running,
+                 'jobs': self.sched.limit,
+                 'utilisation': self.sched.utilisation(),
+                 'rate': rate,
+                 'eta': eta,
+                 'finish': finish,
+                 'slots': slot_status }
+
+    def line(self, snapshot):
+        if snapshot['finding']:
+            count = '%d/?' % (snapshot['finished'])
+        else:
+            count = '%d/%d' % (snapshot['finished'], snapshot['total'])
+        text = 'Status: %s, %d running, %.1f tests/min, %.1f%% of %d slot(s)' % \
+               (count, len(snapshot['running']), snapshot['rate'],
+                snapshot['utilisation'] * 100.0, snapshot['jobs'])
+        if snapshot['eta'] is not None:
+            text += ', ETA %s (%s)' % (_duration(snapshot['eta']),
+                                       snapshot['finish'][11:19])
+        if len(snapshot['running']):
+            longest = snapshot['running'][0]
+            text += ', longest %s %s' % (path.basename(longest['executable']),
+                                         _duration(longest['elapsed']))
+        return text
+
+    def json(self):
+        self.lock.acquire()
+        try:
+            return json.dumps(self.current, sort_keys = True, indent = 2)
+        finally:
+            self.lock.release()
+
+    def _write(self):
+        if self.status_file:
+            tmp = self.status_file + '.tmp'
+            try:
+                sf = open(tmp, 'w')
+                try:
+                    sf.write(self.json())
+                finally:
+                    sf.close()
+                if os.name == 'nt' and os.path.exists(self.status_file):
+                    os.remove(self.status_file)
+                os.rename(tmp, self.status_file)
+            except (IOError, OSError) as err:
+                raise error.general('status: %s: %s' % (self.status_file, str(err)))
+
+    def update(self, total, finding = False, force = False):
+        '''Take the status if the period has passed.'''
+        now = time.time()
+        if not force and now - self.last < self.period:
+            return
+        self.last = now
+        snapshot = self.snapshot(total, finding)
+        self.lock.acquire()
+        try:
+            self.current = snapshot
+        finally:
+            self.lock.release()
+        self._write()
+        if self.interval > 0 and not force:
+            log.notice(self.line(snapshot), stdout_only = True)
+
+    def stop(self, total):
+        self.running = False
+        self.update(total, force = True)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
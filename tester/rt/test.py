@@ -28,14 +28,18 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import collections
 import copy
 import datetime
+import multiprocessing
 import os
+import signal
 import sys
 import threading
-import time
 
+from rtemstoolkit import cache
 from rtemstoolkit import error
+from rtemstoolkit import execute
 from rtemstoolkit import log
 from rtemstoolkit import path
 from rtemstoolkit import stacktraces
@@ -44,12 +48,22 @@ from rtemstoolkit import version
 import bsps
 import config
 import console
+import discover
+import gdb
+import governor
+import history
+import incremental
 import options
+import profiler
+import qemu
+import remote
 import report
-import fnmatch
+import scheduler
+import status
 
 class test(object):
-    def __init__(self, index, total, report, executable, rtems_tools, bsp, bsp_config, opts):
+    def __init__(self, index, total, report, executable, rtems_tools, bsp, bsp_config, opts,
+                 resources = None, deadline = None, phases = None):
         self.index = index
         self.total = total
         self.report = report
@@ -61,6 +75,14 @@ class test(object):
         self.opts.defaults['bsp'] = bsp
         self.opts.defaults['bsp_arch'] = '%%{%s_arch}' % (bsp)
         self.opts.defaults['bsp_opts'] = '%%{%s_opts}' % (bsp)
+        bound = ['test_index', 'test_total', 'test_executable']
+        if resources:
+            for name in resources:
+                self.opts.defaults['resource_%s' % (name)] = str(resources[name])
+                bound += ['resource_%s' % (name)]
+        if deadline:
+            self.opts.defaults['test_deadline'] = str(deadline)
+            bound += ['test_deadline']
         if not path.isfile(executable):
             raise error.general('cannot find executable: %s' % (executable))
         self.opts.defaults['test_executable'] = executable
@@ -69,7 +91,14 @@ class test(object):
             if not path.isdir(rtems_tools_bin):
                 raise error.general('cannot find RTEMS tools path: %s' % (rtems_tools_bin))
             self.opts.defaults['rtems_tools'] = rtems_tools_bin
-        self.config = config.file(self.report, self.bsp_config, self.opts)
+        if phases is not None:
+            phases.mark('options')
+        template = config.templates.get(self.bsp_config, bsp, self.opts,
+                                        opts, bound)
+        self.config = config.file(self.report, self.bsp_config, self.opts,
+                                  phases = phases, template = template)
+        if phases is not None:
+            phases.mark('config')
 
     def run(self):
         if self.config:
@@ -80,12 +109,17 @@ class test(object):
             self.config.kill()
 
 class test_run(object):
-    def __init__(self, index, total, report, executable, rtems_tools, bsp, bsp_config, opts):
+    def __init__(self, index, total, report, executable, rtems_tools, bsp, bsp_config, opts,
+                 pool = None, sequence = None, cached = None, deadline = None,
+                 profile = None):
         self.test = None
         self.result = None
         self.start_time = None
         self.end_time = None
         self.index = copy.copy(index)
+        if sequence is None:
+            sequence = index
+        self.sequence = sequence
         self.total = total
         self.report = report
         self.executable = copy.copy(executable)
@@ -93,24 +127,47 @@ class test_run(object):
         self.bsp = bsp
         self.bsp_config = bsp_config
         self.opts = opts
+        self.pool = pool
+        self.cached = cached
+        self.deadline = deadline
+        self.allocation = None
+        self.profile = profile
+        self.phases = None
 
-    def runner(self):
+    def runner(self, completed):
         self.start_time = datetime.datetime.now()
+        if self.phases is not None:
+            self.phases.mark('dispatch')
         try:
-            self.test = test(self.index, self.total, self.report,
-                             self.executable, self.rtems_tools,
-                             self.bsp, self.bsp_config,
-                             self.opts)
-            self.test.run()
+            if self.cached is None or not self.cached.replay(self):
+                if self.pool is not None:
+                    self.pool.run(self)
+                else:
+                    self.test = test(self.index, self.total, self.report,
+                                     self.executable, self.rtems_tools,
+                                     self.bsp, self.bsp_config,
+                                     self.opts, self.allocation,
+                                     self.deadline, self.phases)
+                    self.test.run()
+                if self.cached is not None:
+                    self.cached.save(self)
         except KeyboardInterrupt:
             pass
         except:
             self.result = sys.exc_info()
         self.end_time = datetime.datetime.now()
+        if self.phases is not None:
+            self.phases.mark('finish')
+            self.profile.add(self.bsp, self.executable, self.phases)
+        if completed is not None:
+            completed(self)
 
-    def run(self):
+    def run(self, completed = None):
+        if self.profile is not None:
+            self.phases = profiler.phases()
         self.thread = threading.Thread(target = self.runner,
-                                       name = 'test[%s]' % path.basename(self.executable))
+                                       name = 'test[%s]' % path.basename(self.executable),
+                                       args = (completed,))
         self.thread.start()
 
     def is_alive(self):
@@ -124,33 +181,305 @@ class test_run(object):
         if self.test:
             self.test.kill()
 
+#
+# The worker processes are forked from the tester so the options and event
+# queue are inherited rather than pickled.
+#
+_process_opts = None
+_process_events = None
+
+def _process_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    #
+    # An idle GDB session in a worker would stay connected to a target the
+    # tests in the other workers are given and a QEMU instance would be left
+    # running when the worker is terminated.
+    #
+    gdb.sessions.enabled = False
+    qemu.instances.enabled = False
+
+def _process_runner(key, index, total, executable, rtems_tools, bsp, bsp_config, opts,
+                    resources, deadline):
+    msg = None
+    try:
+        tst = test(index, total, report.forwarder(key, _process_events),
+                   executable, rtems_tools, bsp, bsp_config, _process_opts[opts],
+                   resources, deadline)
+        tst.run()
+    except error.general as gerr:
+        msg = str(gerr)
+    except error.internal as ierr:
+        msg = str(ierr)
+    except:
+        msg = 'worker exception: %s' % (str(sys.exc_info()[1]))
+    _process_events.put((key, 'done', (msg,)))
+
+class process_pool(object):
+    '''Run tests in a pool of worker processes. The report calls the workers
+    make are passed back and made on the test's report in this process. The
+    options are a list with an entry for each BSP being tested.'''
+
+    def __init__(self, jobs, opts):
+        global _process_opts
+        global _process_events
+        if os.name == 'nt':
+            raise error.general('process executor not supported on this host')
+        self.lock = threading.Lock()
+        self.running = {}
+        self.key = 0
+        _process_opts = opts
+        _process_events = multiprocessing.Queue()
+        self.events = _process_events
+        self.pool = multiprocessing.Pool(jobs, _process_init)
+        self.pump = threading.Thread(target = self._pump,
+                                     name = 'process-pool[events]')
+        self.pump.daemon = True
+        self.pump.start()
+
+    def _pump(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            key, what, args = event
+            self.lock.acquire()
+            try:
+                if key not in self.running:
+                    continue
+                tst, done, result = self.running[key]
+            finally:
+                self.lock.release()
+            try:
+                if what == 'start':
+                    tst.report.start(*args)
+                elif what == 'end':
+                    tst.report.end(*args)
+                elif what == 'done':
+                    result[0] = args[0]
+                    done.set()
+            except error.general as gerr:
+                result[0] = str(gerr)
+                done.set()
+
+    def run(self, tst):
+        done = threading.Event()
+        result = [None]
+        self.lock.acquire()
+        try:
+            self.key += 1
+            key = self.key
+            self.running[key] = (tst, done, result)
+        finally:
+            self.lock.release()
+        opts = [i for i in range(0, len(_process_opts)) if _process_opts[i] is tst.opts]
+        if len(opts) != 1:
+            raise error.internal('test options not found in the process pool')
+        try:
+            self.pool.apply_async(_process_runner,
+                                  (key, tst.index, tst.total, tst.executable,
+                                   tst.rtems_tools, tst.bsp, tst.bsp_config,
+                                   opts[0], tst.allocation, tst.deadline))
+            while not done.wait(1.0):
+                pass
+        finally:
+            self.lock.acquire()
+            try:
+                del self.running[key]
+            finally:
+                self.lock.release()
+        if result[0] is not None:
+            raise error.general(result[0])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.events.put(None)
+        self.pump.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.lock.acquire()
+        try:
+            for key in self.running:
+                tst, done, result = self.running[key]
+                result[0] = 'terminated'
+                done.set()
+        finally:
+            self.lock.release()
+
+class bsp_run(object):
+    '''The configuration, executables and report of a BSP being tested. The
+    BSP's macro file is loaded into a copy of the options so more than one BSP
+    can be tested in a run.
+
+    A BSP that needs exclusive resources, such as a port or a tty device,
+    lists them in the bsp_resources macro. Each line is a resource pool's name
+    and its instances, for example 'gdb_port: 1234 1235'. A test is given a
+    free instance of each pool in the resource_<name> macro. The BSP's jobs
+    macro limits the number of its tests run at once.
+
+    With adaptive timeouts a test's timeout is taken from its run time
+    history using the timeout_percentile, timeout_factor and timeout_floor
+    macros and is never longer than the BSP's timeout.'''
+
+    def __init__(self, name, opts, executables, spool = None):
+        self.name = name
+        self.opts = copy.copy(opts)
+        self.opts.defaults.load('%%{_configdir}/bsps/%s.mc' % (name))
+        bsp = self.opts.defaults.get('%{bsp}')
+        if not bsp:
+            raise error.general('BSP definition (%{bsp}) not found in the global map')
+        self.bsp = bsp[2]
+        if not self.opts.defaults.set_read_map(self.bsp):
+            raise error.general('no BSP map found')
+        bsp_script = self.opts.defaults.get(self.bsp)
+        if not bsp_script:
+            raise error.general('BSP script not found: %s' % (self.bsp))
+        self.config = self.opts.defaults.expand(self.opts.defaults[self.bsp])
+        self.executables = executables
+        self.report = report.report(len(executables), spool)
+        self.cached = None
+        self.timeouts = None
+        try:
+            self.timeout = int(self.opts.defaults.expand('%{timeout}'))
+            self.timeout_percent = \
+                float(self.opts.defaults.expand('%{timeout_percentile}'))
+            self.timeout_factor = \
+                float(self.opts.defaults.expand('%{timeout_factor}'))
+            self.timeout_floor = \
+                int(self.opts.defaults.expand('%{timeout_floor}'))
+        except ValueError:
+            raise error.general('invalid timeout configuration: %s' % (name))
+        self.jobs = int(self.opts.jobs(self.opts.defaults['_ncpus']))
+        if self.jobs < 1:
+            self.jobs = 1
+        self.running = 0
+        self.resources = {}
+        if 'bsp_resources' in self.opts.defaults:
+            for l in self.opts.defaults.expand('%{bsp_resources}').splitlines():
+                l = l.strip()
+                if len(l) == 0:
+                    continue
+                ls = l.split(':', 1)
+                if len(ls) != 2 or len(ls[0].strip()) == 0 or len(ls[1].split()) == 0:
+                    raise error.general('invalid BSP resource: %s: %s' % (name, l))
+                self.resources[ls[0].strip().lower()] = ls[1].split()
+        invalid_tests = self.opts.defaults['invalid_tests']
+        if invalid_tests:
+            self.report.set_invalid_tests([l.strip() for l in invalid_tests.splitlines()])
+
+    def deadline(self, index):
+        '''The adaptive timeout of a test or None if the test's timeout is
+        %{timeout}.'''
+        if self.timeouts is None:
+            return None
+        return self.timeouts.deadline(self.name, self.executables[index],
+                                      self.timeout_percent,
+                                      self.timeout_factor,
+                                      self.timeout_floor,
+                                      self.timeout)
+
+def bsp_list(arg):
+    '''The BSPs to test are a comma separated list or '@' and a file that
+    lists a BSP per line. A BSP in a file can be followed by the paths to the
+    executables to test on it. A BSP without paths uses the paths on the
+    command line.'''
+    bsps = []
+    if arg.startswith('@'):
+        try:
+            lf = open(path.host(arg[1:]), 'r')
+            try:
+                lines = lf.readlines()
+            finally:
+                lf.close()
+        except IOError as err:
+            raise error.general('reading BSP list: %s: %s' % (arg[1:], str(err)))
+        for l in lines:
+            if '#' in l:
+                l = l[:l.index('#')]
+            ls = l.split()
+            if len(ls):
+                bsps += [(ls[0], ls[1:])]
+    else:
+        bsps = [(b.strip(), []) for b in arg.split(',') if len(b.strip())]
+    if len(bsps) == 0:
+        raise error.general('no BSP provided')
+    names = [b[0] for b in bsps]
+    for name in names:
+        if names.count(name) > 1:
+            raise error.general('BSP listed more than once: %s' % (name))
+    return bsps
+
+def remote_token(opts):
+    '''The token remote workers give the coordinator from the option or the
+    environment. None is returned if there is no token.'''
+    token = opts.find_arg('--remote-token')
+    if token:
+        if len(token) != 2 or len(token[1]) == 0:
+            raise error.general('invalid remote token option')
+        return token[1]
+    token = os.environ.get(remote.token_env)
+    if token:
+        return token
+    return None
+
+def run_worker(opts, coordinator, rtems_tools):
+    '''Run the tests the coordinator sends. The BSPs are loaded as the tests
+    for them arrive.'''
+    lock = threading.Lock()
+    bsp_runs = {}
+    def runner(msg, executable, reporter):
+        lock.acquire()
+        try:
+            if msg['bsp'] not in bsp_runs:
+                bsp_runs[msg['bsp']] = bsp_run(msg['bsp'], opts, [])
+            br = bsp_runs[msg['bsp']]
+        finally:
+            lock.release()
+        tst = test(msg['index'], msg['total'], reporter, executable,
+                   rtems_tools, br.bsp, br.config, br.opts,
+                   msg.get('resources'), msg.get('deadline'))
+        tst.run()
+    jobs = int(opts.jobs(opts.defaults['_ncpus']))
+    try:
+        remote.worker(coordinator, jobs, runner, report.forwarder,
+                      token = remote_token(opts)).run()
+    finally:
+        gdb.sessions.close()
+        qemu.instances.close()
+
 def find_executables(paths, glob):
-    executables = []
-    for p in paths:
-        if path.isfile(p):
-            executables += [p]
-        elif path.isdir(p):
-            for root, dirs, files in os.walk(p, followlinks = True):
-                for f in files:
-                    if fnmatch.fnmatch(f.lower(), glob):
-                        executables += [path.join(root, f)]
-    return sorted(executables)
-
-def report_finished(reports, report_mode, reporting, finished, job_trace):
+    return sorted(discover.executables(paths, glob))
+
+def next_test(bsp_runs, pending, resources):
+    '''Return the position of the next test to start, its BSP run and the
+    resources it is given. The test that has waited longest of the BSPs with
+    free resources is started so a BSP waiting for a resource does not hold up
+    the others.'''
+    heads = [(pending[br.name][0], br) for br in bsp_runs \
+             if len(pending[br.name]) and br.running < br.jobs]
+    for position, br in sorted(heads, key = lambda h: h[0]):
+        allocation = resources.acquire(br.resources)
+        if allocation is not None:
+            pending[br.name].popleft()
+            return position, br, allocation
+    return None, None, None
+
+def report_finished(report_mode, reporting, finished, job_trace):
     processing = True
     while processing:
         processing = False
         reported = []
         for tst in finished:
             if tst not in reported and \
-                    (reporting < 0 or tst.index == reporting):
+                    (reporting < 0 or tst.sequence == reporting):
                 if job_trace:
                     log.notice('}} %*d: %s: %s (%d)' % (len(str(tst.total)), tst.index,
                                                         path.basename(tst.executable),
                                                         'reporting',
                                                         reporting))
                 processing = True
-                reports.log(tst.executable, report_mode)
+                tst.report.log(tst.executable, report_mode)
                 reported += [tst]
                 reporting += 1
         finished[:] = [t for t in finished if t not in reported]
@@ -179,25 +508,104 @@ def list_bsps(opts):
         log.notice('  %s' % (path.basename(bsp[:-3])))
     raise error.exit()
 
+def summarise(reports):
+    '''Log the summary of each BSP's report and a table of the BSPs if more
+    than one BSP was tested. The reports are a list of BSP name and report
+    pairs.'''
+    for name, rep in reports:
+        if len(reports) > 1:
+            log.output()
+            log.notice('BSP: %s' % (name))
+        rep.summary()
+    if len(reports) > 1:
+        log.output()
+        log.notice('BSP Summary:')
+        name_len = max([len(name) for name, rep in reports])
+        for name, rep in reports:
+            log.notice(' %-*s p:%-*d f:%-*d t:%-*d i:%-*d total:%d' % \
+                       (name_len, name,
+                        rep.total_len, rep.passed,
+                        rep.total_len, rep.failed,
+                        rep.total_len, rep.timeouts,
+                        rep.total_len, rep.invalids,
+                        rep.total))
+
+def shard_option(arg):
+    '''Parse a shard option, i/n, into the shard index and count.'''
+    try:
+        index, count = [int(a) for a in arg.split('/')]
+    except ValueError:
+        raise error.general('invalid shard option: %s' % (arg))
+    if count < 1 or index < 1 or index > count:
+        raise error.general('invalid shard option: %s' % (arg))
+    return index, count
+
 def killall(tests):
     for test in tests:
         test.kill()
 
+def parse_cache(args):
+    '''Enable the parse cache if the arguments have the option. The defaults
+    are parsed as the options are loaded so the cache is enabled first.'''
+    for arg in args[1:]:
+        if arg == '--parse-cache':
+            cache.parsed.enable('rtems-test-parse-cache')
+        elif arg.startswith('--parse-cache='):
+            if len(arg) == len('--parse-cache='):
+                raise error.general('invalid parse cache option')
+            cache.parsed.enable(arg[len('--parse-cache='):])
+
+def shell_macros():
+    '''Log the shell macros run and the runs the shell cache avoided.'''
+    if cache.shells.spawns or cache.shells.avoided:
+        log.notice('Shell macros     : %d run, %d cached' % \
+                   (cache.shells.spawns, cache.shells.avoided))
+
+def timers_fired():
+    '''Log the timeouts the timer service fired.'''
+    if execute.timers.timeouts():
+        log.notice('Timers fired     : %d deadline, %d no output' % \
+                   (execute.timers.fired['deadline'],
+                    execute.timers.fired['idle']))
+
 def run(command_path = None):
     import sys
     tests = []
+    pool = None
+    output_spool = None
     stdtty = console.save()
     opts = None
     default_exefilter = '*.exe'
     try:
         optargs = { '--rtems-tools': 'The path to the RTEMS tools',
-                    '--rtems-bsp':   'The RTEMS BSP to run the test on',
+                    '--rtems-bsp':   'The RTEMS BSP or BSPs to run the tests on: bsp[,bsp] or @file',
                     '--report-mode': 'Reporting modes, failures (default),all,none',
+                    '--executor':    'Run tests in threads (default), worker processes or remote workers: thread,process,remote',
+                    '--listen':      'Address the coordinator listens on for remote workers, the host is 127.0.0.1 if not given: [host:]port',
+                    '--worker':      'Run tests for the coordinator at the address: host:port',
+                    '--remote-token': 'Token workers give the coordinator, unset any host that can connect is a worker (default: RTEMS_TEST_TOKEN environment)',
+                    '--schedule':    'Test start order, alpha (default) or longest first from the history: alpha,history',
+                    '--history':     'Test run time history file (default: rtems-test-history.json)',
+                    '--parse-cache': 'Cache the parsed macro and configuration files (default: rtems-test-parse-cache)',
+                    '--adaptive-timeout': 'Time out tests from their run time history rather than %{timeout}',
+                    '--qemu-reuse':  'Keep a QEMU running for each job slot and load each test into it',
+                    '--profile':     'Time the phases of each test and save them to a JSON or CSV file (default: rtems-test-profile.json)',
+                    '--spool-dir':   'Keep the output of each test in a file in the directory rather than a temporary directory',
+                    '--spool-compress': 'Compress the output files of the tests',
+                    '--status-interval': 'Seconds between status lines, 0 for none (default: 30)',
+                    '--status-file': 'Write the status of the run to a JSON file',
+                    '--status-listen': 'Serve the status of the run as JSON over HTTP: [host:]port',
+                    '--incremental': 'Report tests that passed before and have not changed as cached passes',
+                    '--cache-dir':   'Incremental test cache directory (default: rtems-test-cache)',
+                    '--shard':       'Run a part of the tests, shard i of n: i/n',
+                    '--results':     'Save the results of the run to a file',
+                    '--merge-reports': 'Merge the result files given and report a summary',
                     '--list-bsps':   'List the supported BSPs',
                     '--debug-trace': 'Debug trace based on specific flags',
                     '--filter':      'Glob that executables must match to run (default: ' +
                               default_exefilter + ')',
                     '--stacktrace':  'Dump a stack trace on a user termination (^C)' }
+        parse_cache(sys.argv)
         opts = options.load(sys.argv,
                             optargs = optargs,
                             command_path = command_path)
@@ -224,20 +632,30 @@ def run(command_path = None):
             rtems_tools = rtems_tools[1]
         else:
             rtems_tools = '%{_prefix}'
+        worker = opts.find_arg('--worker')
+        if worker:
+            if len(worker) != 2:
+                raise error.general('invalid worker option')
+            run_worker(opts, worker[1], rtems_tools)
+            sys.exit(0)
+        if opts.find_arg('--merge-reports'):
+            if len(opts.params()) == 0:
+                raise error.general('no result files to merge')
+            reports = report.load(opts.params())
+            summarise(reports)
+            history_file = opts.find_arg('--history')
+            if history_file:
+                if len(history_file) != 2:
+                    raise error.general('invalid history option')
+                run_times = history.history(history_file[1])
+                for bsp_name, rep in reports:
+                    run_times.update(bsp_name, rep.results)
+                run_times.save()
+            sys.exit(0)
         bsp = opts.find_arg('--rtems-bsp')
         if bsp is None or len(bsp) != 2:
             raise error.general('RTEMS BSP not provided or invalid option')
-        opts.defaults.load('%%{_configdir}/bsps/%s.mc' % (bsp[1]))
-        bsp = opts.defaults.get('%{bsp}')
-        if not bsp:
-            raise error.general('BSP definition (%{bsp}) not found in the global map')
-        bsp = bsp[2]
-        if not opts.defaults.set_read_map(bsp):
-            raise error.general('no BSP map found')
-        bsp_script = opts.defaults.get(bsp)
-        if not bsp_script:
-            raise error.general('BSP script not found: %s' % (bsp))
-        bsp_config = opts.defaults.expand(opts.defaults[bsp])
+        bsp = bsp_list(bsp[1])
         report_mode = opts.find_arg('--report-mode')
         if report_mode:
             if report_mode[1] != 'failures' and \
@@ -247,61 +665,327 @@ def run(command_path = None):
             report_mode = report_mode[1]
         else:
             report_mode = 'failures'
-        executables = find_executables(opts.params(), exe_filter)
-        if len(executables) == 0:
-            raise error.general('no executables supplied')
+        executor = opts.find_arg('--executor')
+        if executor:
+            if len(executor) != 2 or executor[1] not in ['thread', 'process', 'remote']:
+                raise error.general('invalid executor option')
+            executor = executor[1]
+        else:
+            executor = 'thread'
+        listen = opts.find_arg('--listen')
+        if listen:
+            if len(listen) != 2:
+                raise error.general('invalid listen option')
+            listen = listen[1]
+        else:
+            listen = ':%d' % (remote.default_port)
+        schedule = opts.find_arg('--schedule')
+        if schedule:
+            if len(schedule) != 2 or schedule[1] not in ['alpha', 'history']:
+                raise error.general('invalid schedule option')
+            schedule = schedule[1]
+        else:
+            schedule = 'alpha'
+        shard = opts.find_arg('--shard')
+        if shard:
+            if len(shard) != 2:
+                raise error.general('invalid shard option')
+            shard = shard_option(shard[1])
+            shard_name = '%d/%d' % (shard)
+        else:
+            shard_name = None
+        results_file = opts.find_arg('--results')
+        if results_file:
+            if len(results_file) != 2:
+                raise error.general('invalid results option')
+            results_file = results_file[1]
+        adaptive_timeout = opts.find_arg('--adaptive-timeout') is not None
+        if opts.find_arg('--qemu-reuse'):
+            opts.defaults['qemu_reuse'] = '1'
+        status_interval = opts.find_arg('--status-interval')
+        if status_interval:
+            if len(status_interval) != 2:
+                raise error.general('invalid status interval option')
+            status_interval = status_interval[1]
+        else:
+            status_interval = opts.defaults.expand('%{status_interval}')
+        try:
+            status_interval = float(status_interval)
+        except ValueError:
+            raise error.general('invalid status interval: %s' % (status_interval))
+        profile_file = opts.find_arg('--profile')
+        if profile_file:
+            if executor != 'thread':
+                raise error.general('profiling needs the thread executor')
+            if len(profile_file) == 2:
+                profile_file = profile_file[1]
+            else:
+                profile_file = 'rtems-test-profile.json'
+            profile = profiler.profile()
+        else:
+            profile = None
+        spool_dir = opts.find_arg('--spool-dir')
+        if spool_dir:
+            if len(spool_dir) != 2:
+                raise error.general('invalid spool directory option')
+            spool_dir = spool_dir[1]
+        try:
+            spool_excerpt = int(opts.defaults.expand('%{spool_excerpt}'))
+        except ValueError:
+            raise error.general('invalid output spool excerpt')
+        status_file = opts.find_arg('--status-file')
+        if status_file:
+            if len(status_file) != 2:
+                raise error.general('invalid status file option')
+            status_file = status_file[1]
+        status_listen = opts.find_arg('--status-listen')
+        if status_listen:
+            if len(status_listen) != 2:
+                raise error.general('invalid status listen option')
+            status_listen = status_listen[1]
+        history_file = opts.find_arg('--history')
+        if history_file:
+            if len(history_file) != 2:
+                raise error.general('invalid history option')
+            history_file = history_file[1]
+        elif schedule == 'history' or shard or adaptive_timeout:
+            history_file = opts.defaults.expand('%{test_history}')
+        if history_file:
+            run_times = history.history(history_file)
+        else:
+            run_times = None
+        if opts.find_arg('--incremental'):
+            cache_dir = opts.find_arg('--cache-dir')
+            if cache_dir:
+                if len(cache_dir) != 2:
+                    raise error.general('invalid cache directory option')
+                cache_dir = cache_dir[1]
+            else:
+                cache_dir = opts.defaults.expand('%{test_cache}')
+            test_cache = incremental.cache(cache_dir,
+                                           incremental.size_value(opts.defaults.expand('%{test_cache_size}')))
+        else:
+            test_cache = None
+        #
+        # A single BSP run in alphabetical order starts its tests as the
+        # executables are found. Scheduling from the history and sharding
+        # need all the executables before the first test starts.
+        #
+        streaming = len(bsp) == 1 and schedule == 'alpha' and not shard
+        executables = None
+        bsp_executables = []
+        for name, paths in bsp:
+            if len(paths) == 0:
+                paths = opts.params()
+                if streaming:
+                    executables = []
+                elif executables is None:
+                    executables = find_executables(paths, exe_filter)
+                bsp_executables += [(name, executables)]
+            elif streaming:
+                bsp_executables += [(name, [])]
+            else:
+                bsp_executables += [(name, find_executables(paths, exe_filter))]
+            if not streaming and len(bsp_executables[-1][1]) == 0:
+                raise error.general('no executables supplied: %s' % (name))
+        if shard:
+            candidates = []
+            for name, exes in bsp_executables:
+                candidates += [(name, e) for e in exes]
+            selected = run_times.shard(candidates, shard[0], shard[1])
+            selected = set([candidates[i] for i in selected])
+            bsp_executables = [(name, [e for e in exes if (name, e) in selected])
+                               for name, exes in bsp_executables]
+            log.notice('Shard %d of %d: %d of %d test(s)' % \
+                       (shard[0], shard[1], len(selected), len(candidates)))
+        output_spool = report.spool(spool_dir,
+                                    opts.find_arg('--spool-compress') is not None,
+                                    spool_excerpt)
+        bsp_runs = []
+        for name, exes in bsp_executables:
+            if len(exes) == 0 and not streaming:
+                continue
+            bsp_runs += [bsp_run(name, opts, exes, output_spool)]
+            if test_cache is not None:
+                bsp_runs[-1].cached = test_cache.bsp(bsp_runs[-1], rtems_tools)
+            if adaptive_timeout:
+                bsp_runs[-1].timeouts = run_times
+        #
+        # The work is each BSP's executables in test order. The sequence is
+        # the order the tests are reported in.
+        #
+        work = []
+        for br in bsp_runs:
+            for index in range(0, len(br.executables)):
+                work += [(br, index)]
+        total = len(work)
+        if total == 0 and not streaming:
+            log.notice('No tests to run')
+            if results_file:
+                report.save(results_file, [], shard_name)
+            sys.exit(0)
+        if schedule == 'history':
+            dispatch = run_times.longest_first([(w[0].name, w[0].executables[w[1]])
+                                                for w in work])
+        else:
+            dispatch = list(range(0, total))
         start_time = datetime.datetime.now()
-        total = len(executables)
-        reports = report.report(total)
-        invalid_tests = opts.defaults['invalid_tests']
-        if invalid_tests:
-            reports.set_invalid_tests([l.strip() for l in invalid_tests.splitlines()])
         reporting = 1
-        jobs = int(opts.jobs(opts.defaults['_ncpus']))
+        if opts.jobs_auto() and executor != 'remote':
+            try:
+                jobs_min = int(opts.defaults.expand('%{jobs_min}'))
+                jobs_max = int(opts.defaults.expand('%{jobs_max}'))
+                jobs_interval = float(opts.defaults.expand('%{jobs_interval}'))
+                jobs_reserve = int(opts.defaults.expand('%{jobs_reserve}'))
+            except ValueError:
+                raise error.general('invalid automatic jobs configuration')
+            jobs = jobs_max
+            for br in bsp_runs:
+                br.jobs = jobs
+        else:
+            jobs_min = None
+            jobs = max([br.jobs for br in bsp_runs])
         exe = 0
+        queued = 0
+        pending = dict([(br.name, collections.deque()) for br in bsp_runs])
         finished = []
-        if jobs > len(executables):
-            jobs = len(executables)
-        while exe < total or len(tests) > 0:
-            if exe < total and len(tests) < jobs:
-                tst = test_run(exe + 1, total, reports,
-                               executables[exe],
-                               rtems_tools, bsp, bsp_config,
-                               opts)
+        if jobs > total and not streaming:
+            jobs = total
+        if executor == 'process':
+            pool = process_pool(jobs, [br.opts for br in bsp_runs])
+        elif executor == 'remote':
+            pool = remote.coordinator(listen, bsp_runs,
+                                      token = remote_token(opts))
+        for br in bsp_runs:
+            if len(br.resources):
+                log.notice('Resources: %s: %s' % \
+                           (br.name,
+                            ', '.join(['%s: %s' % (n, ' '.join(br.resources[n]))
+                                       for n in sorted(br.resources)])))
+        sched = scheduler.scheduler(jobs, scheduler.resources())
+        tests = sched.active
+        if jobs_min is not None:
+            gov = governor.governor(sched, int(opts.defaults['_ncpus']),
+                                    min(jobs_min, jobs), jobs,
+                                    jobs_interval, jobs_reserve)
+        else:
+            gov = None
+        if streaming:
+            finder = discover.discovery(paths, exe_filter, sched.wake)
+        else:
+            finder = None
+        if status_interval > 0 or status_file or status_listen:
+            stat = status.status(sched, [(br.name, br.report) for br in bsp_runs],
+                                 status_interval, status_file, status_listen)
+            stat.update(total, finder is not None, force = True)
+        else:
+            stat = None
+        while finder is not None or exe < total or sched.running() > 0:
+            if gov is not None:
+                gov.update()
+            if finder is not None:
+                found, done = finder.take()
+                br = bsp_runs[0]
+                for e in found:
+                    work += [(br, len(br.executables))]
+                    dispatch += [total]
+                    br.executables += [e]
+                    total += 1
+                if done:
+                    finder = None
+                    if total == 0:
+                        raise error.general('no executables supplied: %s' % (br.name))
+                    br.report.set_total(total)
+            while queued < total:
+                pending[work[dispatch[queued]][0].name].append(queued)
+                queued += 1
+            while exe < total and sched.available():
+                position, br, allocation = next_test(bsp_runs, pending,
+                                                     sched.resources)
+                if position is None:
+                    break
+                br, index = work[dispatch[position]]
+                if finder is None:
+                    exe_total = len(br.executables)
+                else:
+                    exe_total = 0
+                tst = test_run(index + 1, exe_total, br.report,
+                               br.executables[index],
+                               rtems_tools, br.bsp, br.config,
+                               br.opts, pool,
+                               sequence = dispatch[position] + 1,
+                               cached = br.cached,
+                               deadline = br.deadline(index),
+                               profile = profile)
                 exe += 1
-                tests += [tst]
                 if job_trace:
                     _job_trace(tst, 'create',
                                total, exe, tests, reporting)
-                tst.run()
-            else:
-                dead = [t for t in tests if not t.is_alive()]
-                tests[:] = [t for t in tests if t not in dead]
-                for tst in dead:
-                    if job_trace:
-                        _job_trace(tst, 'dead',
-                                   total, exe, tests, reporting)
-                    finished += [tst]
-                    tst.reraise()
-                del dead
-                if len(tests) >= jobs or exe >= total:
-                    time.sleep(0.250)
-                if len(finished):
-                    reporting = report_finished(reports,
-                                                report_mode,
-                                                reporting,
-                                                finished,
-                                                job_trace)
+                br.running += 1
+                sched.start(tst, allocation)
+            if exe < total and sched.running() == 0 and finder is None:
+                raise error.internal('no test can be started')
+            if finder is not None and sched.running() == 0:
+                finder.wait(1.0)
+                continue
+            if stat is not None:
+                stat.update(total, finder is not None)
+            for tst in sched.wait():
+                for br in bsp_runs:
+                    if br.opts is tst.opts:
+                        br.running -= 1
+                if job_trace:
+                    _job_trace(tst, 'dead',
+                               total, exe, tests, reporting)
+                finished += [tst]
+                tst.reraise()
+            if len(finished):
+                reporting = report_finished(report_mode,
+                                            reporting,
+                                            finished,
+                                            job_trace)
         finished_time = datetime.datetime.now()
-        reporting = report_finished(reports, report_mode,
+        if gov is not None:
+            gov.stop()
+        if stat is not None:
+            stat.stop(total)
+        gdb.sessions.close()
+        qemu.instances.close()
+        if pool is not None:
+            pool.close()
+            pool = None
+        reporting = report_finished(report_mode,
                                     reporting, finished, job_trace)
         if reporting < total:
             log.warning('finished jobs does match: %d' % (reporting))
-            report_finished(reports, report_mode, -1, finished, job_trace)
-        reports.summary()
+            report_finished(report_mode, -1, finished, job_trace)
+        summarise([(br.name, br.report) for br in bsp_runs])
+        if results_file:
+            report.save(results_file,
+                        [(br.name, br.report) for br in bsp_runs],
+                        shard_name)
+        #
+        # A shard does not save the history. The next shard splits the tests
+        # using the history and a different history is a different split.
+        #
+        if run_times is not None and not shard:
+            for br in bsp_runs:
+                run_times.update(br.name, br.report.results)
+            run_times.save()
+        if test_cache is not None:
+            removed = test_cache.prune()
+            log.notice('Test cache       : %d hit(s), %d stored, %d removed' % \
+                       (test_cache.hits, test_cache.stores, removed))
+        shell_macros()
+        timers_fired()
+        if profile is not None:
+            profile.save(profile_file)
+            profile.summary()
         end_time = datetime.datetime.now()
         log.notice('Average test time: %s' % (str((end_time - start_time) / total)))
         log.notice('Testing time     : %s' % (str(end_time - start_time)))
+        log.notice('Job utilisation  : %.1f%% of %d slot(s), %.1f tests/min' % \
+                   (sched.utilisation() * 100.0, sched.jobs, sched.rate()))
     except error.general as gerr:
         print(gerr)
         sys.exit(1)
@@ -318,8 +1002,14 @@ def run(command_path = None):
             print(stacktraces.trace())
         log.notice('abort: user terminated')
         killall(tests)
+        gdb.sessions.close()
+        qemu.instances.close()
+        if pool is not None:
+            pool.terminate()
         sys.exit(1)
     finally:
+        if output_spool is not None:
+            output_spool.close()
         console.restore(stdtty)
     sys.exit(0)
 